@@ -32,6 +32,7 @@ import numpy as np
 from scipy.optimize import curve_fit
 from scipy import optimize
 import matplotlib.pyplot as plt
+from LineGeometry import flip_lines_low_to_high
 
 arcpy.env.overwriteOutput = True
 arcpy.env.XYTolerance= "0.01 Meters"
@@ -115,48 +116,8 @@ def Dist(x1,y1,x2,y2):
 # It is revised from the codes by Pellitero et al.(2016) in GlaRe.
 #------------------------------------------------------------------------------------------------------------
 def Check_If_Flip_Line_Direction(line, dem):
-    cellsize = arcpy.GetRasterProperties_management(dem,"CELLSIZEX")
-    cellsize_int = int(float(cellsize.getOutput(0)))
-    #arcpy.AddMessage("cellsize_int: " + str(cellsize_int))
-
-    line3d = arcpy.env.scratchGDB + "\\line3d"
-    arcpy.AddField_management(line, "Flip", "Long", "", "", "", "", "", "", "")
-
-    arcpy.InterpolateShape_3d(dem, line, line3d, cellsize_int*3) 
-
-    flip_list = []
-    i = 0
-    with arcpy.da.SearchCursor(line3d,["Shape@"]) as cursor:
-        for row in cursor:
-            startZ = row[0].firstPoint.Z
-            endZ = row[0].lastPoint.Z
-
-            if startZ >= endZ:  ##Flip = True use equal in case the start and end point are the same
-                flip_list.append(1)
-            else:  ##Flip = False
-                flip_list.append(0)
-            i += 1 
-
-    del cursor
-    if i>0:
-        del row
-
-    if sum(flip_list) > 0:
-        with arcpy.da.UpdateCursor(line,["Flip"]) as cursor:
-            i = 0
-            for row in cursor:
-                row[0] = flip_list[i]
-                cursor.updateRow(row)
-                i += 1 
-        del row, cursor
-
-        arcpy.MakeFeatureLayer_management(line, "lyrLines")
-        arcpy.SelectLayerByAttribute_management("lyrLines", "NEW_SELECTION", '"Flip" > 0')
-        arcpy.FlipLine_edit("lyrLines")  ##Need to change to lyrLines
-        arcpy.SelectLayerByAttribute_management("lyrLines", "CLEAR_SELECTION")
-
-    arcpy.DeleteField_management (line, "Flip")
-    arcpy.Delete_management(line3d)
+    ##Sample the DEM at the two end points of all lines in one lookup and reverse the lines in memory
+    flip_lines_low_to_high(line, dem)
 
 ###rdp only positive distance!!! for turning point detection
 def Knickpoints_rdp(points, epsilon, turn_points, dists):
@@ -27,10 +27,16 @@ from arcpy.sa import *
 import numpy as np
 import math
 import os, sys
+import shutil, tempfile
 import scipy
 from scipy.spatial import cKDTree as KDTree
 from scipy import ndimage
 import arcpy.cartography as CA
+from FlowCache import get_flow_products, invalidate_flow_cache, dem_fingerprint, feature_fingerprints, cache_lookup, stage_cache_key, stage_cache_store
+from StreamNetwork import stream_graph, stream_graphs_from_arrays, prune_stream_graph, dissolve_stream_graph, links_to_features, save_stream_arrays, load_stream_arrays, join_link_max, prune_tributaries, trim_dangling_links, points_on_lines, assign_valley_ids
+from FlowRouting import watershed_labels, downstream_labels, numpy_watershed, watershed_mask, watershed_statistics, fdir_dtype, label_dtype
+from LineGeometry import ragged_from_ids, remove_big_turns, smooth_lines, flip_lines_low_to_high
+from LeastCostPath import least_cost_stream_graphs
 
 arcpy.env.overwriteOutput = True
 arcpy.env.XYTolerance= "0.01 Meters"
@@ -63,6 +69,75 @@ else:
 temp_workspace = "in_memory"  
 if ArcGISPro:
     temp_workspace = "memory"
+
+##Folder to cache the Fill/FlowDirection/FlowAccumulation products between runs ("" to disable the cache)
+##and the maximum size of the cache folder in GB. The least recently used entries are removed first.
+##FlowCacheInvalidate removes the cached entries of the input DEM before the run, i.e. when the DEM was edited in
+##place and the fingerprint did not catch the change.
+FlowCacheFolder = ""
+FlowCacheMaxGB = 20
+FlowCacheInvalidate = False
+
+##Backend to derive the filled DEM, flow direction and flow accumulation: "arcpy" (Spatial Analyst tools)
+##or "numpy" (the arcpy-free priority-flood and D8 routing engine in FlowRouting.py)
+RoutingBackend = "arcpy"
+
+##Tile size (cells) of the tiled NumPy routing for large DEMs; 0 routes the whole DEM in memory
+RoutingTileSize = 0
+
+##Delineate the watersheds of all valleys with a single Watershed call instead of one call per valley
+BatchWatershed = True
+
+##Add the hypsometry and relief statistics of each valley to the output watersheds: the area (AreaKM2), the minimum,
+##maximum and mean elevation of the filled DEM, the hypsometric integral (HI) and the hypsometric curve (Hypsometry,
+##the fraction of the area above each of the HypsometryBins relative heights from 0, as text). The statistics are
+##derived from the cleaned watershed mask of each valley (the same mask as the output watershed polygons).
+WatershedStatistics = False
+HypsometryBins = 10
+
+##Coarse-to-fine bounding of the routing: the aggregation factor of the coarse DEM (0 to route the whole DEM) and
+##the buffer (coarse cells) of the catchment windows of the valleys. If set, the filled DEM, flow direction and
+##flow accumulation are only derived within the catchment windows with the NumPy engine (whatever RoutingBackend
+##is), which is much faster if the valleys only cover a small part of a large DEM. If the windows do not contain the
+##catchments, the whole DEM is routed with the tiled NumPy routing (RoutingTileSize, or 1024 if 0) with a warning.
+CoarseBoundingFactor = 0
+CoarseBoundingBuffer = 2
+
+##Number of halo cells around the watershed of a valley for the per-valley processing window
+ValleyWindowHalo = 5
+
+##Tolerance (m) of the point on line tests between the streamlines, the same as arcpy.env.XYTolerance
+TopologyTolerance = 0.01
+
+##Vectorizer of the stream links: "numpy" (trace the links from the arrays in StreamNetwork.py) or
+##"arcpy" (StreamLink and StreamToFeature tools)
+StreamVectorizer = "numpy"
+
+##Tracing of the streamlines with the numpy vectorizer: "d8" (the D8 stream cells) or "leastcost" (the least-cost
+##paths along the valley bottom from the channel heads of the stream threshold to the outlet, which do not zigzag
+##on flat valley floors; see LeastCostPath.py). LeastCostRadius is the radius (cells) of the local valley floor and
+##LeastCostHeightScale is the height (m) above the floor that doubles the cost of a cell.
+StreamTracing = "d8"
+LeastCostRadius = 10
+LeastCostHeightScale = 1.0
+
+##Number of worker processes for the valleys (each valley is processed independently after the flow products
+##and the watersheds of all valleys are derived); 0 or 1 processes the valleys one by one in this process
+ValleyWorkers = 0
+
+##Folder to cache the stage outputs of each valley (watershed, raw stream network and pruned streamlines) between
+##runs ("" to disable), so that a re-run with a new stream threshold, tributary or smoothing parameters only
+##recomputes the changed stages (the numpy vectorizer only). The stages of a valley are keyed on its own geometry,
+##so editing one valley only recomputes that valley. The stages are kept in the "stages" subfolder with their own
+##size limit (StageCacheMaxGB), so that they never evict the flow products, which are also cached in this folder
+##if FlowCacheFolder is not set.
+StageCacheFolder = ""
+StageCacheMaxGB = 5
+
+##Stream thresholds (km2) of the sweep mode, i.e. [0.5, 1, 2, 5]. If set, the flow products and the watersheds
+##are derived once and the streamlines of all thresholds are derived from the same flow accumulation and written
+##to the output with the ThresholdKM2 field; the StreamThresholdKM2 parameter is not used.
+StreamThresholdSweepKM2 = []
     
 #------------------------------------------------------------------------------------------------------------
 # This function calcuates the 2D distance of two points
@@ -115,30 +190,16 @@ def numpy_array_to_features(in_fc, in_array, geom_fields, id_field):
 
 #------------------------------------------------------------------------------------------------------------
 # The function cleans extrlines based on from and to nodes. If only one to node and no corresponding from node, 
-# except for the highest facc section, marking for deletion. The same processes are iterated to remove all extra 
-# lines. This is more efficient than other clean line methods based on the intersect of the to node points.
+# except for the highest facc section, marking for deletion. The same processes are repeated to remove all extra 
+# lines, which is done in memory by trimming the dangling lines from the leaves with a queue on the node degrees
+# (trim_dangling_links in StreamNetwork.py). The lines are read once and deleted in one pass.
 #------------------------------------------------------------------------------------------------------------
 def cleanextralineswithtopology(inline,outline, field):
-    bflag = 1
-    while bflag:
-        bflag = 0
-        lineArray = arcpy.da.FeatureClassToNumPyArray(inline,['OID@','from_node','to_node', field])
-        fromnode = np.array([item[1] for item in lineArray])
-        tonode = np.array([item[2] for item in lineArray])
-        facc = np.array([item[3] for item in lineArray])
-        uniquetonode = np.unique(tonode)
-        maxfacc = max(facc)
-
-        lineid = [] ##Record the id for deletion
-        for i in range(len(lineArray)):
-            linetonode = lineArray[i][2]
-            nodecount = np.count_nonzero(uniquetonode == linetonode)
-            if nodecount == 1 and not (linetonode in fromnode) and lineArray[i][3] < maxfacc: ###only one tonode except for the highest facc section
-                #print "mark for deletion"
-                lineid.append(lineArray[i][0])
-                bflag = 1
-
-        ##Delete the line marked for deletion
+    lineArray = arcpy.da.FeatureClassToNumPyArray(inline,['OID@','from_node','to_node', field])
+    lineid = set(trim_dangling_links(lineArray['OID@'], lineArray['from_node'], lineArray['to_node'], lineArray[field]).tolist())
+
+    ##Delete the line marked for deletion
+    if len(lineid) > 0:
         with arcpy.da.UpdateCursor(inline, "OID@") as cursor:
             for row in cursor:
                 if int(row[0]) in lineid:
@@ -149,7 +210,10 @@ def cleanextralineswithtopology(inline,outline, field):
     return outline
 
 #------------------------------------------------------------------------------------------------------------
-# This function smooths the streamlines by adjusting the big turns.
+# This function smooths the streamlines by adjusting the big turns. The vertices of all lines are read at once
+# and the big turns are removed as array operations over all lines (remove_big_turns in LineGeometry.py) with
+# repeated passes until no angle is smaller than the max angle. The new lines and their fields are written
+# with one cursor.
 #------------------------------------------------------------------------------------------------------------
 def streamline_remove_bigturn(streamline, max_angle, cellsize):
     
@@ -159,66 +223,34 @@ def streamline_remove_bigturn(streamline, max_angle, cellsize):
     ###Create the new line after removing the outlier points
     spatialref=arcpy.Describe(streamline).spatialReference
     new_line = arcpy.CreateFeatureclass_management(temp_workspace, "new_line","POLYLINE", streamline,"","", spatialref)
-    arcpy.AddField_management(new_line, "ORIG_FID", "LONG")
     exist_fields = [f.name for f in arcpy.ListFields(streamline)] #List of current field names in outline layer
-    #arcpy.AddMessage(exist_fields)
     fields = exist_fields[2:] ##The first two fields are FID and Geometry
     
-    linearray = arcpy.da.FeatureClassToNumPyArray(temp_workspace + "\\simply_line", fields)
+    linearray = arcpy.da.FeatureClassToNumPyArray(temp_workspace + "\\simply_line", ['OID@'] + fields)
+    line_rows = dict(zip(linearray['OID@'].tolist(), range(len(linearray))))
 
     pointarray = arcpy.da.FeatureClassToNumPyArray(temp_workspace + "\\streamline_points", ('SHAPE@X', 'SHAPE@Y','ORIG_FID'))
-    line_ids = np.array([item[2] for item in pointarray])
-    unique_line_ids = np.unique(line_ids)
-
-    for fid in unique_line_ids:
-        arr = pointarray[line_ids == fid]
-        ##Methd 2: move this point until the angle is larger than the max_angle
-        for row in range(len(arr)):
-            if row <(len(arr)-1) and row > 0:#if it is not first or last point of all
-                x1 = float(arr[row-1][0])
-                y1 = float(arr[row-1][1])
-                x = float(arr[row][0])
-                y = float(arr[row][1])
-                x2 = float(arr[row+1][0])
-                y2 = float(arr[row+1][1])
-                length1 = distance2points(x1, y1, x, y)
-                length2 = distance2points(x2, y2, x, y)
-                length  = distance2points(x1, y1, x2, y2)
-                pntangle = angle(length1, length2, length)
-                if pntangle < max_angle:
-                    midx = (x1 + x2)/2
-                    midy = (y1 + y2)/2
-                    for i in range(5):
-                        newx = x + (midx - x) * (i+1) / 5
-                        newy = y + (midy - y) * (i+1) / 5
-                        length1 = distance2points(x1, y1, newx, newy)
-                        length2 = distance2points(x2, y2, newx, newy)
-                        pntangle = angle(length1, length2, length)
-                        if pntangle > max_angle:
-                            arr[row][0] = newx
-                            arr[row][1] = newy
-                            break
-     
-        numpy_array_to_features(new_line, arr, ['SHAPE@X', 'SHAPE@Y'], 'ORIG_FID')
-
-    ##Assign field to the new_line
-    arcpy.DeleteField_management(new_line, 'ORIG_FID')
-
-    with arcpy.da.UpdateCursor(new_line, fields) as cursor:
-        i = 0
-        for row in cursor:
-            for j in range(len(fields)):
-                row[j] = linearray[i][j]
-            cursor.updateRow(row)
-            i += 1
-    del cursor, row
+    order, unique_line_ids, offsets = ragged_from_ids(pointarray['ORIG_FID'])
+    xy = np.column_stack((pointarray['SHAPE@X'][order], pointarray['SHAPE@Y'][order]))
+
+    ##Methd 2: move the points until the angles are larger than the max_angle
+    xy = remove_big_turns(xy, offsets, max_angle)
+
+    with arcpy.da.InsertCursor(new_line, ['SHAPE@'] + fields) as cursor:
+        for i in range(len(unique_line_ids)):
+            if offsets[i+1] - offsets[i] < 2: ##skip if not enough x,y pairs
+                continue
+            row = linearray[line_rows[int(unique_line_ids[i])]]
+            cursor.insertRow([xy[offsets[i]:offsets[i+1]].tolist()] + [row[f] for f in fields])
+    del cursor
 
     return new_line
 
 #------------------------------------------------------------------------------------------------------------
 # This fuction regroups streamlines to individual ValleyID and dissolve the streamline sections from the top 
 # to the lowest points or the confluence points of another streamline. The streamline direction has to be from 
-# low to high for each streamline.
+# low to high for each streamline. The start points are tested against the lines with a spatial index instead of
+# the pairwise Point.touches/within calls, and the IDs are assigned in one traversal from the outlet lines.
 #------------------------------------------------------------------------------------------------------------
 def Merge_and_Add_ValleyID_by_Topology (streamlines, FaccField, ValleyID, MergeID, outstreamline): 
 
@@ -226,98 +258,40 @@ def Merge_and_Add_ValleyID_by_Topology (streamlines, FaccField, ValleyID, MergeI
     arcpy.CopyFeatures_management(streamlines, streamlinecopy)
     arcpy.AddField_management(streamlinecopy, ValleyID, "Long") #Add GID to the streamline layer
     arcpy.AddField_management(streamlinecopy, MergeID, "Long") #Add MergeID to the streamline layer
-    #Calculate Field does not work in ArcGIS Pro, using the following code instead
-    with arcpy.da.UpdateCursor(streamlinecopy, [ValleyID, MergeID]) as cursor:
-        for row in cursor:
-            row[0] = -1
-            row[1] = -1
-            cursor.updateRow(row)
-    del row, cursor
 
     points=[]
-    lines=[]
+    parts = []
+    owner = []
+    ends = []
     facc = []
-    valleys = []
-    valley_ID = []
-    mergeid = []
-    mergeused = []
-    ##First loop to get the startpoints, lines and the ValleyID list
-    with arcpy.da.SearchCursor(streamlinecopy, ["SHAPE@", FaccField, ValleyID, MergeID]) as flows:
+    ##First loop to get the startpoints, the vertices of the lines and the facc
+    with arcpy.da.SearchCursor(streamlinecopy, ["SHAPE@", FaccField]) as flows:
+        i = 0
         for flow in flows:
             points.append(((flow[0].firstPoint).X, (flow[0].firstPoint).Y))
-            lines.append(flow[0])
+            ends.append(((flow[0].firstPoint).X, (flow[0].firstPoint).Y, (flow[0].lastPoint).X, (flow[0].lastPoint).Y))
+            for part in flow[0]:
+                parts.append([(pnt.X, pnt.Y) for pnt in part if pnt])
+                owner.append(i)
             facc.append(flow[1])
-            valley_ID.append(flow[2]) ##default are all -1 for each line
-            mergeid.append(flow[3])
-            mergeused.append(0)
-    del flow, flows
-    
-    lenarr = np.array(facc)
-    ids = lenarr.argsort()[::-1]
-
-    array=np.array(points)
-    ##Second loop: to get the lowest streamline and assign seperated glacier ID
-    iceId = 0
-    idlist = []
-    mergidlist = []
-    for i in range(len(array)):
-        nTouches=0
-        punto=arcpy.Point(array[i][0],array[i][1])
-        for a in range (len(array)):
-            if a != i: ##don't touch itself
-                touches=(punto.touches(lines[a]) or punto.within(lines[a]))
-                if touches==True: ##if the start point touches others
-                    #arcpy.AddMessage("touched")
-                    nTouches = 1
-                    break  ##break the loop
-        if nTouches==0: ##this is for glaicer iD
-            #arcpy.AddMessage("not touched")
-            valleys.append(lines[i])
-            idlist.append(iceId)
-            valley_ID[i] = iceId
-            mergeid[i] = iceId
-            mergidlist.append(iceId)
-            iceId += 1
-
-    ##Loop 3: to test if eachline touches the valleys
-    leftover = len(array) - len(valleys)
-    while leftover > 0:
-        #arcpy.AddMessage("leftover: " + str(leftover))
-        for i in range(len(array)):
-            nTouches=0
-            lineid = ids[i]
-            if mergeid[lineid] == -1:
-                punto=arcpy.Point(array[lineid][0],array[lineid][1])
-                for a in range (len(valleys)): 
-                    touches = punto.touches(valleys[a])
-                    if touches==True: ##if the start point touches others
-                        if valley_ID[lineid] == -1: ##if this line has not been assigned
-                            valley_ID[lineid] = idlist[a]
-                            valleys.append(lines[lineid])
-                            idlist.append(idlist[a])
-                            if (mergeused[a] == 0):
-                                mergeid[lineid] = mergidlist[a]
-                                mergidlist.append(mergidlist[a])
-                                mergeused[a] = 1
-                            else:
-                                ##Start a new mergeID
-                                maxmergid = max(mergidlist)
-                                mergeid[lineid] = maxmergid + 1
-                                mergidlist.append(maxmergid + 1)
-                    else:
-                        within = punto.within(valleys[a])
-                        if within==True: ##if the start point touches others
-                            if valley_ID[lineid] == -1: ##if this line has not been assigned
-                                valley_ID[lineid] = idlist[a]
-                                valleys.append(lines[lineid])
-                                idlist.append(idlist[a])
-                                ##start a new mergeid with the max mergid + 1
-                                maxmergid = max(mergidlist)
-                                mergeid[lineid] = maxmergid + 1
-                                mergidlist.append(maxmergid + 1)
-                        
-                ##update leftover
-            leftover = len(array) - len(valleys)
+            i += 1
+    if i > 0:
+        del flow
+    del flows
+
+    ##Find the lines that the start point of each line is on (touches or within) with the spatial index of the line vertices
+    array = np.array(points).reshape(-1, 2)
+    ends = np.array(ends).reshape(-1, 4)
+    pairs = points_on_lines(array, parts, owner, TopologyTolerance)
+    start = array[pairs[:, 0]]
+    line_ends = ends[pairs[:, 1]]
+    touches = (np.hypot(start[:, 0] - line_ends[:, 0], start[:, 1] - line_ends[:, 1]) <= TopologyTolerance) | \
+              (np.hypot(start[:, 0] - line_ends[:, 2], start[:, 1] - line_ends[:, 3]) <= TopologyTolerance)
+
+    ##Assign the ValleyID and MergeID from the outlet lines (the start points not touching other lines)
+    valley_ID, mergeid = assign_valley_ids(len(array), facc, pairs, touches)
+    valley_ID = valley_ID.tolist()
+    mergeid = mergeid.tolist()
 
     ##Finally add ValleyID to the outstreamline
     i = 0
@@ -363,155 +337,300 @@ def Merge_and_Add_ValleyID_by_Topology (streamlines, FaccField, ValleyID, MergeI
 # It is revised from the codes by Pellitero et al.(2016) in GlaRe.
 #------------------------------------------------------------------------------------------------------------
 def Check_If_Flip_Line_Direction(line, dem):
-    cellsize = arcpy.GetRasterProperties_management(dem,"CELLSIZEX")
-    cellsize_int = int(float(cellsize.getOutput(0)))
-    #arcpy.AddMessage("cellsize_int: " + str(cellsize_int))
-
-    line3d = arcpy.env.scratchGDB + "\\line3d"
-    arcpy.AddField_management(line, "Flip", "Long", "", "", "", "", "", "", "")
-
-    arcpy.InterpolateShape_3d(dem, line, line3d, cellsize_int*3) 
-
-    flip_list = []
-    i = 0
-    with arcpy.da.SearchCursor(line3d,["Shape@"]) as cursor:
-        for row in cursor:
-            startZ = row[0].firstPoint.Z
-            endZ = row[0].lastPoint.Z
-
-            if startZ >= endZ:  ##Flip = True use equal in case the start and end point are the same
-                flip_list.append(1)
-            else:  ##Flip = False
-                flip_list.append(0)
-            i += 1 
+    ##Sample the DEM at the two end points of all lines in one lookup and reverse the lines in memory
+    nflip = flip_lines_low_to_high(line, dem)
+    if nflip > 0:
+        arcpy.AddMessage("The number of fliped lines is: " + str(nflip))
 
+#------------------------------------------------------------------------------------------------------------
+# This fuction smooths all lines in one pass: the vertices and fields of the lines are read with one cursor, the
+# lines are smoothed with the PAEK-equivalent Gaussian smoothing along the arc length (smooth_lines in
+# LineGeometry.py) and written with one cursor. The tolerance is a number or a dictionary of the tolerance of
+# each line (by OID).
+#------------------------------------------------------------------------------------------------------------
+def smooth_line_features(inline, outline, tolerance):
+    spatialref=arcpy.Describe(inline).spatialReference
+    fields = [f.name for f in arcpy.ListFields(inline) if f.editable and f.type not in ("OID", "Geometry")]
+    linearray = arcpy.da.FeatureClassToNumPyArray(inline, ['OID@'] + fields)
+    line_rows = dict(zip(linearray['OID@'].tolist(), range(len(linearray))))
+
+    pointarray = arcpy.da.FeatureClassToNumPyArray(inline, ['OID@', 'SHAPE@X', 'SHAPE@Y'], explode_to_points=True)
+    order, unique_line_ids, offsets = ragged_from_ids(pointarray['OID@'])
+    xy = np.column_stack((pointarray['SHAPE@X'][order], pointarray['SHAPE@Y'][order]))
+    if isinstance(tolerance, dict):
+        tolerance = np.array([tolerance[i] for i in unique_line_ids.tolist()], dtype=np.float64)
+    smoothed, new_offsets = smooth_lines(xy, offsets, tolerance)
+
+    linesmooth = arcpy.CreateFeatureclass_management(temp_workspace, "linesmooth","POLYLINE", inline,"","", spatialref)
+    with arcpy.da.InsertCursor(linesmooth, ['SHAPE@'] + fields) as cursor:
+        for i in range(len(unique_line_ids)):
+            row = linearray[line_rows[int(unique_line_ids[i])]]
+            cursor.insertRow([smoothed[new_offsets[i]:new_offsets[i+1]].tolist()] + [row[f] for f in fields])
     del cursor
-    if i>0:
-        del row
 
-    if sum(flip_list) > 0:
-        with arcpy.da.UpdateCursor(line,["Flip"]) as cursor:
-            i = 0
-            for row in cursor:
-                row[0] = flip_list[i]
-                cursor.updateRow(row)
-                i += 1 
-        del row, cursor
-
-        arcpy.MakeFeatureLayer_management(line, "lyrLines")
-        arcpy.SelectLayerByAttribute_management("lyrLines", "NEW_SELECTION", '"Flip" > 0')
-        arcpy.AddMessage("The number of fliped lines is: " + str(sum(flip_list)))
-        arcpy.FlipLine_edit("lyrLines")  ##Need to change to lyrLines
-        arcpy.SelectLayerByAttribute_management("lyrLines", "CLEAR_SELECTION")
-
-    arcpy.DeleteField_management (line, "Flip")
-    arcpy.Delete_management(line3d)
+    arcpy.CopyFeatures_management(linesmooth, outline)
+    return outline
 
-                    
 #------------------------------------------------------------------------------------------------------------
-# This fuction smooths the streamlines based on the size of the watershed (flow accumulation)
+# This fuction smooths the streamlines based on the size of the watershed (flow accumulation). The tolerance of
+# each line is derived from its flow accumulation and all lines are smoothed in one pass.
 #------------------------------------------------------------------------------------------------------------
 def lineSmooth(inline, outline, smoothfield, cellsize):
-    LineID = arcpy.Describe(inline).OIDFieldName
-    countResult = arcpy.GetCount_management(inline)
-    count = int(countResult.getOutput(0))
     cellarea = float(cellsize) * float(cellsize)
-    for i in range (count):
-        query = LineID +" = "+ str(i+1)  ##THe FID starts from 1 for the in_memory data; Which is different from shape (FID from 0) and feature class in the geodatabase (objectID from 1)
-        #arcpy.AddMessage(query)
-        arcpy.Select_analysis(inline, temp_workspace + "\\linesection", query)
-        #Determine the smooth tolerance
-        areacount = 0
-        with arcpy.da.SearchCursor(temp_workspace + "\\linesection", smoothfield) as cursor:
-            for row in cursor:
-                areacount = row[0]
-        del cursor, row
-
-        tolerance = int(areacount * cellarea * 2 / 1.0e6) + 200 ##The function provided by Kienholz et al. (2014) and  James & Carrivick (2016)
-        if tolerance > 1000:
-            tolerance = 1000
-        #arcpy.AddMessage(str(tolerance))
-        arcpy.cartography.SmoothLine(temp_workspace + "\\linesection", temp_workspace + "\\linesectsmooth", "PAEK", tolerance)
-
-        if i == 0: ##The first loop
-            arcpy.CopyFeatures_management(temp_workspace + "\\linesectsmooth", outline)
-        else:
-            arcpy.Append_management(temp_workspace + "\\linesectsmooth", outline, "NO_TEST")    
+    linearray = arcpy.da.FeatureClassToNumPyArray(inline, ['OID@', smoothfield])
+    tolerance = (linearray[smoothfield] * cellarea * 2 / 1.0e6).astype(np.int64) + 200 ##The function provided by Kienholz et al. (2014) and  James & Carrivick (2016)
+    tolerance = np.minimum(tolerance, 1000)
+    smooth_line_features(inline, outline, dict(zip(linearray['OID@'].tolist(), tolerance.tolist())))
     return outline
 
 #------------------------------------------------------------------------------------------------------------
-# This fuction smooths the streamlines based on the size of the watershed (flow accumulation)
+# This fuction converts a linear unit (i.e. "2 Kilometers"; "Unknown" or no unit is in the map units) to the
+# map units of the spatial reference
+#------------------------------------------------------------------------------------------------------------
+linear_unit_meters = {"meters": 1.0, "kilometers": 1000.0, "decimeters": 0.1, "centimeters": 0.01, "millimeters": 0.001,
+                      "feet": 0.3048, "internationalfeet": 0.3048, "ussurveyfeet": 1200.0 / 3937.0, "inches": 0.0254,
+                      "yards": 0.9144, "miles": 1609.344, "nauticalmiles": 1852.0}
+
+def linear_unit_to_map_units(linear_unit, spatialref):
+    parts = str(linear_unit).split()
+    value = float(parts[0])
+    unit = "".join(parts[1:]).lower()
+    if unit in ("", "unknown"):
+        return value
+    if unit not in linear_unit_meters:
+        raise Exception("The linear unit " + " ".join(parts[1:]) + " is not supported; use a distance in meters")
+    meters_per_unit = 1.0
+    if spatialref.type == "Projected":
+        meters_per_unit = spatialref.metersPerUnit
+    return value * linear_unit_meters[unit] / meters_per_unit
+
+#------------------------------------------------------------------------------------------------------------
+# This fuction smooths the streamlines with a fixed smooth distance (a linear unit, converted to the map units)
 #------------------------------------------------------------------------------------------------------------
 def lineSmoothFixDistance(inline, outline, smooth_dist):
-    arcpy.cartography.SmoothLine(inline, outline, "PAEK", smooth_dist)
+    tolerance = linear_unit_to_map_units(smooth_dist, arcpy.Describe(inline).spatialReference)
+    smooth_line_features(inline, outline, tolerance)
     return outline
 
 #------------------------------------------------------------------------------------------------------------
-# This fuction is the main program to derive streamlines from stream network.
+# This fuction delineates the watersheds of all valleys (or cross sections) in a single pass. All valleys are
+# rasterized into one zone raster, the highest flow accumulation cell of each valley is determined by one
+# labelled reduction over the zone raster, and one sweep of the NumPy watershed labeller derives the watershed
+# labels of all outlets.
+# The outlets can be nested along the same valley, so the function also derives the labels upstream of each
+# outlet based on the flow direction of the outlet cells. The full watershed of a valley is the union of the
+# watershed labels upstream of (and including) its own label.
 #------------------------------------------------------------------------------------------------------------
-def streamline_from_Stream_Network (InputDEM, InputValleyorCrossSection, StreamThresholdKM2, TributaryThresholdKM2, TributaryRatio, smooth_method, smooth_dis, StreamLine, outWatershed):
-
-    ValleyID = "ValleyID" ##Add a ValleyID for each moriane or cross section
-
-    cellsize = arcpy.GetRasterProperties_management(InputDEM,"CELLSIZEX")
-    cellsize_int = int(float(cellsize.getOutput(0)))
-    arcpy.env.snapRaster = InputDEM
-
-    StreamThreshold = int(float(StreamThresholdKM2) * 1e6 / (cellsize_int * cellsize_int))
-    TributaryThreshold = int(float(TributaryThresholdKM2) * 1e6 / (cellsize_int * cellsize_int))
+def batch_watersheds(InputValleyorCrossSection, fdir, facc, cellsize_int, bPolyline):
 
-    ###Step 1: Stream network
-    arcpy.AddMessage("Step 1: Stream extraction...")
- 
-    #Calculate Flowdirection
-    fillDEM =Fill(InputDEM)  ##Fill the sink first
-    fdir = FlowDirection(fillDEM,"NORMAL") ##Flow direction
+    valleycopy = temp_workspace + "\\valleycopy"
+    valleybuf = temp_workspace + "\\valleybuf"
+    valleyzones = temp_workspace + "\\valleyzones"
 
-    #Calculate Flowaccumulation
-    facc = FlowAccumulation(fdir) ##Flow accmulation
-
-    TmpStream = temp_workspace + "\\TmpStream"
-    valleyselected = temp_workspace + "\\valleyselected"  ##Set a in_memory file for each moraine feature
-    MaxFccTable = temp_workspace + "\\MaxFccTable"
-    CleanStream = temp_workspace + "\\CleanStream"
-    tmpoutStream = temp_workspace + "\\tmpoutStream"
-    smoothline = temp_workspace + "\\smoothline"
-    tmpws = temp_workspace + "\\tmpws"
-    tmpbuf = temp_workspace + "\\tmpbuf"
-    intersect_points = temp_workspace + "\\intersect_points"
+    ##Label the valleys from 1 to count in the same order as the valley loop
+    arcpy.CopyFeatures_management(InputValleyorCrossSection, valleycopy)
+    arcpy.AddField_management(valleycopy, "ValleyNo", "Long")
+    count = 0
+    with arcpy.da.UpdateCursor(valleycopy, ["ValleyNo"]) as cursor:
+        for row in cursor:
+            count += 1
+            row[0] = count
+            cursor.updateRow(row)
+    del cursor
 
-    outGreaterThan = Con(facc > StreamThreshold, 1,0)  ##Determine the highest flowaccumuation part
-    outStreamLink = StreamLink(outGreaterThan, fdir)
-    
-    # Process: Stream to Feature
-    StreamToFeature(outStreamLink, fdir, TmpStream, "SIMPLIFY")
+    ##Rasterize all valleys at once
+    if bPolyline:
+        ##make a small buffer of the cross section to make sure the cross section get the highest fcc
+        arcpy.Buffer_analysis(valleycopy, valleybuf, (str(cellsize_int)+ " Meter"))
+        arcpy.PolygonToRaster_conversion(valleybuf, "ValleyNo", valleyzones, "CELL_CENTER", "", cellsize_int)
+    else:
+        arcpy.PolygonToRaster_conversion(valleycopy, "ValleyNo", valleyzones, "CELL_CENTER", "", cellsize_int)
+
+    ##Read the zones and flow accumulation as arrays on the same grid
+    lower_left = arcpy.Point(facc.extent.XMin, facc.extent.YMin)
+    ncols = facc.width
+    nrows = facc.height
+    zoneArr = arcpy.RasterToNumPyArray(valleyzones, lower_left, ncols, nrows, 0).astype(label_dtype, copy=False)
+    faccArr = arcpy.RasterToNumPyArray(facc, lower_left, ncols, nrows, -1)
+
+    ##Find the maximum flow accumulation of each valley in one labelled reduction
+    labels = np.arange(1, count + 1)
+    maxfcc = np.array(ndimage.maximum(faccArr, zoneArr, labels))
+    maxfcc_lut = np.full(count + 1, np.inf)
+    valid = ~np.isnan(maxfcc)
+    maxfcc_lut[1:][valid] = maxfcc[valid]
+    pourArr = np.where((zoneArr > 0) & (faccArr == maxfcc_lut[zoneArr]), zoneArr, 0).astype(label_dtype, copy=False)
+    del zoneArr, faccArr
+
+    ##Label the watersheds of all pour points in one sweep
+    fdirArr = arcpy.RasterToNumPyArray(fdir, lower_left, ncols, nrows, 0).astype(fdir_dtype, copy=False)
+    wsArr = watershed_labels(fdirArr, pourArr)
+    outWs = arcpy.NumPyArrayToRaster(wsArr, lower_left, facc.meanCellWidth, facc.meanCellHeight, 0)
+
+    ##Determine the downstream label of each outlet
+    downstream = np.zeros(count + 1, dtype=label_dtype)
+    down = downstream_labels(fdirArr, pourArr, wsArr)
+    downstream[:len(down)] = down
+    ##Get the bounding box (rows and columns) of each watershed label
+    label_slices = ndimage.find_objects(wsArr, max_label=count)
+    del wsArr, fdirArr, pourArr
+
+    ##Collect the upstream labels of each valley
+    upstream = [[] for i in range(count + 1)]
+    for label in labels:
+        if valid[label - 1]:
+            upstream[label].append(int(label))
+    for label in labels:
+        if not valid[label - 1]:
+            continue
+        visited = set([label])
+        down_label = downstream[label]
+        while down_label > 0 and down_label not in visited: ##add this label to all downstream valleys
+            upstream[down_label].append(int(label))
+            visited.add(down_label)
+            down_label = downstream[down_label]
+
+    ##Derive the extent of the full watershed of each valley from the bounding boxes of its labels
+    cellsize_x = facc.meanCellWidth
+    cellsize_y = facc.meanCellHeight
+    windows = []
+    for label in labels:
+        slices = [label_slices[i - 1] for i in upstream[label] if label_slices[i - 1] is not None]
+        if len(slices) < 1:
+            windows.append(None)
+            continue
+        rmin = min([s[0].start for s in slices])
+        rmax = max([s[0].stop for s in slices])
+        cmin = min([s[1].start for s in slices])
+        cmax = max([s[1].stop for s in slices])
+        windows.append(arcpy.Extent(facc.extent.XMin + cmin * cellsize_x, facc.extent.YMax - rmax * cellsize_y,
+                                    facc.extent.XMin + cmax * cellsize_x, facc.extent.YMax - rmin * cellsize_y))
+
+    return outWs, upstream[1:], windows
 
-    FcID = arcpy.Describe(InputValleyorCrossSection).OIDFieldName
+#------------------------------------------------------------------------------------------------------------
+# This fuction returns the processing window of a valley, which is the extent of its watershed plus a halo
+# of cells, clipped by the extent of the DEM. Setting arcpy.env.extent to this window makes the per-valley
+# raster operations scale with the watershed area instead of the DEM area.
+#------------------------------------------------------------------------------------------------------------
+def valley_window(ws_extent, dem_extent, cellsize, halo_cells):
+    halo = float(cellsize) * halo_cells
+    xmin = max(ws_extent.XMin - halo, dem_extent.XMin)
+    ymin = max(ws_extent.YMin - halo, dem_extent.YMin)
+    xmax = min(ws_extent.XMax + halo, dem_extent.XMax)
+    ymax = min(ws_extent.YMax + halo, dem_extent.YMax)
+    return arcpy.Extent(xmin, ymin, xmax, ymax)
 
-    arr=arcpy.da.FeatureClassToNumPyArray(InputValleyorCrossSection, FcID)
-    FIds = np.array([item[0] for item in arr])
-    count = len(FIds)
+#------------------------------------------------------------------------------------------------------------
+# This fuction saves the cleaned watershed mask of a valley with its lower left corner and cell size to a .npz
+# file, so that the mask can be reused from the stage cache. Returns the path.
+#------------------------------------------------------------------------------------------------------------
+def save_watershed_mask(path, maskArr, lower_left, cellsize):
+    np.savez(path, mask = maskArr.astype(np.uint8), xmin = lower_left.X, ymin = lower_left.Y, cellsize = cellsize)
+    return path
 
-    if count < 1:
-        arcpy.AddMessage("There is no features in valleys or cross sections! Quit the program!")
-        sys.exit()
+#------------------------------------------------------------------------------------------------------------
+# This fuction loads a watershed mask saved by save_watershed_mask as an array with its lower left corner and
+# cell size
+#------------------------------------------------------------------------------------------------------------
+def load_watershed_mask_array(path):
+    data = np.load(path)
+    return data["mask"].astype(bool), arcpy.Point(float(data["xmin"]), float(data["ymin"])), float(data["cellsize"])
 
-    bPolyline = True
-    fc_type = arcpy.Describe(InputValleyorCrossSection).shapeType
-    if fc_type == "Polygon": ##quit if not polyline features
-        arcpy.AddMessage("Derive the streamlines within the polygons")
-        bPolyline = False
+#------------------------------------------------------------------------------------------------------------
+# This fuction loads a watershed mask saved by save_watershed_mask as a raster (1 for the watershed, NoData
+# outside)
+#------------------------------------------------------------------------------------------------------------
+def load_watershed_mask(path):
+    maskArr, lower_left, cellsize = load_watershed_mask_array(path)
+    return arcpy.NumPyArrayToRaster(maskArr.astype(np.uint8), lower_left, cellsize, cellsize, 0)
 
+#------------------------------------------------------------------------------------------------------------
+# This fuction converts the statistics of watershed_statistics at the index to the field values of the watershed
+# polygons: the area (km2), the minimum, maximum and mean elevation, the HI and the hypsometric curve as text
+#------------------------------------------------------------------------------------------------------------
+def watershed_statistics_row(stats, index):
+    values = [stats["area"][index] / 1e6, stats["min"][index], stats["max"][index], stats["mean"][index], stats["hi"][index]]
+    values = [float(v) if np.isfinite(v) else -999 for v in values] ##-999 for the flat watersheds
+    curve = ",".join(["%.3f" % v for v in stats["curve"][index]])
+    return values, curve
 
-    outstreamline = arcpy.CreateFeatureclass_management(temp_workspace, "outstreamline","POLYLINE","","","",InputValleyorCrossSection)
-    arcpy.AddField_management(outstreamline, "Max_Max", "Long") 
+#------------------------------------------------------------------------------------------------------------
+# This fuction derives the hypsometry and relief statistics of the watershed mask of a valley from the mask and
+# the filled DEM arrays in one pass with np.bincount (watershed_statistics in FlowRouting.py) instead of a
+# ZonalStatistics run per polygon
+#------------------------------------------------------------------------------------------------------------
+def mask_watershed_statistics(maskArr, lower_left, cellsize, fillDEM):
+    nrows, ncols = maskArr.shape
+    demArr = arcpy.RasterToNumPyArray(as_raster(fillDEM), lower_left, ncols, nrows, np.nan).astype(np.float64)
+    return watershed_statistics_row(watershed_statistics(maskArr.astype(label_dtype), demArr, 1, cellsize, HypsometryBins), 0)
 
-    for ivalley in range (count):
-        arcpy.AddMessage("Generating streamline(s) for valley #"+str(ivalley + 1)+" of "+str(count) + " valley(s)")
+#------------------------------------------------------------------------------------------------------------
+# This fuction adds the hypsometry and relief statistics (the field values and the hypsometric curve of
+# watershed_statistics_row) of a valley to its watershed polygons
+#------------------------------------------------------------------------------------------------------------
+def add_watershed_statistics(ws_fc, row):
+    values, curve = row
+
+    fields = ["AreaKM2", "MinElev", "MaxElev", "MeanElev", "HI"]
+    for field in fields:
+        arcpy.AddField_management(ws_fc, field, "DOUBLE")
+    arcpy.AddField_management(ws_fc, "Hypsometry", "TEXT", "", "", 254)
+    with arcpy.da.UpdateCursor(ws_fc, fields + ["Hypsometry"]) as cursor:
+        for row in cursor:
+            cursor.updateRow(values + [curve])
+    del cursor
 
-        query = FcID +" = "+str(FIds[ivalley])
-        arcpy.Select_analysis(InputValleyorCrossSection, valleyselected, query)
+#------------------------------------------------------------------------------------------------------------
+# This fuction smooths the dissolved streamlines of a valley with the smooth method and copies them to the output
+# feature class. Returns the output feature class ("" if there is no streamline).
+#------------------------------------------------------------------------------------------------------------
+def smooth_valley_streamlines(CleanStream, stream_fc, smooth_method, smooth_dis, cellsize_int):
+    smoothline = temp_workspace + "\\smoothline"
+    streamArr = arcpy.da.FeatureClassToNumPyArray(CleanStream, 'OID@')
+    if len(streamArr) < 1:
+        arcpy.AddMessage("No streamline is created for this feature. It seems that the threshold for a stream is too large!")
+        return ""
+    if "Varied" in smooth_method: 
+        newline = streamline_remove_bigturn(CleanStream, 120, cellsize_int)
+        lineSmooth(newline, smoothline, "Max_Max", cellsize_int)
+        arcpy.CopyFeatures_management(smoothline, stream_fc)
+    elif "Fixed" in smooth_method:
+        lineSmoothFixDistance (CleanStream, smoothline, smooth_dis)
+        arcpy.CopyFeatures_management(smoothline, stream_fc)
+    else: ##No smooth
+        arcpy.CopyFeatures_management(CleanStream, stream_fc)
+    return stream_fc
 
+#------------------------------------------------------------------------------------------------------------
+# This fuction derives the cleaned watershed mask of a valley from the batch watershed labels (within the
+# watershed window of the valley) or the watershed of the highest flow accumulation cell of the valley. Returns
+# the mask array with its lower left corner and cell size, or None if no watershed is derived.
+#------------------------------------------------------------------------------------------------------------
+def valley_watershed_mask(ivalley, settings, fdir, facc):
+    InputValleyorCrossSection = settings["valleys"]
+    FcID = settings["FcID"]
+    cellsize_int = settings["cellsize"]
+    bPolyline = settings["bPolyline"]
+    valleyselected = temp_workspace + "\\valleyselected"  ##Set a in_memory file for each moraine feature
+    tmpbuf = temp_workspace + "\\tmpbuf"
+    dem_extent = facc.extent
+
+    query = FcID +" = "+str(settings["FIds"][ivalley])
+    arcpy.Select_analysis(InputValleyorCrossSection, valleyselected, query)
+
+    if settings["BatchWatershed"]:
+        if len(settings["upstream_labels"][ivalley]) < 1:
+            arcpy.AddMessage("No watershed is derived for this feature. It seems that the feature is outside of the DEM!")
+            return None
+        window = settings["ws_windows"][ivalley]
+        if isinstance(window, tuple):
+            window = arcpy.Extent(*window)
+        ##Only process the cells within the watershed window of this valley
+        arcpy.env.extent = valley_window(window, dem_extent, cellsize_int, ValleyWindowHalo)
+        ##The watershed of this valley includes the watersheds of all nested outlets upstream
+        ConOutWs = Con(InList(as_raster(settings["outWsAll"]), settings["upstream_labels"][ivalley]) >= 0, 1)
+    else:
         if bPolyline:
             ##make a small buffer of the cross section to make sure the cross section get the highest fcc
             arcpy.Buffer_analysis(valleyselected, tmpbuf, (str(cellsize_int)+ " Meter"))
@@ -526,109 +645,186 @@ def streamline_from_Stream_Network (InputDEM, InputValleyorCrossSection, StreamT
         outSnapPour = SnapPourPoint(OutHighestFcc, facc, 0) ## Just create a pourpoint raster with the same extent of the input DEM
         
         #Calculate Watershed
-        outWs = Watershed(fdir, outSnapPour)
+        outWs = numpy_watershed(fdir, outSnapPour)
         ConOutWs = Con(outWs >= 0, 1)  
-        ##Boundary clean
-        OutBndCln = BoundaryClean(ConOutWs)
-
-        arcpy.RasterToPolygon_conversion(OutBndCln, tmpws, "NO_SIMPLIFY", "VALUE")
-
-        if bPolyline:
-            ##erase the moraines by watershed to see if there is some outside of the watershed
-            arcpy.Erase_analysis(valleyselected, tmpws, temp_workspace + "\\valley_outside")
-            outsideArr = arcpy.da.FeatureClassToNumPyArray( temp_workspace + "\\valley_outside", 'OID@')
-
-            if len(outsideArr) > 0:
-                ws_line = temp_workspace + "\\ws_line"
-                arcpy.PolygonToLine_management(tmpws, ws_line)
-                arcpy.Append_management(temp_workspace + "\\valley_outside", ws_line, "NO_TEST")                    
-                arcpy.FeatureToPolygon_management(ws_line, temp_workspace + "\\wsline_poly", "5 Meters", "NO_ATTRIBUTES")
-                arcpy.Dissolve_management(temp_workspace + "\\wsline_poly", tmpws, '#', '#', 'SINGLE_PART')
-            
-        ##delete potential small polygons
-        poly_areaArr = arcpy.da.FeatureClassToNumPyArray(tmpws, 'SHAPE@AREA')
-        poly_areas = np.array([item[0] for item in poly_areaArr])
-        max_area = np.max(poly_areas)
-        if len(poly_areas) > 1:
-            with arcpy.da.UpdateCursor(tmpws, 'SHAPE@AREA') as cursor:
-                for row in cursor:
-                    if int(row[0]) < (max_area - 0.5):
-                        cursor.deleteRow()     
-            del cursor, row				
-
-        #Get the watershed if required
-        if outWatershed !="":
-            if ivalley < 1: ##The first loop
-                arcpy.CopyFeatures_management(tmpws, outWatershed)
-            else:
-                arcpy.Append_management(tmpws, outWatershed, "NO_TEST")        
+    ##Boundary clean
+    OutBndCln = BoundaryClean(ConOutWs)
+
+    ##Clean the watershed on the raster: add the areas enclosed by the parts of the cross section outside of the
+    ##watershed and keep the largest connected part
+    lower_left = arcpy.Point(OutBndCln.extent.XMin, OutBndCln.extent.YMin)
+    nrows, ncols = OutBndCln.height, OutBndCln.width
+    wsArr = arcpy.RasterToNumPyArray(OutBndCln, lower_left, ncols, nrows, 0)
+    lineArr = None
+    if bPolyline:
+        arcpy.PolylineToRaster_conversion(valleyselected, FcID, temp_workspace + "\\valley_cells", "MAXIMUM_LENGTH", "NONE", OutBndCln.meanCellWidth)
+        lineArr = arcpy.RasterToNumPyArray(temp_workspace + "\\valley_cells", lower_left, ncols, nrows, 0)
+    maskArr = watershed_mask(wsArr, lineArr)
+    if not np.any(maskArr):
+        arcpy.AddMessage("No watershed is derived for this feature. It seems that the feature is outside of the DEM!")
+        return None
+    return maskArr, lower_left, OutBndCln.meanCellWidth
 
+#------------------------------------------------------------------------------------------------------------
+# This fuction derives the streamlines and the watershed of one valley. It only reads the shared rasters (the
+# flow direction, flow accumulation and the watershed labels of all valleys) and the settings of the run, and
+# copies its streamlines and watershed to the scratch workspace with the names of the valley number, so that
+# the valleys can be processed in any order or in worker processes. The streamlines are derived for each stream
+# threshold (one threshold, or the thresholds of the sweep mode) from the same watershed and flow accumulation.
+# If the stage cache is used (the numpy vectorizer), the valley starts from the latest stage output of an
+# earlier run with the same parameters (the raw stream network or the pruned streamlines, with the watershed),
+# and the new stage outputs are saved to the stage folder to be stored in the cache by the main process.
+# Returns the streamline feature classes of the thresholds and the watershed feature class ("" if not derived)
+# and the new stage outputs.
+#------------------------------------------------------------------------------------------------------------
+def process_valley(ivalley, settings, scratch):
+    InputValleyorCrossSection = settings["valleys"]
+    FcID = settings["FcID"]
+    cellsize_int = settings["cellsize"]
+    bPolyline = settings["bPolyline"]
+    StreamThresholds = settings["StreamThresholds"]
+    TributaryThreshold = settings["TributaryThreshold"]
+    TributaryRatio = settings["TributaryRatio"]
+    smooth_method = settings["smooth_method"]
+    smooth_dis = settings["smooth_dis"]
+    spatialref = arcpy.Describe(settings["InputDEM"]).spatialReference
+
+    ##Start from the full extent, because the extent is narrowed to the window of the previous valley (in this
+    ##process or in the same worker process)
+    full_extent = settings["full_extent"]
+    if isinstance(full_extent, tuple):
+        full_extent = arcpy.Extent(*full_extent)
+    arcpy.env.extent = full_extent
 
+    TmpStream = temp_workspace + "\\TmpStream"
+    CleanStream = temp_workspace + "\\CleanStream"
+    tmpoutStream = temp_workspace + "\\tmpoutStream"
+    ws_fc = ""
+
+    ##The cached stage outputs of this valley and the folder for the new stage outputs
+    cached = {}
+    stages = {}
+    use_stages = settings["stage_cache"] is not None and StreamVectorizer == "numpy"
+    if use_stages:
+        cached = settings["stage_cache"][ivalley]
+        stage_folder = os.path.join(settings["stage_folder"], "valley_" + str(ivalley))
+        if not os.path.isdir(stage_folder):
+            os.makedirs(stage_folder)
+
+    if cached.get("wsmask") and (cached.get("network") or cached.get("pruned")):
+        ##Only rerun the stages after the cached ones
+        if settings["outWatershed"]:
+            ws_fc = scratch + "\\ws_" + str(ivalley)
+            arcpy.RasterToPolygon_conversion(load_watershed_mask(cached["wsmask"]), ws_fc, "NO_SIMPLIFY", "VALUE")
+            if WatershedStatistics:
+                maskArr, lower_left, cs = load_watershed_mask_array(cached["wsmask"])
+                add_watershed_statistics(ws_fc, mask_watershed_statistics(maskArr, lower_left, cs, settings["fillDEM"]))
+        if cached.get("pruned"):
+            lines, xy, offsets = load_stream_arrays(cached["pruned"])
+        else:
+            links, xy, offsets = load_stream_arrays(cached["network"])
+            graph = prune_stream_graph(stream_graph(links, xy, offsets), TributaryThreshold, TributaryRatio)
+            lines, xy, offsets = dissolve_stream_graph(graph)
+            stages["pruned"] = save_stream_arrays(os.path.join(stage_folder, "pruned.npz"), lines, xy, offsets)
+        links_to_features(temp_workspace, "CleanStream", lines, xy, offsets, spatialref)
+        stream_fc = scratch + "\\stream_" + str(ivalley) + "_0"
+        return [smooth_valley_streamlines(CleanStream, stream_fc, smooth_method, smooth_dis, cellsize_int)], ws_fc, stages
+
+    fdir = as_raster(settings["fdir"])
+    facc = as_raster(settings["facc"])
+    dem_extent = facc.extent
+
+    if cached.get("wsmask"):
+        ##Reuse the cached watershed mask and only rerun the stream network stages
+        maskArr, lower_left, cs = load_watershed_mask_array(cached["wsmask"])
+    else:
+        watershed = valley_watershed_mask(ivalley, settings, fdir, facc)
+        if watershed is None:
+            return ["" for t in StreamThresholds], "", stages
+        maskArr, lower_left, cs = watershed
+        if use_stages:
+            stages["wsmask"] = save_watershed_mask(os.path.join(stage_folder, "wsmask.npz"), maskArr, lower_left, cs)
+    nrows = maskArr.shape[0]
+    wsMask = arcpy.NumPyArrayToRaster(maskArr.astype(np.uint8), lower_left, cs, cs, 0)
+
+    #Get the watershed if required
+    if settings["outWatershed"]:
+        ws_fc = scratch + "\\ws_" + str(ivalley)
+        arcpy.RasterToPolygon_conversion(wsMask, ws_fc, "NO_SIMPLIFY", "VALUE")
+        if WatershedStatistics:
+            add_watershed_statistics(ws_fc, mask_watershed_statistics(maskArr, lower_left, cs, settings["fillDEM"]))
+
+    ##Clip the processing extent to the watershed (including the parts of the cross section outside of it)
+    rows = np.flatnonzero(np.any(maskArr, axis = 1))
+    cols = np.flatnonzero(np.any(maskArr, axis = 0))
+    ymax = lower_left.Y + nrows * cs
+    ws_extent = arcpy.Extent(lower_left.X + cols[0] * cs, ymax - (rows[-1] + 1) * cs, lower_left.X + (cols[-1] + 1) * cs, ymax - rows[0] * cs)
+    arcpy.env.extent = valley_window(ws_extent, dem_extent, cellsize_int, ValleyWindowHalo)
+
+    ##The stream networks of all stream thresholds are derived from the same flow accumulation of the watershed
+    if StreamVectorizer == "numpy":
+        ##Only read the flow direction and flow accumulation of the box of the watershed, and set the flow
+        ##accumulation outside of the watershed to NoData in place (the mask of the box is a view of the watershed
+        ##mask), instead of extracting another raster by the mask
+        box_mask = maskArr[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        box_lower_left = arcpy.Point(ws_extent.XMin, ws_extent.YMin)
+        faccArr = arcpy.RasterToNumPyArray(facc, box_lower_left, box_mask.shape[1], box_mask.shape[0], -1)
+        fdirArr = arcpy.RasterToNumPyArray(fdir, box_lower_left, box_mask.shape[1], box_mask.shape[0], 0).astype(fdir_dtype, copy=False)
+        faccArr[~box_mask] = -1
+        if StreamTracing == "leastcost":
+            demArr = arcpy.RasterToNumPyArray(as_raster(settings["fillDEM"]), box_lower_left, box_mask.shape[1], box_mask.shape[0], np.nan)
+            graphs = least_cost_stream_graphs(demArr, fdirArr, faccArr, StreamThresholds, ws_extent.XMin, ws_extent.YMax, cs, LeastCostRadius, LeastCostHeightScale)
+            del demArr
+        else:
+            graphs = stream_graphs_from_arrays(fdirArr, faccArr, StreamThresholds, ws_extent.XMin, ws_extent.YMax, cs)
+        del faccArr, fdirArr
+    else:
         # Process: Extract by Mask
-        #try:
-        ExtraFcc = ExtractByMask(facc,tmpws)
-        
-        # Process: Greater Than
-        outGreaterThan = Con(ExtraFcc > StreamThreshold, 1,0)  ##Determine the highest flowaccumuation part
-        #need to check if outGreaterThan has the 1 values. If not, no stream will be created
-        MaxRasterValue = int((arcpy.GetRasterProperties_management(outGreaterThan, "MAXIMUM").getOutput(0)))
-        if MaxRasterValue > 0:
+        ExtraFcc = ExtractByMask(facc,wsMask)
+    stream_fcs = []
+    for k in range(len(StreamThresholds)):
+        StreamThreshold = StreamThresholds[k]
+        stream_fc = scratch + "\\stream_" + str(ivalley) + "_" + str(k)
+        if StreamVectorizer == "numpy":
+            ##Prune the tributaries, clean the extra lines and dissolve the links of the stream network graph in
+            ##memory, and only write the dissolved streamlines
+            graph = graphs[k]
+            if len(graph["links"]) < 1:
+                arcpy.AddMessage("No streamline is created for this feature. It seems that the threshold for a stream is too large!")
+                stream_fcs.append("")
+                continue
+            if use_stages:
+                stages["network"] = save_stream_arrays(os.path.join(stage_folder, "network.npz"), graph["links"], graph["xy"], graph["offsets"])
+            graph = prune_stream_graph(graph, TributaryThreshold, TributaryRatio)
+            lines, xy, offsets = dissolve_stream_graph(graph)
+            if use_stages:
+                stages["pruned"] = save_stream_arrays(os.path.join(stage_folder, "pruned.npz"), lines, xy, offsets)
+            links_to_features(temp_workspace, "CleanStream", lines, xy, offsets, spatialref)
+        else:
+            # Process: Greater Than
+            outGreaterThan = Con(ExtraFcc > StreamThreshold, 1,0)  ##Determine the highest flowaccumuation part
+            #need to check if outGreaterThan has the 1 values. If not, no stream will be created
+            MaxRasterValue = int((arcpy.GetRasterProperties_management(outGreaterThan, "MAXIMUM").getOutput(0)))
+            if MaxRasterValue < 1:
+                arcpy.AddMessage("No streamline is created for this feature. It seems that the threshold for a stream is too large!")
+                stream_fcs.append("")
+                continue
+
             # Process: Stream Link
             outStreamLink = StreamLink(outGreaterThan, fdir)
             
             # Process: Stream to Feature
             StreamToFeature(outStreamLink, fdir, TmpStream, "SIMPLIFY")
 
-            # Process: Zonal Statistics as Table
-            ZonalStatisticsAsTable(outStreamLink, "VALUE", ExtraFcc, MaxFccTable, "DATA", "MAXIMUM")
-
-            # Process: Join Field
-            arcpy.JoinField_management(TmpStream, "grid_code", MaxFccTable, "Value", "MAX")  ##Join to get the flow accumulation value
+            ##Get the maximum flow accumulation of each link from the arrays instead of a zonal table and join
+            join_link_max(TmpStream, outStreamLink, ExtraFcc)
             #arcpy.CopyFeatures_management(TmpStream, "c:\\test\\TmpStream02072023.shp")
             ###This TmpStream already have a to_node in the attibute table, so that it can be used to make the decision
             ##the following is the new to remove and unnecessary lines
             lineArray = arcpy.da.FeatureClassToNumPyArray(TmpStream,['OID@','to_node','MAX'])
-            tonode = np.array([item[1] for item in lineArray])
-            uniquenode = np.unique(tonode)
-            lineid = [] ##Record the id for deletion
-            #arcpy.AddMessage("Checking tributary threshold...")
-            for i in range(len(uniquenode)):
-                selArr = lineArray[tonode == uniquenode[i]]
-                fcclist = []
-                if len(selArr) > 1: ##Sometimes having more than two end points
-                    for j in range(len(selArr)):
-                        fcclist.append(selArr[j][2])
-
-                    numselected = len(fcclist)
-                    while numselected > 1:
-                        minfcc = min(fcclist)
-                        if minfcc < TributaryThreshold:
-                            for j in range(len(selArr)):
-                                if selArr[j][2] == minfcc: ##Remove the smaller fcc one
-                                    lineid.append(selArr[j][0])
-                                    fcclist.pop(j)
-                                    selArr = np.delete(selArr, j)##Remove this one and loop to delete others
-                                    numselected = len(selArr)
-                                    break ##Only remove one each time
-
-                        else: ##quit the loop if all minfcc are larger than the theshold?? Try to remove more based on the ratio
-                            break
-
-            for i in range(len(uniquenode)):
-                selArr = lineArray[tonode == uniquenode[i]]
-                fcclist = []
-                if len(selArr) > 1: ##Sometimes having more than two end points
-                    for j in range(len(selArr)):
-                        fcclist.append(selArr[j][2])
-
-                    sumfcc = sum(fcclist)
-                    fccratio = [x / float(sumfcc) for x in fcclist]
-
-                    for j in range(len(fccratio)):
-                        if fccratio[j] < float(TributaryRatio): ##Remove the smaller fcc one
-                            lineid.append(selArr[j][0])
-            
-            
+            ##Apply the tributary threshold and ratio rules to all junctions at once
+            lineid = set(prune_tributaries(lineArray['OID@'], lineArray['to_node'], lineArray['MAX'], TributaryThreshold, TributaryRatio).tolist())
+
             ##Delete the line marked for deletion
             with arcpy.da.UpdateCursor(TmpStream, "OID@") as cursor:
                 for row in cursor:
@@ -641,35 +837,293 @@ def streamline_from_Stream_Network (InputDEM, InputValleyorCrossSection, StreamT
 
             arcpy.Dissolve_management(tmpoutStream, CleanStream, '#', 'MAX MAX', 'SINGLE_PART', 'UNSPLIT_LINES')
 
-            streamArr = arcpy.da.FeatureClassToNumPyArray(CleanStream, 'OID@')
-            if len(streamArr) > 0:
-                if "Varied" in smooth_method: 
-                    newline = streamline_remove_bigturn(CleanStream, 120, cellsize_int)
-                    lineSmooth(newline, smoothline, "Max_Max", cellsize_int)
-                    arcpy.Append_management(smoothline, outstreamline, "NO_TEST")
-                elif "Fixed" in smooth_method:
-                    lineSmoothFixDistance (CleanStream, smoothline, smooth_dis)
-                    arcpy.Append_management(smoothline, outstreamline, "NO_TEST")
-                else: ##No smooth
-                    arcpy.Append_management(CleanStream, outstreamline, "NO_TEST")
-            else:
-                arcpy.AddMessage("No streamline is created for this feature. It seems that the threshold for a stream is too large!")
+        stream_fcs.append(smooth_valley_streamlines(CleanStream, stream_fc, smooth_method, smooth_dis, cellsize_int))
+
+    return stream_fcs, ws_fc, stages
+
+#------------------------------------------------------------------------------------------------------------
+# This fuction returns a raster object of a raster path (or the raster object itself)
+#------------------------------------------------------------------------------------------------------------
+def as_raster(raster):
+    if isinstance(raster, Raster):
+        return raster
+    return Raster(raster)
+
+#------------------------------------------------------------------------------------------------------------
+# This fuction returns the path of a raster that can be opened by the worker processes. The temporary rasters
+# (e.g. the in-memory outputs of the Spatial Analyst tools) are saved to the scratch folder once.
+#------------------------------------------------------------------------------------------------------------
+def shared_raster_path(raster, folder, name):
+    if not isinstance(raster, Raster):
+        return raster
+    path = raster.catalogPath
+    if raster.isTemporary or path.lower().startswith(("in_memory", "memory")):
+        path = os.path.join(folder, name + ".tif")
+        raster.save(path)
+    return path
+
+#------------------------------------------------------------------------------------------------------------
+# This fuction returns the path of a feature class that can be opened by the worker processes. The in-memory
+# feature classes and the layers (the selected features of a layer) are copied to a geodatabase in the scratch
+# folder once.
+#------------------------------------------------------------------------------------------------------------
+def shared_feature_path(features, folder, name):
+    desc = arcpy.Describe(features)
+    path = desc.catalogPath
+    if desc.dataType in ("FeatureLayer", "Layer") or path.lower().startswith(("in_memory", "memory")):
+        gdb = os.path.join(folder, "shared.gdb")
+        if not arcpy.Exists(gdb):
+            arcpy.CreateFileGDB_management(folder, "shared.gdb")
+        path = os.path.join(gdb, name)
+        arcpy.CopyFeatures_management(features, path)
+    return path
+
+#------------------------------------------------------------------------------------------------------------
+# The functions below run process_valley in a pool of worker processes. Each worker opens the shared rasters
+# read-only and writes the outputs of its valleys to its own scratch geodatabase, so that the workers never
+# write to the same workspace. The outputs are returned in the valley order and merged by the main process.
+#------------------------------------------------------------------------------------------------------------
+valley_settings = None
+valley_scratch = ""
+
+def init_valley_worker(settings, scratch_folder):
+    global valley_settings, valley_scratch
+    arcpy.env.overwriteOutput = True
+    arcpy.env.snapRaster = settings["InputDEM"]
+    gdb = "valley_" + str(os.getpid()) + ".gdb"
+    arcpy.CreateFileGDB_management(scratch_folder, gdb)
+    valley_settings = settings
+    valley_scratch = os.path.join(scratch_folder, gdb)
+
+def valley_worker(ivalley):
+    return process_valley(ivalley, valley_settings, valley_scratch)
+
+def process_valleys_in_pool(settings, count, workers, scratch_folder):
+    import multiprocessing
+
+    ##The worker processes can only open the rasters on disk
+    shared = dict(settings)
+    for name in ("fillDEM", "fdir", "facc", "outWsAll"):
+        if name in shared:
+            shared[name] = shared_raster_path(settings[name], scratch_folder, name)
+    if settings["BatchWatershed"]:
+        shared["ws_windows"] = [None if w is None else (w.XMin, w.YMin, w.XMax, w.YMax) for w in settings["ws_windows"]]
+    full_extent = settings["full_extent"]
+    if isinstance(full_extent, arcpy.Extent):
+        shared["full_extent"] = (full_extent.XMin, full_extent.YMin, full_extent.XMax, full_extent.YMax)
+    ##The valleys are copied in the same order, so the valley number is the same; the ids are the copied ones
+    shared["valleys"] = shared_feature_path(settings["valleys"], scratch_folder, "valleys")
+    if shared["valleys"] != settings["valleys"]:
+        shared["FcID"] = arcpy.Describe(shared["valleys"]).OIDFieldName
+        shared["FIds"] = [row[0] for row in arcpy.da.SearchCursor(shared["valleys"], "OID@")]
+
+    if sys.platform == "win32": ##Run the geoprocessing tools in the workers without the ArcGIS application
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+    pool = multiprocessing.Pool(min(workers, count), init_valley_worker, (shared, scratch_folder))
+    results = []
+    try:
+        ##imap returns the outputs in the valley order
+        for result in pool.imap(valley_worker, range(count)):
+            results.append(result)
+            arcpy.AddMessage("Generated streamline(s) for valley #"+str(len(results))+" of "+str(count) + " valley(s)")
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+#------------------------------------------------------------------------------------------------------------
+# This fuction merges the streamlines (of each stream threshold) and the watershed of one valley to the outputs
+#------------------------------------------------------------------------------------------------------------
+def merge_valley_outputs(stream_fcs, ws_fc, outstreamlines, outWatershed, nWatershed):
+    for stream_fc, outstreamline in zip(stream_fcs, outstreamlines):
+        if stream_fc != "":
+            arcpy.Append_management(stream_fc, outstreamline, "NO_TEST")
+            arcpy.Delete_management(stream_fc)
+    if ws_fc != "":
+        if nWatershed < 1: ##The first watershed
+            arcpy.CopyFeatures_management(ws_fc, outWatershed)
         else:
-            arcpy.AddMessage("No streamline is created for this feature. It seems that the threshold for a stream is too large!")
+            arcpy.Append_management(ws_fc, outWatershed, "NO_TEST")
+        arcpy.Delete_management(ws_fc)
+        nWatershed += 1
+    return nWatershed
+
+#------------------------------------------------------------------------------------------------------------
+# This fuction stores the new stage outputs of a valley in the stage cache
+#------------------------------------------------------------------------------------------------------------
+def store_valley_stages(stages, keys, fingerprint):
+    for name in stages:
+        stage_cache_store(os.path.join(StageCacheFolder, "stages"), keys[name], name, stages[name], fingerprint, int(float(StageCacheMaxGB) * 1e9))
 
-    if  bPolyline == False: ##if polygon as the input, clip the streamlines within the polygon
-        arcpy.Clip_analysis(outstreamline, InputValleyorCrossSection, temp_workspace + "\\streamline_clip")
-        arcpy.CopyFeatures_management(temp_workspace + "\\streamline_clip", outstreamline)        
+#------------------------------------------------------------------------------------------------------------
+# This fuction is the main program to derive streamlines from stream network.
+#------------------------------------------------------------------------------------------------------------
+def streamline_from_Stream_Network (InputDEM, InputValleyorCrossSection, StreamThresholdKM2, TributaryThresholdKM2, TributaryRatio, smooth_method, smooth_dis, StreamLine, outWatershed):
+
+    ValleyID = "ValleyID" ##Add a ValleyID for each moriane or cross section
+
+    cellsize = arcpy.GetRasterProperties_management(InputDEM,"CELLSIZEX")
+    cellsize_int = int(float(cellsize.getOutput(0)))
+    arcpy.env.snapRaster = InputDEM
+
+    ##The stream thresholds of the sweep mode (from low to high) or the single stream threshold
+    if len(StreamThresholdSweepKM2) > 0:
+        thresholdsKM2 = sorted([float(t) for t in StreamThresholdSweepKM2])
+        arcpy.AddMessage("Sweep the stream thresholds (km2): " + ", ".join([str(t) for t in thresholdsKM2]))
+    else:
+        thresholdsKM2 = [float(StreamThresholdKM2)]
+    StreamThresholds = [int(t * 1e6 / (cellsize_int * cellsize_int)) for t in thresholdsKM2]
+    TributaryThreshold = int(float(TributaryThresholdKM2) * 1e6 / (cellsize_int * cellsize_int))
+
+    ###Step 1: Stream network
+    arcpy.AddMessage("Step 1: Stream extraction...")
+    if StreamTracing == "leastcost" and StreamVectorizer != "numpy":
+        arcpy.AddMessage("The least-cost streamlines need the numpy vectorizer; trace the D8 stream cells instead")
+ 
+    #Calculate Flowdirection and Flowaccumulation (or read them from the flow cache, or the stage cache folder)
+    flow_cache_folder = FlowCacheFolder
+    if flow_cache_folder == "":
+        flow_cache_folder = StageCacheFolder
+    if FlowCacheInvalidate and flow_cache_folder != "":
+        nremoved = invalidate_flow_cache(flow_cache_folder, InputDEM)
+        if StageCacheFolder != "":
+            nremoved += invalidate_flow_cache(os.path.join(StageCacheFolder, "stages"), InputDEM)
+        arcpy.AddMessage("Remove " + str(nremoved) + " cache entries of the DEM")
+    bound_features = ""
+    if CoarseBoundingFactor > 1:
+        bound_features = InputValleyorCrossSection
+    fillDEM, fdir, facc = get_flow_products(InputDEM, flow_cache_folder, FlowCacheMaxGB, backend = RoutingBackend, tile_size = RoutingTileSize,
+                                            bound_features = bound_features, bound_factor = CoarseBoundingFactor, bound_buffer = CoarseBoundingBuffer)
+
+    FcID = arcpy.Describe(InputValleyorCrossSection).OIDFieldName
+
+    arr=arcpy.da.FeatureClassToNumPyArray(InputValleyorCrossSection, FcID)
+    FIds = np.array([item[0] for item in arr])
+    count = len(FIds)
 
-    ##make sure there are streamlines created
-    countResult = arcpy.GetCount_management(outstreamline)
-    count = int(countResult.getOutput(0))
     if count < 1:
-        arcpy.AddMessage("No streamlines are created for this set of moraine features!!")
+        arcpy.AddMessage("There is no features in valleys or cross sections! Quit the program!")
+        sys.exit()
+
+    bPolyline = True
+    fc_type = arcpy.Describe(InputValleyorCrossSection).shapeType
+    if fc_type == "Polygon": ##quit if not polyline features
+        arcpy.AddMessage("Derive the streamlines within the polygons")
+        bPolyline = False
+
+
+    outstreamlines = []
+    for k in range(len(thresholdsKM2)):
+        outstreamline = arcpy.CreateFeatureclass_management(temp_workspace, "outstreamline_" + str(k),"POLYLINE","","","",InputValleyorCrossSection)
+        arcpy.AddField_management(outstreamline, "Max_Max", "Long") 
+        outstreamlines.append(outstreamline)
+
+    ##Look up the stage outputs of each valley from the earlier runs. The watershed depends on the DEM and the
+    ##valleys, the raw stream network also on the stream threshold, and the pruned streamlines also on the
+    ##tributary threshold and ratio; the smoothing is always rerun.
+    stage_keys = None
+    stage_cache = None
+    stage_folder = ""
+    all_cached = False
+    if StageCacheFolder != "" and StreamVectorizer == "numpy" and len(thresholdsKM2) == 1:
+        stage_fingerprint = dem_fingerprint(InputDEM)
+        valley_fingerprints = feature_fingerprints(InputValleyorCrossSection)
+        params = [RoutingBackend, CoarseBoundingFactor, CoarseBoundingBuffer, BatchWatershed, ValleyWindowHalo, cellsize_int]
+        stage_keys = []
+        stage_cache = []
+        for ivalley in range(count):
+            ws_params = [valley_fingerprints[ivalley]] + params
+            network_params = ws_params + [thresholdsKM2[0], StreamTracing, LeastCostRadius, LeastCostHeightScale]
+            pruned_params = network_params + [TributaryThresholdKM2, TributaryRatio]
+            keys = {"wsmask": stage_cache_key("wsmask", stage_fingerprint, ws_params),
+                    "network": stage_cache_key("network", stage_fingerprint, network_params),
+                    "pruned": stage_cache_key("pruned", stage_fingerprint, pruned_params)}
+            cached = {}
+            for name in keys:
+                paths = cache_lookup(os.path.join(StageCacheFolder, "stages"), keys[name], (name,))
+                cached[name] = paths[name] if paths else None
+            stage_keys.append(keys)
+            stage_cache.append(cached)
+        ncached = len([c for c in stage_cache if c["wsmask"] and (c["network"] or c["pruned"])])
+        nws_cached = len([c for c in stage_cache if c["wsmask"]])
+        arcpy.AddMessage("Reuse the cached watersheds of " + str(nws_cached) + " and the cached stream networks of " + str(ncached) + " of " + str(count) + " valley(s)")
+        all_cached = (nws_cached == count)
+        stage_folder = tempfile.mkdtemp(prefix="stages_", dir=arcpy.env.scratchFolder)
+
+    ##The watersheds are not needed if the watersheds of all valleys are cached
+    bBatchWatershed = BatchWatershed and not all_cached
+    if bBatchWatershed:
+        arcpy.AddMessage("Delineating the watersheds of all valleys...")
+        outWsAll, upstream_labels, ws_windows = batch_watersheds(InputValleyorCrossSection, fdir, facc, cellsize_int, bPolyline)
+
+    full_extent = arcpy.env.extent
+    settings = {"valleys": InputValleyorCrossSection, "FcID": FcID, "FIds": FIds.tolist(), "InputDEM": InputDEM,
+                "fillDEM": fillDEM, "fdir": fdir, "facc": facc, "cellsize": cellsize_int, "bPolyline": bPolyline,
+                "StreamThresholds": StreamThresholds, "TributaryThreshold": TributaryThreshold, "TributaryRatio": TributaryRatio,
+                "smooth_method": smooth_method, "smooth_dis": str(smooth_dis), "outWatershed": outWatershed != "",
+                "BatchWatershed": bBatchWatershed, "stage_cache": stage_cache, "stage_folder": stage_folder,
+                "full_extent": full_extent}
+    if bBatchWatershed:
+        settings.update({"outWsAll": outWsAll, "upstream_labels": upstream_labels, "ws_windows": ws_windows})
+
+    nWatershed = 0
+    if ValleyWorkers > 1 and count > 1:
+        arcpy.AddMessage("Generating streamline(s) of " + str(count) + " valley(s) with " + str(min(ValleyWorkers, count)) + " worker processes")
+        scratch_folder = tempfile.mkdtemp(prefix="valleys_", dir=arcpy.env.scratchFolder)
+        results = process_valleys_in_pool(settings, count, ValleyWorkers, scratch_folder)
+        ##Merge the outputs in the valley order
+        for ivalley in range(count):
+            stream_fcs, ws_fc, stages = results[ivalley]
+            nWatershed = merge_valley_outputs(stream_fcs, ws_fc, outstreamlines, outWatershed, nWatershed)
+            if stage_keys is not None:
+                store_valley_stages(stages, stage_keys[ivalley], stage_fingerprint)
+        arcpy.ClearWorkspaceCache_management()
+        shutil.rmtree(scratch_folder, ignore_errors=True)
+    else:
+        for ivalley in range (count):
+            arcpy.AddMessage("Generating streamline(s) for valley #"+str(ivalley + 1)+" of "+str(count) + " valley(s)")
+            stream_fcs, ws_fc, stages = process_valley(ivalley, settings, temp_workspace)
+            nWatershed = merge_valley_outputs(stream_fcs, ws_fc, outstreamlines, outWatershed, nWatershed)
+            if stage_keys is not None:
+                store_valley_stages(stages, stage_keys[ivalley], stage_fingerprint)
+
+    if stage_folder != "":
+        shutil.rmtree(stage_folder, ignore_errors=True)
+
+    arcpy.env.extent = full_extent
+
+    sweep_lines = []
+    for k in range(len(thresholdsKM2)):
+        outstreamline = outstreamlines[k]
+        if  bPolyline == False: ##if polygon as the input, clip the streamlines within the polygon
+            arcpy.Clip_analysis(outstreamline, InputValleyorCrossSection, temp_workspace + "\\streamline_clip")
+            arcpy.CopyFeatures_management(temp_workspace + "\\streamline_clip", outstreamline)        
+
+        ##make sure there are streamlines created
+        countResult = arcpy.GetCount_management(outstreamline)
+        count = int(countResult.getOutput(0))
+        if count < 1:
+            arcpy.AddMessage("No streamlines are created for this set of moraine features with the stream threshold of " + str(thresholdsKM2[k]) + " km2!!")
+            continue
+        ##Merge streamline and add ValleyID
+        Check_If_Flip_Line_Direction (outstreamline, fillDEM) ##use fillDEM because the orginal DEM may have problems
+        if len(thresholdsKM2) == 1:
+            Merge_and_Add_ValleyID_by_Topology (outstreamline, "Max_Max", ValleyID, "MergeID", StreamLine)
+        else: ##Record the stream threshold of the streamlines
+            sweep_line = temp_workspace + "\\sweepline_" + str(k)
+            Merge_and_Add_ValleyID_by_Topology (outstreamline, "Max_Max", ValleyID, "MergeID", sweep_line)
+            arcpy.AddField_management(sweep_line, "ThresholdKM2", "DOUBLE")
+            with arcpy.da.UpdateCursor(sweep_line, ["ThresholdKM2"]) as cursor:
+                for row in cursor:
+                    row[0] = thresholdsKM2[k]
+                    cursor.updateRow(row)
+            del cursor
+            sweep_lines.append(sweep_line)
+
+    if len(thresholdsKM2) > 1 and len(sweep_lines) > 0: ##One output with the ThresholdKM2 field
+        arcpy.Merge_management(sweep_lines, StreamLine)
+    elif count < 1:
         sys.exit()
-    ##Merge streamline and add ValleyID
-    Check_If_Flip_Line_Direction (outstreamline, fillDEM) ##use fillDEM because the orginal DEM may have problems
-    Merge_and_Add_ValleyID_by_Topology (outstreamline, "Max_Max", ValleyID, "MergeID", StreamLine)
 
 ##Main program
 if __name__ == '__main__':
@@ -0,0 +1,345 @@
+#-------------------------------------------------------------------------------
+# Name: FlowCache.py
+#
+# Purpose:
+# This module provides a persistent on-disk cache for the flow routing products (filled DEM,
+# flow direction and flow accumulation) used by the streamline and cross section tools. Fill,
+# FlowDirection and FlowAccumulation are the most time-consuming steps for large DEMs and
+# they are repeated every time a tool is re-run with different parameters. The cache entries
+# are keyed by a fast fingerprint of the DEM (raster properties plus a few sampled blocks of
+# cell values) and the extent, mask and snap settings used to derive them. The total size of
+# the cache is bounded and the least recently used entries are removed first. Entries can be
+# invalidated for one DEM or for the whole cache folder.
+#
+# Author: Dr. Yingkui Li
+# Created:     11/07/2024-03/05/2025
+# Department of Geography, University of Tennessee
+# Knoxville, TN 37996
+#-------------------------------------------------------------------------------
+
+from __future__ import division
+import numpy as np
+import os, sys
+import json
+import time
+import shutil
+import hashlib
+
+cache_index_name = "flowcache_index.json"
+flow_product_names = ("fill", "fdir", "facc")
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives a fast fingerprint of a numpy array. Only the shape, the data type and a few
+# evenly-spaced blocks of cell values are hashed, so that it is fast even for very large DEMs.
+#------------------------------------------------------------------------------------------------------------
+def array_fingerprint(arr, sample_blocks = 4, block_size = 64):
+    arr = np.asarray(arr)
+    md5 = hashlib.md5()
+    md5.update(str(arr.shape).encode("utf-8"))
+    md5.update(str(arr.dtype).encode("utf-8"))
+    if arr.ndim == 2 and arr.size > 0:
+        nrows, ncols = arr.shape
+        rows = np.unique(np.linspace(0, max(nrows - block_size, 0), sample_blocks).astype(int))
+        cols = np.unique(np.linspace(0, max(ncols - block_size, 0), sample_blocks).astype(int))
+        for r in rows:
+            for c in cols:
+                md5.update(np.ascontiguousarray(arr[r:r+block_size, c:c+block_size]).tobytes())
+    else:
+        md5.update(np.ascontiguousarray(arr).tobytes())
+    return md5.hexdigest()
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives a fast fingerprint of a DEM raster based on the raster properties, the size and
+# modification time of the source file (if any) and a few sampled blocks of cell values.
+#------------------------------------------------------------------------------------------------------------
+def dem_fingerprint(dem, sample_blocks = 4, block_size = 64):
+    import arcpy
+
+    desc = arcpy.Describe(dem)
+    ext = desc.extent
+    cellsize = float(desc.meanCellWidth)
+    nrows = int(desc.height)
+    ncols = int(desc.width)
+
+    md5 = hashlib.md5()
+    props = [nrows, ncols, cellsize, ext.XMin, ext.YMin, ext.XMax, ext.YMax, desc.spatialReference.name]
+    md5.update(str(props).encode("utf-8"))
+
+    catalog_path = desc.catalogPath
+    if catalog_path and os.path.exists(catalog_path):
+        stat = os.stat(catalog_path)
+        md5.update(str([catalog_path, stat.st_size, stat.st_mtime]).encode("utf-8"))
+
+    ##Sample blocks of cell values evenly over the DEM
+    bsize = min(block_size, nrows, ncols)
+    rows = np.unique(np.linspace(0, nrows - bsize, sample_blocks).astype(int))
+    cols = np.unique(np.linspace(0, ncols - bsize, sample_blocks).astype(int))
+    for r in rows:
+        for c in cols:
+            ##RasterToNumPyArray uses the lower left corner of the block
+            lower_left = arcpy.Point(ext.XMin + c * cellsize, ext.YMax - (r + bsize) * cellsize)
+            block = arcpy.RasterToNumPyArray(dem, lower_left, bsize, bsize, -9999)
+            md5.update(np.ascontiguousarray(block).tobytes())
+
+    return md5.hexdigest()
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the fingerprint of the geometries of a feature class (i.e. a mask used to extract
+# the DEM before the flow analysis)
+#------------------------------------------------------------------------------------------------------------
+def feature_fingerprint(features):
+    import arcpy
+
+    md5 = hashlib.md5()
+    with arcpy.da.SearchCursor(features, ["SHAPE@WKT"]) as cursor:
+        for row in cursor:
+            md5.update(str(row[0]).encode("utf-8"))
+    del cursor
+    return md5.hexdigest()
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the fingerprint of the geometry of each feature (in the cursor order), so that the
+# outputs of a feature can be cached independently of the edits of the other features
+#------------------------------------------------------------------------------------------------------------
+def feature_fingerprints(features):
+    import arcpy
+
+    fingerprints = []
+    with arcpy.da.SearchCursor(features, ["SHAPE@WKT"]) as cursor:
+        for row in cursor:
+            fingerprints.append(hashlib.md5(str(row[0]).encode("utf-8")).hexdigest())
+    del cursor
+    return fingerprints
+
+#------------------------------------------------------------------------------------------------------------
+# This function creates the cache key from the DEM fingerprint and the extent, mask and snap settings
+#------------------------------------------------------------------------------------------------------------
+def flow_cache_key(fingerprint, extent = "", snap = "", mask = "", product = "flow"):
+    keystr = "|".join([product, str(fingerprint), str(extent), str(snap), str(mask)])
+    return hashlib.md5(keystr.encode("utf-8")).hexdigest()
+
+#------------------------------------------------------------------------------------------------------------
+# These functions read and write the cache index. The index records the fingerprint, size, creation and
+# last access time of each cache entry.
+#------------------------------------------------------------------------------------------------------------
+def load_cache_index(cache_folder):
+    index_file = os.path.join(cache_folder, cache_index_name)
+    if os.path.exists(index_file):
+        try:
+            with open(index_file, "r") as f:
+                return json.load(f)
+        except ValueError: ##corrupted index, start over
+            return {}
+    return {}
+
+def save_cache_index(cache_folder, index):
+    index_file = os.path.join(cache_folder, cache_index_name)
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f, indent = 1)
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    os.rename(tmp_file, index_file)
+
+def folder_size(folder):
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+#------------------------------------------------------------------------------------------------------------
+# This function looks up a cache entry. It returns a dictionary of the product names and the file paths if
+# all products are in the cache, otherwise it returns None. The last access time is updated for LRU eviction.
+#------------------------------------------------------------------------------------------------------------
+def cache_lookup(cache_folder, key, names = flow_product_names):
+    if cache_folder == "" or not os.path.isdir(cache_folder):
+        return None
+    index = load_cache_index(cache_folder)
+    if key not in index:
+        return None
+
+    entry_folder = os.path.join(cache_folder, key)
+    files = index[key]["files"]
+    paths = {}
+    for name in names:
+        if name not in files or not os.path.exists(os.path.join(entry_folder, files[name])):
+            ##The entry is broken; remove it
+            cache_invalidate(cache_folder, key)
+            return None
+        paths[name] = os.path.join(entry_folder, files[name])
+
+    index[key]["last_used"] = time.time()
+    save_cache_index(cache_folder, index)
+    return paths
+
+#------------------------------------------------------------------------------------------------------------
+# This function stores a new cache entry. The writer function is called with the entry folder and returns
+# a dictionary of the product names and the file names written into that folder. The entry is written into
+# a temporary folder first, so that an interrupted run does not leave a partial entry.
+#------------------------------------------------------------------------------------------------------------
+def cache_store(cache_folder, key, writer, fingerprint = "", max_bytes = 0):
+    if not os.path.isdir(cache_folder):
+        os.makedirs(cache_folder)
+
+    entry_folder = os.path.join(cache_folder, key)
+    tmp_folder = entry_folder + "_tmp"
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder, ignore_errors = True)
+    os.makedirs(tmp_folder)
+
+    files = writer(tmp_folder)
+
+    if os.path.exists(entry_folder):
+        shutil.rmtree(entry_folder, ignore_errors = True)
+    os.rename(tmp_folder, entry_folder)
+
+    index = load_cache_index(cache_folder)
+    now = time.time()
+    index[key] = {"fingerprint": fingerprint, "files": files, "size": folder_size(entry_folder), "created": now, "last_used": now}
+    save_cache_index(cache_folder, index)
+
+    if max_bytes > 0:
+        cache_evict(cache_folder, max_bytes, keep = key)
+
+    paths = {}
+    for name in files:
+        paths[name] = os.path.join(entry_folder, files[name])
+    return paths
+
+#------------------------------------------------------------------------------------------------------------
+# These functions cache the intermediate outputs of the stages of a tool (i.e. the watershed, raw stream
+# network and pruned streamlines of each valley), so that a re-run only recomputes the stages after the first
+# changed parameter. The key of a stage is derived from the DEM fingerprint and all parameters the stage
+# depends on. A stage output is one file with its sidecar files (the files with the same base name, i.e. the
+# .shx, .dbf and .prj files of a shapefile).
+#------------------------------------------------------------------------------------------------------------
+def stage_cache_key(stage, fingerprint, params):
+    return flow_cache_key(fingerprint, "|".join([str(p) for p in params]), product = "stage_" + stage)
+
+def stage_cache_store(cache_folder, key, name, path, fingerprint = "", max_bytes = 0):
+    folder, filename = os.path.split(path)
+    base = os.path.splitext(filename)[0]
+
+    def writer(entry_folder):
+        for f in os.listdir(folder):
+            if os.path.splitext(f)[0] == base:
+                shutil.copy(os.path.join(folder, f), entry_folder)
+        return {name: filename}
+
+    return cache_store(cache_folder, key, writer, fingerprint, max_bytes)[name]
+
+#------------------------------------------------------------------------------------------------------------
+# This function removes the least recently used entries until the total size of the cache is below max_bytes
+#------------------------------------------------------------------------------------------------------------
+def cache_evict(cache_folder, max_bytes, keep = ""):
+    index = load_cache_index(cache_folder)
+    total = sum([index[k]["size"] for k in index])
+    lru_keys = sorted(index.keys(), key=lambda k: index[k]["last_used"])
+    for k in lru_keys:
+        if total <= max_bytes:
+            break
+        if k == keep:
+            continue
+        total -= index[k]["size"]
+        shutil.rmtree(os.path.join(cache_folder, k), ignore_errors = True)
+        del index[k]
+    save_cache_index(cache_folder, index)
+
+#------------------------------------------------------------------------------------------------------------
+# This function invalidates cache entries. If key is specified, only this entry is removed; if fingerprint
+# is specified, all entries derived from the DEM with this fingerprint are removed; otherwise the whole
+# cache is cleared.
+#------------------------------------------------------------------------------------------------------------
+def cache_invalidate(cache_folder, key = "", fingerprint = ""):
+    if not os.path.isdir(cache_folder):
+        return 0
+    index = load_cache_index(cache_folder)
+    if key != "":
+        keys = [k for k in index if k == key]
+    elif fingerprint != "":
+        keys = [k for k in index if index[k]["fingerprint"] == fingerprint]
+    else:
+        keys = list(index.keys())
+
+    for k in keys:
+        shutil.rmtree(os.path.join(cache_folder, k), ignore_errors = True)
+        del index[k]
+    save_cache_index(cache_folder, index)
+    return len(keys)
+
+#------------------------------------------------------------------------------------------------------------
+# This function invalidates all cache entries of a DEM, so that the flow products are recalculated in the
+# next run (i.e. the DEM was edited in place and the fingerprint did not catch the change)
+#------------------------------------------------------------------------------------------------------------
+def invalidate_flow_cache(cache_folder, dem = ""):
+    if dem == "":
+        return cache_invalidate(cache_folder)
+    return cache_invalidate(cache_folder, fingerprint = dem_fingerprint(dem))
+
+#------------------------------------------------------------------------------------------------------------
+# This function returns the filled DEM, flow direction and flow accumulation rasters for a DEM. If the cache
+# folder is specified, the products are read from the cache or calculated and stored in the cache. The
+# source_dem and mask are used to derive the cache key when the DEM is an intermediate raster extracted
+# from the source DEM by the mask (i.e. extDEM in GenerateCrossSections.py). The backend is either "arcpy"
+# (Fill, FlowDirection and FlowAccumulation in ArcGIS) or "numpy" (the engine in FlowRouting.py). If the
+# bound features and factor are specified, the products are only derived within the catchment windows of the
+# features found on the DEM aggregated by the factor (the coarse-to-fine bounding of the NumPy engine).
+#------------------------------------------------------------------------------------------------------------
+def get_flow_products(dem, cache_folder = "", max_gb = 20, source_dem = "", mask = "", backend = "arcpy", tile_size = 0, bound_features = "", bound_factor = 0, bound_buffer = 2):
+    import arcpy
+    from arcpy.sa import Fill, FlowDirection, FlowAccumulation, Raster
+
+    bounded = bound_features != "" and int(bound_factor) > 1
+
+    def compute():
+        if bounded:
+            from FlowRouting import bounded_flow_products
+            if backend != "numpy":
+                arcpy.AddMessage("The coarse-to-fine bounding routes the DEM with the NumPy engine instead of the " + backend + " backend")
+            return bounded_flow_products(dem, bound_features, int(bound_factor), int(bound_buffer), tile_size if int(tile_size) > 0 else 1024)
+        if backend == "numpy":
+            from FlowRouting import numpy_flow_products
+            return numpy_flow_products(dem, tile_size)
+        fillDEM =Fill(dem)  ##Fill the sink first
+        fdir = FlowDirection(fillDEM,"NORMAL") ##Flow direction
+        facc = FlowAccumulation(fdir) ##Flow accmulation
+        return fillDEM, fdir, facc
+
+    if cache_folder == "":
+        return compute()
+
+    if source_dem == "":
+        source_dem = dem
+    fingerprint = dem_fingerprint(source_dem)
+    mask_str = ""
+    if mask != "":
+        mask_str = feature_fingerprint(mask)
+    ##The extent and cell alignment of the analyzed DEM represent the extent and snap settings
+    desc = arcpy.Describe(dem)
+    ext = desc.extent
+    extent_str = "%.3f %.3f %.3f %.3f" % (ext.XMin, ext.YMin, ext.XMax, ext.YMax)
+    snap_str = "%.6f %.6f" % (float(desc.meanCellWidth), float(desc.meanCellHeight))
+    product = "flow_" + backend
+    if bounded:
+        mask_str = mask_str + " " + feature_fingerprint(bound_features)
+        product = "flow_bounded_%d_%d" % (int(bound_factor), int(bound_buffer))
+    key = flow_cache_key(fingerprint, extent_str, snap_str, mask_str, product)
+
+    paths = cache_lookup(cache_folder, key)
+    if paths:
+        arcpy.AddMessage("Use the cached flow direction and flow accumulation in: " + cache_folder)
+        return Raster(paths["fill"]), Raster(paths["fdir"]), Raster(paths["facc"])
+
+    fillDEM, fdir, facc = compute()
+
+    def writer(folder):
+        files = {}
+        for name, raster in zip(flow_product_names, (fillDEM, fdir, facc)):
+            files[name] = name + ".tif"
+            raster.save(os.path.join(folder, files[name]))
+        return files
+
+    paths = cache_store(cache_folder, key, writer, fingerprint, int(float(max_gb) * 1e9))
+    return Raster(paths["fill"]), Raster(paths["fdir"]), Raster(paths["facc"])
+
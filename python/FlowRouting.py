@@ -0,0 +1,1442 @@
+#-------------------------------------------------------------------------------
+# Name: FlowRouting.py
+#
+# Purpose:
+# This module is an arcpy-free flow routing engine based on NumPy arrays. It includes
+# the priority-flood depression filling (Barnes et al., 2014), the D8 flow direction and
+# the topologically ordered flow accumulation. The flow direction uses the same D8 encoding
+# as ArcGIS (1: E, 2: SE, 4: S, 8: SW, 16: W, 32: NW, 64: N, 128: NE) and the flow accumulation
+# is the number (or the sum of weights) of the upstream cells, so that the outputs can replace
+# the Fill, FlowDirection and FlowAccumulation tools in ArcGIS and the rest of the tools can
+# run on either backend. The ArcGIS bridge functions import arcpy only when they are called.
+# For large DEMs, the routing can run tile by tile on arrays on disk (tiled_d8_routing), with
+# the peak memory bounded by the tile size and the same outputs as the routing of the whole DEM.
+# The watersheds of many pour points are labelled in one sweep over the donor (upstream) index.
+# If only a few valleys of a large DEM are studied, the routing can be bounded to the catchment
+# windows of the valleys found on a coarse (aggregated) DEM (bounded_d8_routing). The long profiles
+# of many source cells are traced down the flow direction at once (flow_path_profiles), and the
+# hypsometry of many watersheds is derived in one pass over the labels (watershed_statistics).
+#
+# Run this file directly to check the engine and report the run time on synthetic DEMs.
+#
+# Author: Dr. Yingkui Li
+# Created:     11/07/2024-03/05/2025
+# Department of Geography, University of Tennessee
+# Knoxville, TN 37996
+#-------------------------------------------------------------------------------
+
+from __future__ import division
+import numpy as np
+import math
+import os, sys
+import time
+import heapq
+from array import array
+from collections import deque
+from scipy import ndimage
+
+##ArcGIS D8 flow direction codes and the corresponding row/col offsets and distances
+d8_codes = np.array([1, 2, 4, 8, 16, 32, 64, 128], dtype=np.uint8)
+d8_drow = np.array([0, 1, 1, 1, 0, -1, -1, -1])
+d8_dcol = np.array([1, 1, 0, -1, -1, -1, 0, 1])
+d8_dist = np.array([1.0, math.sqrt(2), 1.0, math.sqrt(2), 1.0, math.sqrt(2), 1.0, math.sqrt(2)])
+
+##Lookup table from the D8 code to the index of the direction (-1 for invalid codes)
+d8_index = np.full(256, -1, dtype=np.int8)
+d8_index[d8_codes] = np.arange(8)
+
+##Compact dtypes of the routing outputs: the D8 codes in uint8, the watershed and link labels in int32, and the
+##flow accumulation (the number of upstream cells, -1 for NoData) in int32 (int64 for DEMs with 2^31 cells or
+##more) or float32 if weighted. Use these dtypes for the arrays read from the flow rasters.
+fdir_dtype = np.uint8
+label_dtype = np.int32
+weighted_facc_dtype = np.float32
+
+#------------------------------------------------------------------------------------------------------------
+# This function returns the dtype of the counts (flow accumulation) and indices of the cells of a DEM
+#------------------------------------------------------------------------------------------------------------
+def count_dtype(ncells):
+    if ncells < 2 ** 31:
+        return np.int32
+    return np.int64
+
+#------------------------------------------------------------------------------------------------------------
+# This function fills the depressions of a DEM with the priority-flood algorithm (Barnes et al., 2014). The
+# cells on the edge of the DEM (or next to NoData cells) are put into a priority queue and the DEM is flooded
+# inward from the lowest cell; the cells in depressions are raised to the spill elevation and processed with
+# a plain queue. The complexity is O(n log n).
+#------------------------------------------------------------------------------------------------------------
+def priority_flood_fill(dem, valid = None):
+    dem = np.asarray(dem, dtype=np.float64)
+    nrows, ncols = dem.shape
+    if valid is None:
+        valid = ~np.isnan(dem)
+
+    ##Pad the DEM by one cell, so that the neighbors of a cell are never outside of the array
+    W = ncols + 2
+    closed_pad = np.pad(~valid, 1, mode="constant", constant_values=True)
+    seeds_pad = ndimage.binary_dilation(closed_pad, structure=np.ones((3,3), dtype=bool)) & ~closed_pad
+    zpad = np.pad(np.where(valid, dem, 0.0), 1, mode="constant", constant_values=0.0)
+
+    ##Use compact python containers for the loop, which are much faster to index than numpy arrays
+    Z = array("d")
+    Z.frombytes(zpad.tobytes())
+    filled = array("d", Z)
+    closed = bytearray(closed_pad.astype(np.uint8).tobytes())
+
+    offsets = [int(d8_drow[k] * W + d8_dcol[k]) for k in range(8)]
+
+    seed_ids = np.flatnonzero(seeds_pad)
+    heap = list(zip(zpad.ravel()[seed_ids].tolist(), seed_ids.tolist()))
+    heapq.heapify(heap)
+    for c in seed_ids.tolist():
+        closed[c] = 1
+
+    pit = deque()
+    while heap or pit:
+        if pit:
+            c = pit.popleft()
+            zc = filled[c]
+        else:
+            zc, c = heapq.heappop(heap)
+        for off in offsets:
+            n = c + off
+            if closed[n]:
+                continue
+            closed[n] = 1
+            if Z[n] <= zc: ##in a depression or flat; raise to the spill elevation
+                filled[n] = zc
+                pit.append(n)
+            else:
+                heapq.heappush(heap, (Z[n], n))
+
+    filled = np.frombuffer(filled, dtype=np.float64).reshape(nrows + 2, ncols + 2)[1:-1, 1:-1].copy()
+    filled[~valid] = np.nan
+    return filled
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the steepest-descent D8 flow direction of the cells in a block of the filled DEM with
+# the ArcGIS encoding. The block has a halo of one cell on each side (NaN outside of the DEM), and row0/col0
+# are the row and column of the first interior cell in the whole DEM, so that a tile and the whole DEM get
+# the same directions. Each cell flows to the neighbor with the steepest drop (the diagonal distance is sqrt(2)
+# times of the cell size). Following the NORMAL option of the ArcGIS FlowDirection tool, a cell on the edge of
+# the DEM (or next to NoData) without a lower neighbor flows out of the DEM. Cells on flats are left as 0.
+#------------------------------------------------------------------------------------------------------------
+def steepest_descent_block(zb, row0 = 0, col0 = 0, shape = None):
+    nrows = zb.shape[0] - 2
+    ncols = zb.shape[1] - 2
+    if shape is None:
+        shape = (nrows, ncols)
+    center = zb[1:-1, 1:-1]
+    valid = ~np.isnan(center)
+
+    ##Derive the steepest drop to the valid neighbors
+    maxdrop = np.zeros((nrows, ncols))
+    fdir = np.zeros((nrows, ncols), dtype=np.uint8)
+    outward = np.zeros((nrows, ncols), dtype=np.uint8) ##direction to the first NoData (or outside) neighbor
+    for k in range(8):
+        dr = d8_drow[k]
+        dc = d8_dcol[k]
+        zn = zb[1+dr:1+dr+nrows, 1+dc:1+dc+ncols]
+        with np.errstate(invalid="ignore"):
+            drop = (center - zn) / d8_dist[k]
+        steeper = drop > maxdrop ##NaN drops are never steeper
+        maxdrop[steeper] = drop[steeper]
+        fdir[steeper] = d8_codes[k]
+        outside = np.isnan(zn) & (outward == 0)
+        outward[outside] = d8_codes[k]
+
+    ##Cells on the edge of the DEM flow outward from the DEM
+    rows = np.repeat((row0 + np.arange(nrows))[:, None], ncols, axis=1)
+    cols = np.repeat((col0 + np.arange(ncols))[None, :], nrows, axis=0)
+    edge_dir = np.zeros((nrows, ncols), dtype=np.uint8)
+    edge_dir[cols == shape[1] - 1] = 1
+    edge_dir[rows == shape[0] - 1] = 4
+    edge_dir[cols == 0] = 16
+    edge_dir[rows == 0] = 64
+    edge_dir[(rows == 0) & (cols == 0)] = 32
+    edge_dir[(rows == 0) & (cols == shape[1] - 1)] = 128
+    edge_dir[(rows == shape[0] - 1) & (cols == 0)] = 8
+    edge_dir[(rows == shape[0] - 1) & (cols == shape[1] - 1)] = 2
+    outward = np.where(edge_dir > 0, edge_dir, outward)
+
+    noflow = valid & (fdir == 0)
+    fdir[noflow] = outward[noflow]
+    fdir[~valid] = 0
+    return fdir
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the distance (number of cells) from each flat cell to the nearest cell that drains the
+# flat, moving only through cells with the same filled elevation. The inputs are blocks of the filled DEM (zb),
+# the flow direction from steepest_descent_block (fb, 0 on flats) and the current distances (db) with a halo of
+# one cell. The halo distances are used as sources, so that the distances can be passed between tiles. The
+# distances are derived with a bucket (Dial) breadth-first search in vectorized waves.
+#------------------------------------------------------------------------------------------------------------
+flat_inf = np.iinfo(np.int32).max
+
+def flat_distance_block(zb, fb, db):
+    H, W = zb.shape
+    N = H * W
+    z = zb.ravel()
+    valid = ~np.isnan(z)
+    interior = np.zeros((H, W), dtype=bool)
+    interior[1:-1, 1:-1] = True
+    target = (valid & (fb.ravel() == 0) & interior.ravel())
+    dist = db.ravel().astype(np.int64)
+    dist[valid & (fb.ravel() > 0)] = 0
+    dist[target] = flat_inf
+    dist[~valid] = flat_inf
+
+    ##Only the cells next to the flat cells can be the sources
+    near_target = ndimage.binary_dilation(target.reshape(H, W), structure=np.ones((3,3), dtype=bool)).ravel()
+    sources = np.flatnonzero(near_target & ~target & (dist < flat_inf))
+    buckets = {}
+    if sources.size > 0:
+        sdist = dist[sources]
+        order = np.argsort(sdist, kind="stable")
+        sources = sources[order]
+        sdist = sdist[order]
+        splits = np.flatnonzero(np.diff(sdist)) + 1
+        for group in np.split(sources, splits):
+            buckets[int(dist[group[0]])] = [group]
+
+    offsets = [int(d8_drow[k] * W + d8_dcol[k]) for k in range(8)]
+    while buckets:
+        d = min(buckets)
+        frontier = np.unique(np.concatenate(buckets.pop(d)))
+        frontier = frontier[dist[frontier] == d]
+        newcells = []
+        for off in offsets:
+            n = frontier + off
+            inside = (n >= 0) & (n < N)
+            f = frontier[inside]
+            n = n[inside]
+            ok = target[n] & (dist[n] > d + 1) & (z[n] == z[f])
+            n = n[ok]
+            dist[n] = d + 1
+            newcells.append(n)
+        newcells = np.concatenate(newcells)
+        if newcells.size > 0:
+            buckets.setdefault(d + 1, []).append(newcells)
+
+    return dist.reshape(H, W)[1:-1, 1:-1]
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the flow direction of the flat cells: each flat cell flows to the first neighbor (in the
+# order of the D8 codes) with the same filled elevation and one cell closer to the drainage of the flat. The
+# blocks have a halo of one cell and the distances of the cells that drain the flat are 0.
+#------------------------------------------------------------------------------------------------------------
+def flat_direction_block(zb, fb, db):
+    nrows = zb.shape[0] - 2
+    ncols = zb.shape[1] - 2
+    center = zb[1:-1, 1:-1]
+    dcenter = db[1:-1, 1:-1].astype(np.int64)
+    flats = ~np.isnan(center) & (fb[1:-1, 1:-1] == 0) & (dcenter < flat_inf)
+    codes = np.zeros((nrows, ncols), dtype=np.uint8)
+    for k in range(8):
+        dr = d8_drow[k]
+        dc = d8_dcol[k]
+        zn = zb[1+dr:1+dr+nrows, 1+dc:1+dc+ncols]
+        dn = db[1+dr:1+dr+nrows, 1+dc:1+dc+ncols].astype(np.int64)
+        ok = flats & (codes == 0) & (zn == center) & (dn == dcenter - 1)
+        codes[ok] = d8_codes[k]
+    return codes
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the D8 flow direction of a filled DEM with the ArcGIS encoding. The cells with a lower
+# neighbor flow to the steepest drop and the cells on flats flow toward the nearest cell that drains the flat
+# (the part of the flat routing in Garbrecht and Martz, 1997), which always leads to a lower cell or the edge
+# of the DEM. NoData cells are set to 0.
+#------------------------------------------------------------------------------------------------------------
+def d8_flow_direction(filled):
+    filled = np.asarray(filled, dtype=np.float64)
+    zb = np.pad(filled, 1, mode="constant", constant_values=np.nan)
+    fdir = steepest_descent_block(zb)
+    fb = np.pad(fdir, 1, mode="constant", constant_values=0)
+    db = np.full(zb.shape, flat_inf, dtype=np.int64)
+    db[1:-1, 1:-1] = flat_distance_block(zb, fb, db)
+    codes = flat_direction_block(zb, fb, db)
+    return np.where(codes > 0, codes, fdir)
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the flat index of the receiver (downstream) cell of each cell based on the D8 flow
+# direction. It is -1 if the cell flows out of the DEM or into a NoData cell, or the cell is NoData.
+#------------------------------------------------------------------------------------------------------------
+def flow_receivers(fdir):
+    nrows, ncols = fdir.shape
+    k = d8_index[fdir.ravel()]
+    ids = np.arange(nrows * ncols)
+    rows = ids // ncols + np.where(k >= 0, d8_drow[k], 0)
+    cols = ids % ncols + np.where(k >= 0, d8_dcol[k], 0)
+    inside = (k >= 0) & (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+    recv = np.full(nrows * ncols, -1, dtype=np.int64)
+    recv[inside] = rows[inside] * ncols + cols[inside]
+    ##Flow into a NoData cell is the same as flow out of the DEM
+    recv[inside] = np.where(fdir.ravel()[recv[inside]] > 0, recv[inside], -1)
+    return recv
+
+#------------------------------------------------------------------------------------------------------------
+# This function sorts the cells in the topological order of the flow network (upstream cells first) with
+# Kahn's algorithm. The cells are processed in waves: a wave includes all cells whose upstream cells are all
+# in the previous waves, so that each wave can be processed with one vectorized operation. It returns the
+# ordered cell ids and the start index of each wave in the order.
+#------------------------------------------------------------------------------------------------------------
+def topological_order(recv, valid):
+    n = len(recv)
+    has_recv = recv >= 0
+    indeg = np.bincount(recv[has_recv], minlength=n)
+    frontier = np.flatnonzero((indeg == 0) & valid)
+
+    order = []
+    wave_starts = []
+    total = 0
+    while frontier.size > 0:
+        order.append(frontier)
+        wave_starts.append(total)
+        total += frontier.size
+        rv = recv[frontier]
+        rv = rv[rv >= 0]
+        if rv.size < 1:
+            break
+        uniq, counts = np.unique(rv, return_counts=True)
+        indeg[uniq] -= counts
+        frontier = uniq[indeg[uniq] == 0]
+
+    if len(order) > 0:
+        order = np.concatenate(order)
+    else:
+        order = np.zeros(0, dtype=np.int64)
+    return order, np.array(wave_starts, dtype=np.int64)
+
+#------------------------------------------------------------------------------------------------------------
+# This function passes the weights downstream wave by wave in the topological order. The accumulation of a
+# cell includes the weight of the cell itself.
+#------------------------------------------------------------------------------------------------------------
+def accumulate_waves(recv, order, wave_starts, w):
+    acc = w.copy()
+    wave_ends = np.append(wave_starts[1:], len(order))
+    for start, end in zip(wave_starts, wave_ends):
+        cells = order[start:end]
+        rv = recv[cells]
+        has_recv = rv >= 0
+        uniq, inv = np.unique(rv[has_recv], return_inverse=True)
+        acc[uniq] += np.bincount(inv, weights=acc[cells[has_recv]], minlength=len(uniq)).astype(acc.dtype)
+    return acc
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the flow accumulation from the D8 flow direction. As in ArcGIS, the accumulation of a
+# cell is the number of upstream cells (or the sum of the weights of the upstream cells) excluding the cell
+# itself. The accumulation is passed downstream wave by wave in the topological order.
+#------------------------------------------------------------------------------------------------------------
+def flow_accumulation(fdir, weight = None):
+    nrows, ncols = fdir.shape
+    valid = fdir.ravel() > 0
+    recv = flow_receivers(fdir)
+    order, wave_starts = topological_order(recv, valid)
+
+    if weight is None:
+        w = valid.astype(count_dtype(nrows * ncols))
+    else:
+        w = np.where(valid, np.asarray(weight, dtype=weighted_facc_dtype).ravel(), 0).astype(weighted_facc_dtype)
+    acc = accumulate_waves(recv, order, wave_starts, w)
+
+    ##Exclude the cell itself and set the NoData cells in place
+    acc -= w
+    if weight is None:
+        acc[~valid] = -1
+    else:
+        acc[~valid] = np.nan
+    return acc.reshape(nrows, ncols)
+
+#------------------------------------------------------------------------------------------------------------
+# This function builds the donor (upstream) index of the flow network in the compressed sparse row format: the
+# donors of cell i are donors[starts[i]:starts[i+1]]. It is built once with one sort of the receivers.
+#------------------------------------------------------------------------------------------------------------
+def donor_index(recv):
+    has_recv = np.flatnonzero(recv >= 0)
+    donors = has_recv[np.argsort(recv[has_recv], kind="stable")]
+    starts = np.zeros(len(recv) + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(np.bincount(recv[has_recv], minlength=len(recv)))
+    return donors, starts
+
+#------------------------------------------------------------------------------------------------------------
+# This function gathers all donors of a set of cells from the donor index. It returns the donors and the
+# position of the cell (in cells) that each donor flows to.
+#------------------------------------------------------------------------------------------------------------
+def gather_donors(cells, donors, starts):
+    counts = starts[cells + 1] - starts[cells]
+    total = int(counts.sum())
+    parent = np.repeat(np.arange(len(cells)), counts)
+    first = np.repeat(starts[cells] - (np.cumsum(counts) - counts), counts)
+    return donors[first + np.arange(total)], parent
+
+#------------------------------------------------------------------------------------------------------------
+# This function labels the watersheds of many pour points at once, the same as the Watershed tool in ArcGIS.
+# The pour array has the label of each pour point cell (0 for other cells). Starting from all pour points, the
+# labels are passed upstream through the donor index in one breadth-first sweep. A pour point upstream of
+# another one keeps its own label and stops the label from downstream (nested outlets), so that each cell gets
+# the label of the first pour point downstream. The donor index can be reused for other sets of pour points.
+#------------------------------------------------------------------------------------------------------------
+def watershed_labels(fdir, pour, index = None):
+    nrows, ncols = fdir.shape
+    if index is None:
+        index = donor_index(flow_receivers(fdir))
+    donors, starts = index
+    pour = np.asarray(pour).ravel()
+    labels = np.where(fdir.ravel() > 0, pour, 0).astype(label_dtype)
+    frontier = np.flatnonzero(labels > 0)
+    while frontier.size > 0:
+        up, parent = gather_donors(frontier, donors, starts)
+        free = labels[up] == 0 ##the donors that are pour points keep their own labels
+        up = up[free]
+        labels[up] = labels[frontier[parent[free]]]
+        frontier = up
+    return labels.reshape(nrows, ncols)
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the label of the watershed downstream of each pour point label (0 if the pour point
+# flows out of the DEM or to an unlabelled cell), which links the nested watersheds.
+#------------------------------------------------------------------------------------------------------------
+def downstream_labels(fdir, pour, labels):
+    recv = flow_receivers(fdir)
+    pour = np.asarray(pour).ravel()
+    nlabels = int(pour.max()) if pour.size > 0 else 0
+    cells = np.flatnonzero((pour > 0) & (fdir.ravel() > 0))
+    rv = recv[cells]
+    down = np.where(rv >= 0, labels.ravel()[np.maximum(rv, 0)], 0)
+    down = np.where(down == pour[cells], 0, down)
+    downstream = np.zeros(nlabels + 1, dtype=label_dtype)
+    ##A label with several pour cells takes the first downstream label of another watershed
+    cells = cells[::-1]
+    down = down[::-1]
+    downstream[pour[cells][down > 0]] = down[down > 0]
+    return downstream
+
+#------------------------------------------------------------------------------------------------------------
+# This function runs the whole routing on a DEM array: fill, D8 flow direction and flow accumulation. NoData
+# cells are NaN in the DEM (or specified by nodata).
+#------------------------------------------------------------------------------------------------------------
+def d8_routing(dem, nodata = None, weight = None):
+    dem = np.asarray(dem, dtype=np.float64)
+    if nodata is not None:
+        dem = np.where(dem == nodata, np.nan, dem)
+    filled = priority_flood_fill(dem)
+    fdir = d8_flow_direction(filled)
+    facc = flow_accumulation(fdir, weight)
+    return filled, fdir, facc
+
+#------------------------------------------------------------------------------------------------------------
+# Tiled routing: The functions below run the same routing on a large DEM tile by tile, so that the peak memory
+# is bounded by the tile size. The DEM and the outputs are arrays on disk (np.memmap) and only one tile (with
+# a halo of one cell) is read at a time. The tiles are stitched with small boundary graphs, and the outputs
+# are identical to the outputs of d8_routing on the whole DEM.
+#------------------------------------------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------------------------------------
+# This function lists the tiles (start row, end row, start col, end col) of a DEM
+#------------------------------------------------------------------------------------------------------------
+def tile_windows(shape, tile_size):
+    nrows, ncols = shape
+    tiles = []
+    for r0 in range(0, nrows, tile_size):
+        for c0 in range(0, ncols, tile_size):
+            tiles.append((r0, min(r0 + tile_size, nrows), c0, min(c0 + tile_size, ncols)))
+    return tiles
+
+#------------------------------------------------------------------------------------------------------------
+# This function reads a block of an array with a halo of cells on each side. The halo cells outside of the
+# array are set to the fill value.
+#------------------------------------------------------------------------------------------------------------
+def read_block(arr, r0, r1, c0, c1, halo = 1, fill_value = np.nan, dtype = None):
+    nrows, ncols = arr.shape
+    if dtype is None:
+        dtype = arr.dtype
+    block = np.full((r1 - r0 + 2 * halo, c1 - c0 + 2 * halo), fill_value, dtype=dtype)
+    rr0 = max(r0 - halo, 0)
+    rr1 = min(r1 + halo, nrows)
+    cc0 = max(c0 - halo, 0)
+    cc1 = min(c1 + halo, ncols)
+    block[rr0 - r0 + halo:rr1 - r0 + halo, cc0 - c0 + halo:cc1 - c0 + halo] = arr[rr0:rr1, cc0:cc1]
+    return block
+
+#------------------------------------------------------------------------------------------------------------
+# This function reduces the spill edges between the labels (two label arrays and the spill elevations) to the
+# lowest spill elevation of each pair of labels with one lexsort of the pairs
+#------------------------------------------------------------------------------------------------------------
+def min_label_edges(u, v, spill):
+    a = np.minimum(u, v)
+    b = np.maximum(u, v)
+    if len(a) < 1:
+        return a, b, np.asarray(spill, dtype=np.float64)
+    order = np.lexsort((b, a))
+    a = a[order]
+    b = b[order]
+    starts = np.flatnonzero(np.concatenate(([True], (a[1:] != a[:-1]) | (b[1:] != b[:-1]))))
+    return a[starts], b[starts], np.minimum.reduceat(np.asarray(spill, dtype=np.float64)[order], starts)
+
+#------------------------------------------------------------------------------------------------------------
+# This function floods a tile with the priority-flood algorithm and labels the watersheds of the flood (the
+# parallel priority-flood of Barnes, 2016). The cells next to NoData or the edge of the DEM are the outlets of
+# the whole DEM (label 1). A cell on the edge of the tile joins the label of the lowest labelled neighbor it
+# drains to when it is popped, and only starts a new label if there is none, so that there is one label per
+# local basin instead of one per edge cell. It returns the local filled DEM, the labels, the next label, and the
+# lowest spill elevation between adjacent labels (min_label_edges).
+#------------------------------------------------------------------------------------------------------------
+def labelled_flood_block(zb, next_label):
+    H, W = zb.shape
+    nan_pad = np.isnan(zb)
+    interior = np.zeros((H, W), dtype=bool)
+    interior[1:-1, 1:-1] = True
+    valid = ~nan_pad & interior
+    outlets = valid & ndimage.binary_dilation(nan_pad, structure=np.ones((3,3), dtype=bool))
+    ring = valid & ~ndimage.binary_erosion(interior, structure=np.ones((3,3), dtype=bool))
+    seeds = outlets | ring
+
+    Z = array("d")
+    Z.frombytes(np.where(valid, zb, 0.0).tobytes())
+    filled = array("d", Z)
+    label = array("l", outlets.ravel().astype(np.int64).tolist()) ##label 1 for the outlets of the DEM
+    closed = bytearray((~valid | seeds).astype(np.uint8).tobytes())
+    offsets = [int(d8_drow[k] * W + d8_dcol[k]) for k in range(8)]
+    edge_u = array("l")
+    edge_v = array("l")
+    edge_spill = array("d")
+
+    seed_ids = np.flatnonzero(seeds)
+    heap = list(zip(np.asarray(zb).ravel()[seed_ids].tolist(), seed_ids.tolist()))
+    heapq.heapify(heap)
+
+    pit = deque()
+    while heap or pit:
+        if pit:
+            c = pit.popleft()
+            zc = filled[c]
+        else:
+            zc, c = heapq.heappop(heap)
+            if label[c] == 0:
+                ##Join the basin of the lowest labelled neighbor at or below the cell (the labelled cells reach the
+                ##first cell of their label without rising above their own level)
+                zlow = zc
+                for off in offsets:
+                    n = c + off
+                    if label[n] > 0 and filled[n] <= zlow:
+                        zlow = filled[n]
+                        label[c] = label[n]
+                if label[c] == 0:
+                    label[c] = next_label
+                    next_label += 1
+        lc = label[c]
+        for off in offsets:
+            n = c + off
+            if closed[n]:
+                ln = label[n]
+                if ln > 0 and ln != lc:
+                    ##Record the spill elevation between the two labels
+                    edge_u.append(lc)
+                    edge_v.append(ln)
+                    edge_spill.append(zc if zc > filled[n] else filled[n])
+                continue
+            closed[n] = 1
+            label[n] = lc
+            if Z[n] <= zc:
+                filled[n] = zc
+                pit.append(n)
+            else:
+                heapq.heappush(heap, (Z[n], n))
+
+    filled = np.frombuffer(filled, dtype=np.float64).reshape(H, W)[1:-1, 1:-1]
+    label = np.array(label, dtype=np.int64).reshape(H, W)[1:-1, 1:-1]
+    edges = min_label_edges(np.array(edge_u, dtype=np.int64), np.array(edge_v, dtype=np.int64), np.array(edge_spill))
+    return np.where(valid[1:-1, 1:-1], filled, np.nan), label, next_label, edges
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the spill elevations between the labels of adjacent cells across a tile boundary. The
+# two strips of cells on both sides are compared with the three neighbors on the other side.
+#------------------------------------------------------------------------------------------------------------
+def boundary_edges(fill_a, label_a, fill_b, label_b):
+    n = len(fill_a)
+    us, vs, spills = [], [], []
+    for shift in (-1, 0, 1):
+        ia = np.arange(max(0, -shift), min(n, n - shift))
+        ib = ia + shift
+        fa = fill_a[ia]
+        fb = fill_b[ib]
+        ok = ~np.isnan(fa) & ~np.isnan(fb) & (label_a[ia] != label_b[ib])
+        us.append(label_a[ia][ok].astype(np.int64))
+        vs.append(label_b[ib][ok].astype(np.int64))
+        spills.append(np.maximum(fa[ok], fb[ok]))
+    return min_label_edges(np.concatenate(us), np.concatenate(vs), np.concatenate(spills))
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the spill elevation of each label: the lowest elevation at which the water of the label
+# can reach the outlets of the DEM (label 1). It is a minimax Dijkstra search over the label graph (the edges of
+# min_label_edges).
+#------------------------------------------------------------------------------------------------------------
+def label_spill_elevation(edges, nlabels):
+    spill = np.full(nlabels, -np.inf)
+    u, v, weights = edges
+    if len(u) < 1:
+        return spill
+    src = np.concatenate((u, v))
+    dst = np.concatenate((v, u))
+    wts = np.concatenate((weights, weights))
+    order = np.argsort(src, kind="stable")
+    src = src[order]
+    dst = dst[order].tolist()
+    wts = wts[order].tolist()
+    starts = np.searchsorted(src, np.arange(nlabels + 1)).tolist()
+
+    done = bytearray(nlabels)
+    best = [np.inf] * nlabels
+    best[1] = -np.inf
+    heap = [(-np.inf, 1)]
+    while heap:
+        s, u = heapq.heappop(heap)
+        if done[u]:
+            continue
+        done[u] = 1
+        for i in range(starts[u], starts[u + 1]):
+            v = dst[i]
+            sv = s if s > wts[i] else wts[i]
+            if sv < best[v]:
+                best[v] = sv
+                heapq.heappush(heap, (sv, v))
+    best = np.array(best)
+    spill[np.isfinite(best)] = best[np.isfinite(best)]
+    return spill
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the local flow network of a tile from the flow direction with a halo of one cell. It
+# returns the receivers within the tile (-1 if the flow leaves the tile or the DEM) and the global id of the
+# receiver in another tile (-1 if none).
+#------------------------------------------------------------------------------------------------------------
+def tile_receivers(fb, r0, c0, ncols_total):
+    nr = fb.shape[0] - 2
+    nc = fb.shape[1] - 2
+    fdir = fb[1:-1, 1:-1].ravel()
+    k = d8_index[fdir]
+    ids = np.arange(nr * nc)
+    rows = ids // nc + np.where(k >= 0, d8_drow[k], 0)
+    cols = ids % nc + np.where(k >= 0, d8_dcol[k], 0)
+    recv_valid = (k >= 0) & (fb[rows + 1, cols + 1] > 0)
+    in_tile = (rows >= 0) & (rows < nr) & (cols >= 0) & (cols < nc)
+    recv = np.where(recv_valid & in_tile, rows * nc + cols, -1)
+    cross = np.where(recv_valid & ~in_tile, (r0 + rows) * ncols_total + (c0 + cols), -1)
+    return recv, cross
+
+#------------------------------------------------------------------------------------------------------------
+# This function runs the routing (fill, flow direction and flow accumulation) tile by tile on a large DEM. The
+# DEM can be an array or a memmap, and the outputs are saved as .npy files in the output folder and returned as
+# memmaps. The peak memory is bounded by the tile size and the size of the tile boundaries.
+#------------------------------------------------------------------------------------------------------------
+def tiled_d8_routing(dem, out_folder, tile_size = 1024, nodata = None):
+    nrows, ncols = dem.shape
+    tiles = tile_windows(dem.shape, tile_size)
+    filled = np.lib.format.open_memmap(os.path.join(out_folder, "fill.npy"), mode="w+", dtype=np.float64, shape=dem.shape)
+    fdir = np.lib.format.open_memmap(os.path.join(out_folder, "fdir.npy"), mode="w+", dtype=fdir_dtype, shape=dem.shape)
+    facc = np.lib.format.open_memmap(os.path.join(out_folder, "facc.npy"), mode="w+", dtype=count_dtype(dem.size), shape=dem.shape)
+    labels = np.lib.format.open_memmap(os.path.join(out_folder, "labels.npy"), mode="w+", dtype=count_dtype(dem.size), shape=dem.shape)
+    dist = np.lib.format.open_memmap(os.path.join(out_folder, "flatdist.npy"), mode="w+", dtype=np.int32, shape=dem.shape)
+
+    def dem_block(r0, r1, c0, c1):
+        zb = read_block(dem, r0, r1, c0, c1, 1, np.nan, np.float64)
+        if nodata is not None:
+            zb[zb == nodata] = np.nan
+        return zb
+
+    ##Step 1: flood each tile and label the watersheds of the flood
+    tile_edges = []
+    next_label = 2
+    for (r0, r1, c0, c1) in tiles:
+        zb = dem_block(r0, r1, c0, c1)
+        filled[r0:r1, c0:c1], labels[r0:r1, c0:c1], next_label, edges = labelled_flood_block(zb, next_label)
+        tile_edges.append(edges)
+
+    ##Step 2: stitch the labels across the tile boundaries and derive the spill elevation of each label
+    for c in range(tile_size, ncols, tile_size):
+        tile_edges.append(boundary_edges(filled[:, c-1], labels[:, c-1], filled[:, c], labels[:, c]))
+    for r in range(tile_size, nrows, tile_size):
+        tile_edges.append(boundary_edges(filled[r-1, :], labels[r-1, :], filled[r, :], labels[r, :]))
+    edges = min_label_edges(*[np.concatenate(part) for part in zip(*tile_edges)])
+    del tile_edges
+    spill = label_spill_elevation(edges, next_label)
+    for (r0, r1, c0, c1) in tiles:
+        filled[r0:r1, c0:c1] = np.maximum(filled[r0:r1, c0:c1], spill[labels[r0:r1, c0:c1]])
+
+    ##Step 3: derive the steepest-descent flow direction of each tile
+    flat_tiles = []
+    for i, (r0, r1, c0, c1) in enumerate(tiles):
+        zb = read_block(filled, r0, r1, c0, c1)
+        fd = steepest_descent_block(zb, r0, c0, dem.shape)
+        fdir[r0:r1, c0:c1] = fd
+        flats = ~np.isnan(zb[1:-1, 1:-1]) & (fd == 0)
+        dist[r0:r1, c0:c1] = np.where(flats | np.isnan(zb[1:-1, 1:-1]), flat_inf, 0)
+        if flats.any():
+            flat_tiles.append(i)
+
+    ##Step 4: derive the distances on the flats and pass them between the tiles until no change
+    tile_rows = (nrows + tile_size - 1) // tile_size
+    tile_cols = (ncols + tile_size - 1) // tile_size
+    dirty = set(flat_tiles)
+    while dirty:
+        i = min(dirty)
+        dirty.discard(i)
+        r0, r1, c0, c1 = tiles[i]
+        zb = read_block(filled, r0, r1, c0, c1)
+        fb = read_block(fdir, r0, r1, c0, c1, 1, 0)
+        db = read_block(dist, r0, r1, c0, c1, 1, flat_inf, np.int64)
+        newdist = flat_distance_block(zb, fb, db)
+        changed = newdist != db[1:-1, 1:-1]
+        if not changed.any():
+            continue
+        dist[r0:r1, c0:c1] = newdist
+        ##The tiles next to the changed edge cells need to be updated
+        ti = i // tile_cols
+        tj = i % tile_cols
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                ni = ti + di
+                nj = tj + dj
+                if (di == 0 and dj == 0) or ni < 0 or ni >= tile_rows or nj < 0 or nj >= tile_cols:
+                    continue
+                rows = slice(0, 1) if di < 0 else (slice(-1, None) if di > 0 else slice(None))
+                cols = slice(0, 1) if dj < 0 else (slice(-1, None) if dj > 0 else slice(None))
+                if changed[rows, cols].any() and (ni * tile_cols + nj) in flat_tiles:
+                    dirty.add(ni * tile_cols + nj)
+
+    ##Step 5: derive the flow direction of the flat cells
+    for i in flat_tiles:
+        r0, r1, c0, c1 = tiles[i]
+        zb = read_block(filled, r0, r1, c0, c1)
+        fb = read_block(fdir, r0, r1, c0, c1, 1, 0)
+        db = read_block(dist, r0, r1, c0, c1, 1, flat_inf, np.int64)
+        codes = flat_direction_block(zb, fb, db)
+        fdir[r0:r1, c0:c1] = np.where(codes > 0, codes, fdir[r0:r1, c0:c1])
+
+    ##Step 6: accumulate each tile locally and record the flow leaving the tile from the edge cells
+    ring_ids = []
+    ring_next = []
+    ring_weight = []
+    ring_cross = []
+    for (r0, r1, c0, c1) in tiles:
+        nr = r1 - r0
+        nc = c1 - c0
+        fb = read_block(fdir, r0, r1, c0, c1, 1, 0)
+        valid = fb[1:-1, 1:-1].ravel() > 0
+        recv, cross = tile_receivers(fb, r0, c0, ncols)
+        order, wave_starts = topological_order(recv, valid)
+        acc = accumulate_waves(recv, order, wave_starts, valid.astype(facc.dtype))
+        ids = np.arange(nr * nc)
+        gids = (r0 + ids // nc) * ncols + (c0 + ids % nc)
+        ##The exit of each cell is the last cell of its flow path in the tile
+        exit_id = np.where(cross >= 0, gids, -1)
+        wave_ends = np.append(wave_starts[1:], len(order))
+        for start, end in zip(wave_starts[::-1], wave_ends[::-1]):
+            cells = order[start:end]
+            rv = recv[cells]
+            has_recv = rv >= 0
+            exit_id[cells[has_recv]] = exit_id[rv[has_recv]]
+        edge_cells = np.zeros((nr, nc), dtype=bool)
+        edge_cells[[0, -1], :] = True
+        edge_cells[:, [0, -1]] = True
+        edge_cells = np.flatnonzero(edge_cells.ravel() & valid)
+        is_exit = cross[edge_cells] >= 0
+        ring_ids.append(gids[edge_cells])
+        ring_next.append(np.where(is_exit, cross[edge_cells], exit_id[edge_cells]))
+        ring_weight.append(np.where(is_exit, acc[edge_cells], 0))
+        ring_cross.append(is_exit)
+
+    ##Step 7: pass the flow between the tiles on the graph of the edge cells
+    ring_ids = np.concatenate(ring_ids)
+    ring_next = np.concatenate(ring_next)
+    ring_weight = np.concatenate(ring_weight).astype(np.int64)
+    ring_cross = np.concatenate(ring_cross)
+    order = np.argsort(ring_ids)
+    ring_ids = ring_ids[order]
+    ring_next = ring_next[order]
+    ring_weight = ring_weight[order]
+    ring_cross = ring_cross[order]
+    node_next = np.full(len(ring_ids), -1, dtype=np.int64)
+    has_next = ring_next >= 0
+    node_next[has_next] = np.searchsorted(ring_ids, ring_next[has_next])
+    node_order, node_waves = topological_order(node_next, np.ones(len(ring_ids), dtype=bool))
+    node_acc = accumulate_waves(node_next, node_order, node_waves, ring_weight)
+    ##The inflow of an edge cell from the other tiles
+    inflow_nodes = ring_cross & has_next
+    inflow = np.bincount(node_next[inflow_nodes], weights=node_acc[inflow_nodes], minlength=len(ring_ids)).astype(np.int64)
+
+    ##Step 8: accumulate each tile with the inflow from the other tiles
+    for (r0, r1, c0, c1) in tiles:
+        nr = r1 - r0
+        nc = c1 - c0
+        fb = read_block(fdir, r0, r1, c0, c1, 1, 0)
+        valid = fb[1:-1, 1:-1].ravel() > 0
+        recv, cross = tile_receivers(fb, r0, c0, ncols)
+        order, wave_starts = topological_order(recv, valid)
+        w = valid.astype(facc.dtype)
+        lo = np.searchsorted(ring_ids, r0 * ncols)
+        hi = np.searchsorted(ring_ids, (r1 - 1) * ncols + c1)
+        gids = ring_ids[lo:hi]
+        rows = gids // ncols - r0
+        cols = gids % ncols - c0
+        inside = (cols >= 0) & (cols < nc)
+        np.add.at(w, rows[inside] * nc + cols[inside], inflow[lo:hi][inside].astype(facc.dtype))
+        acc = accumulate_waves(recv, order, wave_starts, w)
+        facc[r0:r1, c0:c1] = np.where(valid, acc - 1, -1).reshape(nr, nc)
+
+    filled.flush()
+    fdir.flush()
+    facc.flush()
+    del labels, dist
+    for name in ("labels.npy", "flatdist.npy"):
+        os.remove(os.path.join(out_folder, name))
+    return filled, fdir, facc
+
+#------------------------------------------------------------------------------------------------------------
+# Coarse-to-fine bounding: The functions below only route the cells that can drain to the valleys. The DEM is
+# aggregated to a coarse level, the catchments of the valley cells are labelled on the coarse grid, and the
+# full-resolution routing runs only inside the (buffered) windows of the catchments. The windows of the valleys
+# with a catchment touching the edge of the windows at full resolution are expanded, and the routing is rerun.
+#------------------------------------------------------------------------------------------------------------
+
+#------------------------------------------------------------------------------------------------------------
+# This function aggregates a DEM to blocks of factor x factor cells with the minimum elevation of each block, so
+# that the valley floors (and the flow paths along them) are kept on the coarse grid. The blocks of NoData cells
+# are NaN.
+#------------------------------------------------------------------------------------------------------------
+def aggregate_dem(dem, factor):
+    nrows, ncols = dem.shape
+    padded = np.pad(np.asarray(dem, dtype=np.float64), ((0, -nrows % factor), (0, -ncols % factor)), constant_values=np.nan)
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    return np.fmin.reduce(blocks, axis=(1, 3))
+
+#------------------------------------------------------------------------------------------------------------
+# This function aggregates a label array to blocks of factor x factor cells with the maximum label of each block
+#------------------------------------------------------------------------------------------------------------
+def aggregate_labels(labels, factor):
+    nrows, ncols = labels.shape
+    padded = np.pad(labels, ((0, -nrows % factor), (0, -ncols % factor)), constant_values=0)
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    return blocks.max(axis=(1, 3))
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the full-resolution window (start row, end row, start col, end col) of each valley
+# label (1 to the maximum label) from its catchment on the coarse grid, including the catchments of the valleys
+# upstream and the cells of the valley itself, with a buffer of coarse cells. The window is None for a label
+# without any cell.
+#------------------------------------------------------------------------------------------------------------
+def coarse_catchment_windows(dem, valley_labels, factor = 8, buffer_cells = 2):
+    return coarse_windows(aggregate_dem(dem, factor), aggregate_labels(valley_labels, factor), dem.shape, factor, buffer_cells)
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the full-resolution windows of the valley labels from the coarse DEM (minimum of each
+# block) and the coarse labels (maximum of each block) of a DEM with the shape (rows, cols), so that the coarse
+# grids can also be aggregated outside of NumPy (coarse_catchment_windows)
+#------------------------------------------------------------------------------------------------------------
+def coarse_windows(coarse_dem, coarse_labels, shape, factor = 8, buffer_cells = 2):
+    nrows, ncols = shape
+    nlabels = int(coarse_labels.max()) if coarse_labels.size > 0 else 0
+    filled, fdir, facc = d8_routing(coarse_dem)
+    ws = watershed_labels(fdir, coarse_labels)
+    down = downstream_labels(fdir, coarse_labels, ws)
+    downstream = np.zeros(nlabels + 1, dtype=np.int64)
+    downstream[:len(down)] = down
+
+    ##The bounding boxes (full-resolution rows and columns) of the coarse catchments and the valley cells
+    boxes = np.full((nlabels + 1, 4), -1, dtype=np.int64)
+    for slices_list in (ndimage.find_objects(ws, max_label=nlabels), ndimage.find_objects(coarse_labels, max_label=nlabels)):
+        for label, s in enumerate(slices_list, 1):
+            if s is None:
+                continue
+            box = np.array([s[0].start * factor, s[0].stop * factor, s[1].start * factor, s[1].stop * factor])
+            if boxes[label, 0] < 0:
+                boxes[label] = box
+            else:
+                boxes[label] = [min(boxes[label, 0], box[0]), max(boxes[label, 1], box[1]), min(boxes[label, 2], box[2]), max(boxes[label, 3], box[3])]
+
+    ##Add the box of each valley to all valleys downstream
+    merged = boxes.copy()
+    for label in range(1, nlabels + 1):
+        if boxes[label, 0] < 0:
+            continue
+        visited = set([label])
+        down_label = downstream[label]
+        while down_label > 0 and down_label not in visited:
+            if merged[down_label, 0] >= 0:
+                merged[down_label] = [min(merged[down_label, 0], boxes[label, 0]), max(merged[down_label, 1], boxes[label, 1]),
+                                      min(merged[down_label, 2], boxes[label, 2]), max(merged[down_label, 3], boxes[label, 3])]
+            visited.add(down_label)
+            down_label = downstream[down_label]
+
+    buf = buffer_cells * factor
+    windows = [None]
+    for label in range(1, nlabels + 1):
+        r0, r1, c0, c1 = merged[label]
+        if r0 < 0:
+            windows.append(None)
+        else:
+            windows.append((max(r0 - buf, 0), min(r1 + buf, nrows), max(c0 - buf, 0), min(c1 + buf, ncols)))
+    return windows[1:]
+
+#------------------------------------------------------------------------------------------------------------
+# This function runs the routing of a DEM array only inside the union of the coarse catchment windows of the
+# valleys (a label array with 0 outside the valleys). The cells outside the windows are NoData, so that the
+# flow leaves the windows at their edges. If the catchment of a valley (all cells draining to the valley cells)
+# touches a cell outside the windows, the windows of the valley are expanded by the buffer (at least one coarse
+# cell) and the routing is rerun; after max_passes, the whole DEM (already in memory) is routed. Returns the
+# filled DEM, flow direction and flow accumulation of the bounding box of the windows, and the bounding box
+# (start row, end row, start col, end col).
+#------------------------------------------------------------------------------------------------------------
+def bounded_d8_routing(dem, valley_labels, factor = 8, buffer_cells = 2, max_passes = 4):
+    dem = np.asarray(dem, dtype=np.float64)
+    valley_labels = np.asarray(valley_labels).astype(label_dtype, copy=False)
+    windows = coarse_catchment_windows(dem, valley_labels, factor, buffer_cells)
+
+    def read_window(r0, r1, c0, c1):
+        return dem[r0:r1, c0:c1], valley_labels[r0:r1, c0:c1]
+
+    result = windowed_d8_routing(read_window, dem.shape, windows, factor, buffer_cells, max_passes)
+    if result is None:
+        filled, fdir, facc = d8_routing(dem)
+        return filled, fdir, facc, (0, dem.shape[0], 0, dem.shape[1])
+    return result
+
+#------------------------------------------------------------------------------------------------------------
+# This function runs the bounded routing of bounded_d8_routing on a DEM with the shape (rows, cols) that is only
+# read window by window: read_window(start row, end row, start col, end col) returns the DEM and the valley
+# labels of a window. Only the bounding box of the windows (with a margin of one cell) is read in each pass.
+# Returns None if there is no window or the windows do not contain the catchments after max_passes, so that the
+# caller can route the whole DEM in a bounded memory (e.g. tiled_d8_routing).
+#------------------------------------------------------------------------------------------------------------
+def windowed_d8_routing(read_window, shape, windows, factor = 8, buffer_cells = 2, max_passes = 4):
+    nrows, ncols = shape
+    windows = [list(w) for w in windows if w is not None]
+    grow = max(buffer_cells, 1) * factor
+    eight = np.ones((3, 3), dtype=bool)
+
+    for npass in range(max_passes):
+        if len(windows) < 1:
+            break
+        box = (int(min([w[0] for w in windows])), int(max([w[1] for w in windows])), int(min([w[2] for w in windows])), int(max([w[3] for w in windows])))
+        ##The margin of one cell around the box finds the valid cells next to the windows
+        e0, e1, f0, f1 = max(box[0] - 1, 0), min(box[1] + 1, nrows), max(box[2] - 1, 0), min(box[3] + 1, ncols)
+        dem, valley_labels = read_window(e0, e1, f0, f1)
+        dem = np.asarray(dem, dtype=np.float64)
+        inside = np.zeros(dem.shape, dtype=bool)
+        for (r0, r1, c0, c1) in windows:
+            inside[r0 - e0:r1 - e0, c0 - f0:c1 - f0] = True
+        sub = (slice(box[0] - e0, box[1] - e0), slice(box[2] - f0, box[3] - f0))
+        filled, fdir, facc = d8_routing(np.where(inside[sub], dem[sub], np.nan))
+
+        ##Check if the catchments of the valleys touch the valid cells outside the windows
+        outside = ndimage.binary_dilation(~np.isnan(dem) & ~inside, structure = eight)[sub]
+        ws = watershed_labels(fdir, np.where(inside[sub], valley_labels[sub], 0))
+        touching = (ws > 0) & outside
+        if not np.any(touching):
+            return filled, fdir, facc, box
+
+        ##Expand the windows containing the touching cells
+        rows, cols = np.nonzero(touching)
+        rows = rows + box[0]
+        cols = cols + box[2]
+        for w in windows:
+            hit = (rows >= w[0]) & (rows < w[1]) & (cols >= w[2]) & (cols < w[3])
+            if np.any(hit):
+                w[:] = [max(w[0] - grow, 0), min(w[1] + grow, nrows), max(w[2] - grow, 0), min(w[3] + grow, ncols)]
+    return None
+
+#------------------------------------------------------------------------------------------------------------
+# This function traces the long profiles from the source cells (flat indices) down the D8 flow direction. All
+# profiles are traced at once: each step moves all unfinished profiles to their receiver cells in one array
+# operation. A profile stops at its target cell (-1 for none) or at the outlet (the cell that flows out of the
+# DEM or into NoData). As the flow path may pass by the target cell, a profile with a target also stops at the
+# first cell at or below the elevation of the target (z is the filled DEM, so the elevation does not increase
+# down the flow path). The distance from the source adds one cell size for the cardinal steps and sqrt(2) cell
+# sizes for the diagonal steps. It returns the cells, distances and elevations of the profiles from the source
+# to the end, and the offsets of the profiles.
+#------------------------------------------------------------------------------------------------------------
+def flow_path_profiles(fdir, z, sources, cellsize = 1.0, targets = None):
+    recv = flow_receivers(fdir)
+    k = d8_index[fdir.ravel()]
+    step = np.where(k >= 0, d8_dist[k] * cellsize, 0.0)
+    sources = np.asarray(sources, dtype=np.int64)
+    nprofiles = len(sources)
+    if targets is None:
+        targets = np.full(nprofiles, -1, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    z = np.asarray(z).ravel()
+    ztarget = np.where(targets >= 0, z[np.maximum(targets, 0)], -np.inf)
+
+    prof = np.arange(nprofiles)
+    cur = sources
+    dist = np.zeros(nprofiles)
+    steps = [(prof, cur, dist)]
+    while prof.size > 0:
+        nxt = recv[cur]
+        going = (nxt >= 0) & (cur != targets[prof]) & ~(z[cur] <= ztarget[prof])
+        dist = dist[going] + step[cur[going]]
+        prof = prof[going]
+        cur = nxt[going]
+        steps.append((prof, cur, dist))
+
+    ##The steps are in order, so a stable sort by profile keeps the cells of each profile from the source down
+    prof = np.concatenate([s[0] for s in steps])
+    order = np.argsort(prof, kind="stable")
+    cells = np.concatenate([s[1] for s in steps])[order]
+    dist = np.concatenate([s[2] for s in steps])[order]
+    offsets = np.zeros(nprofiles + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(prof, minlength=nprofiles))
+    return cells, dist, z[cells], offsets
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the hypsometry and relief statistics of all watersheds of a label array in one pass
+# with np.bincount: the number of cells, area, minimum, maximum and mean elevation, the hypsometric integral
+# ((mean - min) / (max - min), Pike and Wilson, 1971) and the binned hypsometric curve, i.e. the fraction of
+# the area above the relative heights of 0, 1/bins, ..., (bins - 1)/bins. The labels are 1 to nlabels (0 for
+# the cells outside of the watersheds), and the statistics of a label without valid cells are NaN.
+#------------------------------------------------------------------------------------------------------------
+def watershed_statistics(labels, dem, nlabels = None, cellsize = 1.0, bins = 10):
+    labels = np.asarray(labels).ravel()
+    z = np.asarray(dem, dtype=np.float64).ravel()
+    valid = (labels > 0) & np.isfinite(z)
+    lab = labels[valid].astype(np.int64)
+    z = z[valid]
+    if nlabels is None:
+        nlabels = int(lab.max()) if lab.size > 0 else 0
+
+    count = np.bincount(lab, minlength=nlabels + 1)[1:nlabels + 1]
+    zsum = np.bincount(lab, weights=z, minlength=nlabels + 1)[1:nlabels + 1]
+    ##The minimum and maximum elevations are the first and last elevations of each label in the sorted order
+    order = np.lexsort((z, lab))
+    ends = np.cumsum(count)
+    has = count > 0
+    zmin = np.full(nlabels, np.nan)
+    zmax = np.full(nlabels, np.nan)
+    zmin[has] = z[order[ends[has] - count[has]]]
+    zmax[has] = z[order[ends[has] - 1]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zmean = zsum / count
+        relief = zmax - zmin
+        hi = (zmean - zmin) / relief
+        h = (z - zmin[lab - 1]) / relief[lab - 1]
+
+    ##Bin the relative height of each cell (0 for the flat watersheds) and accumulate the bins from the top
+    h = np.where(np.isfinite(h), h, 0.0)
+    b = np.minimum((h * bins).astype(np.int64), bins - 1)
+    hist = np.bincount((lab - 1) * bins + b, minlength=nlabels * bins).reshape(nlabels, bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        curve = np.cumsum(hist[:, ::-1], axis=1)[:, ::-1] / count[:, None]
+    return {"count": count, "area": count * float(cellsize) ** 2, "min": zmin, "max": zmax, "mean": zmean,
+            "hi": hi, "curve": curve}
+
+#------------------------------------------------------------------------------------------------------------
+# This function cleans the watershed mask of a valley on the raster. The cells of the valley line (the cross
+# section) can be given: the areas enclosed by the watershed and the parts of the line outside of it are added
+# with the line cells around them, while the dangling parts of the line are not. Only the largest connected part
+# of the watershed is kept. Returns a boolean mask.
+#------------------------------------------------------------------------------------------------------------
+def watershed_mask(ws, line = None):
+    mask = np.asarray(ws) > 0
+    if line is not None:
+        line = np.asarray(line) > 0
+        if np.any(line & ~mask):
+            ##The areas enclosed by the watershed and the cross section
+            enclosed = ndimage.binary_fill_holes(mask | line) & ~(mask | line)
+            around = ndimage.binary_dilation(enclosed, structure = np.ones((3, 3), dtype=bool))
+            mask = mask | enclosed | (line & around)
+
+    ##Keep the largest connected part
+    labels, nlabels = ndimage.label(mask)
+    if nlabels > 1:
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        mask = labels == np.argmax(sizes)
+    return mask
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function reads a raster into a float64 array with NaN for NoData cells. It also returns
+# the lower left corner and the cell size, which are needed to write the arrays back to rasters.
+#------------------------------------------------------------------------------------------------------------
+def raster_to_array(raster):
+    import arcpy
+
+    ras = arcpy.Raster(raster) if isinstance(raster, str) else raster
+    lower_left = arcpy.Point(ras.extent.XMin, ras.extent.YMin)
+    arr = arcpy.RasterToNumPyArray(ras, lower_left, ras.width, ras.height, np.nan).astype(np.float64)
+    return arr, lower_left, ras.meanCellWidth
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function writes an array to a raster with the lower left corner and the cell size
+#------------------------------------------------------------------------------------------------------------
+def array_to_raster(arr, lower_left, cellsize, nodata = None):
+    import arcpy
+
+    if nodata is None:
+        return arcpy.NumPyArrayToRaster(arr, lower_left, cellsize, cellsize)
+    return arcpy.NumPyArrayToRaster(arr, lower_left, cellsize, cellsize, nodata)
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function derives the filled DEM, flow direction and flow accumulation rasters of a DEM
+# with the NumPy engine. The outputs can be used in the same way as the outputs of Fill, FlowDirection and
+# FlowAccumulation.
+#------------------------------------------------------------------------------------------------------------
+def numpy_flow_products(dem, tile_size = 0):
+    if tile_size > 0:
+        return tiled_flow_products(dem, tile_size)
+    demArr, lower_left, cellsize = raster_to_array(dem)
+    filled, fdir, facc = d8_routing(demArr)
+    fillDEM = array_to_raster(filled, lower_left, cellsize)
+    fdirRaster = array_to_raster(fdir, lower_left, cellsize, 0)
+    faccRaster = array_to_raster(facc, lower_left, cellsize, -1)
+    return fillDEM, fdirRaster, faccRaster
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function derives the watersheds of the pour points with the NumPy labeller. The pour
+# raster is read on the grid of the flow direction raster, and the output can be used in the same way as the
+# output of the Watershed tool.
+#------------------------------------------------------------------------------------------------------------
+def numpy_watershed(fdir, pour):
+    import arcpy
+
+    fdir = arcpy.Raster(fdir) if isinstance(fdir, str) else fdir
+    lower_left = arcpy.Point(fdir.extent.XMin, fdir.extent.YMin)
+    fdirArr = arcpy.RasterToNumPyArray(fdir, lower_left, fdir.width, fdir.height, 0).astype(fdir_dtype, copy=False)
+    pourArr = arcpy.RasterToNumPyArray(pour, lower_left, fdir.width, fdir.height, 0).astype(label_dtype, copy=False)
+    labels = watershed_labels(fdirArr, pourArr)
+    return array_to_raster(labels, lower_left, fdir.meanCellWidth, 0)
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function runs the tiled routing on a large DEM raster. The DEM is copied block by block to
+# a memmap in the scratch folder, and the outputs are written to rasters tile by tile and mosaicked, so that the
+# whole DEM is never loaded into the memory.
+#------------------------------------------------------------------------------------------------------------
+def tiled_flow_products(dem, tile_size = 1024):
+    import arcpy
+    import tempfile
+
+    ras = arcpy.Raster(dem) if isinstance(dem, str) else dem
+    nrows = ras.height
+    ncols = ras.width
+    cellsize = ras.meanCellWidth
+    xmin = ras.extent.XMin
+    ymax = ras.extent.YMax
+    work_folder = tempfile.mkdtemp(dir=arcpy.env.scratchFolder)
+
+    demArr = np.lib.format.open_memmap(os.path.join(work_folder, "dem.npy"), mode="w+", dtype=np.float64, shape=(nrows, ncols))
+    for (r0, r1, c0, c1) in tile_windows((nrows, ncols), tile_size):
+        lower_left = arcpy.Point(xmin + c0 * cellsize, ymax - r1 * cellsize)
+        demArr[r0:r1, c0:c1] = arcpy.RasterToNumPyArray(ras, lower_left, c1 - c0, r1 - r0, np.nan)
+
+    filled, fdir, facc = tiled_d8_routing(demArr, work_folder, tile_size)
+
+    outputs = []
+    facc_pixel_type = "32_BIT_SIGNED" if facc.dtype == np.int32 else "32_BIT_FLOAT"
+    for name, arr, nodata, pixel_type in (("fill", filled, None, "32_BIT_FLOAT"), ("fdir", fdir, 0, "8_BIT_UNSIGNED"), ("facc", facc, -1, facc_pixel_type)):
+        tile_rasters = []
+        for i, (r0, r1, c0, c1) in enumerate(tile_windows((nrows, ncols), tile_size)):
+            lower_left = arcpy.Point(xmin + c0 * cellsize, ymax - r1 * cellsize)
+            block = np.array(arr[r0:r1, c0:c1])
+            if name == "facc" and block.dtype != np.int32:
+                block = block.astype(np.float32)
+            tile_raster = array_to_raster(block, lower_left, cellsize, nodata)
+            tile_path = os.path.join(work_folder, name + "_" + str(i) + ".tif")
+            tile_raster.save(tile_path)
+            tile_rasters.append(tile_path)
+        arcpy.MosaicToNewRaster_management(tile_rasters, work_folder, name + ".tif", ras.spatialReference, pixel_type, cellsize, 1)
+        outputs.append(arcpy.Raster(os.path.join(work_folder, name + ".tif")))
+    return outputs[0], outputs[1], outputs[2]
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function converts the features (valleys or cross sections) to a raster of their object
+# IDs on the grid of the DEM raster. It returns the raster path and the sorted object IDs, which renumber the
+# IDs to the labels (1 to the number of features, 0 outside) with feature_labels.
+#------------------------------------------------------------------------------------------------------------
+def feature_label_raster(dem, features):
+    import arcpy
+
+    ras = arcpy.Raster(dem) if isinstance(dem, str) else dem
+    label_raster = os.path.join(arcpy.env.scratchFolder, "feature_labels.tif")
+    oid_field = arcpy.Describe(features).OIDFieldName
+    with arcpy.EnvManager(extent = ras.extent, snapRaster = ras, cellSize = ras.meanCellWidth):
+        arcpy.FeatureToRaster_conversion(features, oid_field, label_raster, ras.meanCellWidth)
+    oids = np.sort(np.array([row[0] for row in arcpy.da.SearchCursor(features, [oid_field])], dtype=np.int64))
+    return label_raster, oids
+
+#------------------------------------------------------------------------------------------------------------
+# This function renumbers the object IDs of a label raster array to the labels from 1 (0 for NoData)
+#------------------------------------------------------------------------------------------------------------
+def feature_labels(oid_array, oids):
+    oid_array = np.asarray(oid_array)
+    labels = np.searchsorted(oids, oid_array) + 1
+    labels[~np.isin(oid_array, oids)] = 0
+    return labels.astype(label_dtype)
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function derives the filled DEM, flow direction and flow accumulation rasters with the
+# coarse-to-fine bounding, so that only the cells within the catchment windows of the features are routed at
+# the full resolution with the NumPy engine. The coarse DEM and labels are aggregated by the Aggregate tool (from
+# the upper left corner, the same blocks as aggregate_dem and aggregate_labels), and the DEM is only read within
+# the windows. The output rasters cover the bounding box of the windows. If the windows do not contain the
+# catchments, the whole DEM is routed with the tiled routing (tiled_flow_products) instead.
+#------------------------------------------------------------------------------------------------------------
+def bounded_flow_products(dem, features, factor = 8, buffer_cells = 2, tile_size = 1024):
+    import arcpy
+    from arcpy.sa import Aggregate
+
+    ras = arcpy.Raster(dem) if isinstance(dem, str) else dem
+    cellsize = ras.meanCellWidth
+    nrows, ncols = ras.height, ras.width
+    xmin, ymax = ras.extent.XMin, ras.extent.YMax
+    label_raster, oids = feature_label_raster(ras, features)
+    coarse_shape = (-(-nrows // factor), -(-ncols // factor))
+    with arcpy.EnvManager(extent = "MAXOF", mask = ""):
+        coarse_dem = arcpy.RasterToNumPyArray(Aggregate(ras, factor, "MINIMUM", "EXPAND", "DATA"), nodata_to_value = np.nan).astype(np.float64)
+        coarse_labels = feature_labels(arcpy.RasterToNumPyArray(Aggregate(label_raster, factor, "MAXIMUM", "EXPAND", "DATA"), nodata_to_value = 0), oids)
+    windows = coarse_windows(coarse_dem[:coarse_shape[0], :coarse_shape[1]], coarse_labels[:coarse_shape[0], :coarse_shape[1]], (nrows, ncols), factor, buffer_cells)
+
+    def read_window(r0, r1, c0, c1):
+        lower_left = arcpy.Point(xmin + c0 * cellsize, ymax - r1 * cellsize)
+        demArr = arcpy.RasterToNumPyArray(ras, lower_left, c1 - c0, r1 - r0, np.nan).astype(np.float64)
+        labels = feature_labels(arcpy.RasterToNumPyArray(label_raster, lower_left, c1 - c0, r1 - r0, 0), oids)
+        return demArr, labels
+
+    result = windowed_d8_routing(read_window, (nrows, ncols), windows, factor, buffer_cells)
+    arcpy.Delete_management(label_raster)
+    if result is None:
+        arcpy.AddWarning("The catchment windows of the features do not converge; route the whole DEM with the tiled routing (" + str(tile_size) + " x " + str(tile_size) + " tiles) instead")
+        return tiled_flow_products(ras, tile_size)
+    filled, fdir, facc, (r0, r1, c0, c1) = result
+    arcpy.AddMessage("Route " + str(r1 - r0) + " x " + str(c1 - c0) + " of " + str(nrows) + " x " + str(ncols) + " cells within the catchment windows")
+    box_lower_left = arcpy.Point(xmin + c0 * cellsize, ymax - r1 * cellsize)
+    fillDEM = array_to_raster(filled, box_lower_left, cellsize)
+    fdirRaster = array_to_raster(fdir, box_lower_left, cellsize, 0)
+    faccRaster = array_to_raster(facc, box_lower_left, cellsize, -1)
+    return fillDEM, fdirRaster, faccRaster
+
+#------------------------------------------------------------------------------------------------------------
+# The functions below check the engine and report the run time on synthetic DEMs
+#------------------------------------------------------------------------------------------------------------
+def synthetic_dem(nrows, ncols, seed = 0, nodata_hole = False):
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:nrows, 0:ncols]
+    ##A tilted valley surface with random bumps and pits
+    dem = 0.5 * rows + 0.02 * (cols - ncols / 2.0) ** 2
+    dem = dem + ndimage.gaussian_filter(rng.rand(nrows, ncols) * 40.0, 3)
+    dem = dem + rng.rand(nrows, ncols)
+    if nodata_hole:
+        dem[nrows//3:nrows//3 + nrows//10, ncols//3:ncols//3 + ncols//10] = np.nan
+    return dem
+
+def brute_force_fill(dem):
+    ##Planchon and Darboux (2001) iterative filling, used to check the priority-flood results
+    valid = ~np.isnan(dem)
+    nrows, ncols = dem.shape
+    seeds = ndimage.binary_dilation(np.pad(~valid, 1, constant_values=True), np.ones((3,3), dtype=bool))[1:-1, 1:-1] & valid
+    W = np.where(seeds | ~valid, dem, np.inf)
+    while True:
+        Wpad = np.pad(W, 1, constant_values=np.inf)
+        nbmin = np.full(dem.shape, np.inf)
+        for k in range(8):
+            dr = d8_drow[k]
+            dc = d8_dcol[k]
+            nbmin = np.fmin(nbmin, Wpad[1+dr:1+dr+nrows, 1+dc:1+dc+ncols])
+        newW = np.where(valid & ~seeds, np.maximum(dem, nbmin), W)
+        if np.array_equal(newW, W, equal_nan=True):
+            return np.where(valid, W, np.nan)
+        W = newW
+
+def check_watersheds(fdir, pour):
+    ##Follow the flow path of each cell downstream to the first pour point
+    labels = watershed_labels(fdir, pour)
+    recv = flow_receivers(fdir)
+    flat_pour = pour.ravel()
+    for cell in range(fdir.size):
+        c = cell
+        while c >= 0 and flat_pour[c] == 0:
+            c = recv[c]
+        expected = flat_pour[c] if (c >= 0 and fdir.ravel()[cell] > 0) else 0
+        assert labels.ravel()[cell] == expected
+    return labels
+
+def check_routing(dem):
+    valid = ~np.isnan(dem)
+    filled, fdir, facc = d8_routing(dem)
+    ##The filled DEM is the same as the iterative filling
+    assert np.allclose(filled[valid], brute_force_fill(dem)[valid])
+    ##Every valid cell has a flow direction and all flow paths reach the edge of the DEM
+    assert np.all(np.isin(fdir[valid], d8_codes)) and np.all(fdir[~valid] == 0)
+    recv = flow_receivers(fdir)
+    order, wave_starts = topological_order(recv, valid.ravel())
+    assert len(order) == np.count_nonzero(valid)
+    ##The flow never goes uphill on the filled DEM
+    has_recv = recv >= 0
+    assert np.all(filled.ravel()[recv[has_recv]] <= filled.ravel()[has_recv])
+    ##The outlets collect all valid cells
+    outlets = valid.ravel() & ~has_recv
+    assert facc.ravel()[outlets].sum() + np.count_nonzero(outlets) == np.count_nonzero(valid)
+    return filled, fdir, facc
+
+if __name__ == '__main__':
+    for nodata_hole in (False, True):
+        check_routing(synthetic_dem(60, 80, seed = 1, nodata_hole = nodata_hole))
+    print("Synthetic DEM checks passed")
+
+    ##The outputs are in the compact dtypes, and the weighted accumulation of ones is the accumulation
+    filled, fdir, facc = d8_routing(synthetic_dem(60, 80, seed = 3, nodata_hole = True))
+    wfacc = flow_accumulation(fdir, np.ones(fdir.shape))
+    assert fdir.dtype == fdir_dtype and facc.dtype == np.int32 and wfacc.dtype == weighted_facc_dtype
+    assert np.array_equal(np.where(np.isnan(wfacc), -1, wfacc), facc)
+    assert watershed_labels(fdir, (facc > 20).astype(np.int64)).dtype == label_dtype
+    print("Dtype checks passed")
+
+    ##The tiled routing is identical to the routing on the whole DEM, including the flats across the tiles
+    import tempfile
+    for nodata_hole in (False, True):
+        dem = synthetic_dem(70, 93, seed = 2, nodata_hole = nodata_hole)
+        dem = np.round(dem / 3.0) * 3.0
+        filled, fdir, facc = d8_routing(dem)
+        for tile_size in (16, 25, 64):
+            tmp_folder = tempfile.mkdtemp()
+            tfilled, tfdir, tfacc = tiled_d8_routing(dem, tmp_folder, tile_size)
+            assert np.array_equal(tfilled, filled, equal_nan=True)
+            assert np.array_equal(tfdir, fdir) and np.array_equal(tfacc, facc)
+    ##The edge cells of a tile draining to one local basin share one label
+    zb = np.add.outer(np.arange(20.0), np.arange(20.0) * 0.1)
+    zb[8:12, 8:12] -= 30.0
+    fb, lb, next_label, edges = labelled_flood_block(zb, 2)
+    assert next_label == 3 and np.all(lb == 2) and len(edges[0]) == 0
+    zb[1:-1, 10] = 100.0 ##a ridge splits the tile into two basins
+    fb, lb, next_label, edges = labelled_flood_block(zb, 2)
+    assert next_label == 4 and len(edges[0]) == 1
+    print("Tiled routing checks passed")
+
+    ##The watersheds of many (nested) pour points in one sweep
+    filled, fdir, facc = d8_routing(synthetic_dem(60, 80, seed = 4, nodata_hole = True))
+    rng = np.random.RandomState(4)
+    pour = np.zeros(fdir.shape, dtype=np.int64)
+    cells = rng.choice(np.flatnonzero(facc.ravel() > 5), 40, replace=False)
+    pour.ravel()[cells] = np.arange(1, 41)
+    check_watersheds(fdir, pour)
+    print("Watershed checks passed")
+
+    ##The watershed statistics are the same as the statistics of each watershed, and the empty labels are NaN
+    filled, fdir, facc = d8_routing(synthetic_dem(60, 80, seed = 3, nodata_hole = True))
+    pour = np.zeros(fdir.shape, dtype=np.int64)
+    pour.ravel()[np.argsort(facc.ravel())[::-1][:8]] = np.arange(1, 9)
+    ws = watershed_labels(fdir, pour)
+    stats = watershed_statistics(ws, filled, 9, 30.0, 5)
+    for label in range(1, 9):
+        z = filled[(ws == label) & np.isfinite(filled)]
+        if len(z) < 1:
+            assert stats["count"][label - 1] == 0 and np.isnan(stats["min"][label - 1])
+            continue
+        assert stats["count"][label - 1] == len(z) and np.isclose(stats["area"][label - 1], len(z) * 900.0)
+        assert stats["min"][label - 1] == z.min() and stats["max"][label - 1] == z.max() and np.isclose(stats["mean"][label - 1], z.mean())
+        if z.max() == z.min(): ##a flat watershed
+            assert np.isnan(stats["hi"][label - 1]) and np.array_equal(stats["curve"][label - 1], [1, 0, 0, 0, 0])
+            continue
+        h = (z - z.min()) / (z.max() - z.min())
+        assert np.isclose(stats["hi"][label - 1], h.mean())
+        assert np.allclose(stats["curve"][label - 1], [np.mean(np.minimum(np.floor(h * 5), 4) >= j) for j in range(5)])
+    assert stats["count"][8] == 0 and np.all(np.isnan(stats["curve"][8]))
+    print("Watershed statistics checks passed")
+
+    ##The cleaned watershed mask keeps the largest part and the areas enclosed by the cross section
+    ws = np.zeros((20, 20), dtype=np.int32)
+    ws[2:10, 2:10] = 1
+    ws[15:17, 15:17] = 1
+    line = np.zeros(ws.shape, dtype=np.int32)
+    line[5, 9:15] = 1
+    line[5:9, 14] = 1
+    line[8, 9:15] = 1
+    line[12:19, 5] = 1
+    mask = watershed_mask(ws, line)
+    expected = ws == 1
+    expected[15:17, 15:17] = False
+    expected[5:9, 9:15] = True
+    assert np.array_equal(mask, expected)
+    assert np.array_equal(watershed_mask(ws), (ws == 1) & (np.arange(20)[:, None] < 12))
+    print("Watershed mask checks passed")
+
+    ##The bounded routing gives the same watersheds and flow accumulation of the valleys as the routing of the
+    ##whole DEM, with the windows expanded when the buffer is too small
+    rows, cols = np.mgrid[0:300, 0:400]
+    dem = 0.3 * rows + 40 * np.abs(np.sin(cols * np.pi / 120.0)) + 10 * np.abs(np.sin(rows * np.pi / 150.0))
+    dem = dem + synthetic_dem(300, 400, seed = 5) - 0.5 * rows
+    valley_labels = np.zeros(dem.shape, dtype=np.int64)
+    valley_labels[150, 160:200] = 1
+    valley_labels[200, 170:180] = 2
+    valley_labels[100, 290:300] = 3
+    filled, fdir, facc = d8_routing(dem)
+    ws = watershed_labels(fdir, valley_labels)
+    for factor, buffer_cells in ((8, 2), (16, 0), (4, 1)):
+        bfilled, bfdir, bfacc, box = bounded_d8_routing(dem, valley_labels, factor, buffer_cells)
+        sub = (slice(box[0], box[1]), slice(box[2], box[3]))
+        assert np.array_equal(watershed_labels(bfdir, valley_labels[sub]), ws[sub]) and np.sum(ws[sub] > 0) == np.sum(ws > 0)
+        assert np.array_equal(bfacc[valley_labels[sub] > 0], facc[valley_labels > 0])
+    ##The windowed routing only reads the bounding box of the windows
+    reads = []
+    def read_window(r0, r1, c0, c1):
+        reads.append((r1 - r0) * (c1 - c0))
+        return dem[r0:r1, c0:c1], valley_labels[r0:r1, c0:c1]
+    windows = coarse_windows(aggregate_dem(dem, 8), aggregate_labels(valley_labels, 8), dem.shape, 8, 2)
+    wfilled, wfdir, wfacc, wbox = windowed_d8_routing(read_window, dem.shape, windows, 8, 2)
+    assert np.array_equal(wfacc, bounded_d8_routing(dem, valley_labels, 8, 2)[2]) and max(reads) < dem.size
+    ##The windows that do not converge are left to the caller, and the array version routes the whole DEM
+    assert windowed_d8_routing(read_window, dem.shape, windows, 8, 2, max_passes = 0) is None
+    assert np.array_equal(bounded_d8_routing(dem, valley_labels, 8, 2, max_passes = 0)[2], facc)
+    print("Bounded routing checks passed")
+
+    ##The long profiles follow the receivers to the outlet (or the target) with the diagonal steps of sqrt(2) cells
+    filled, fdir, facc = d8_routing(synthetic_dem(60, 80, seed = 2))
+    recv = flow_receivers(fdir)
+    sources = np.random.RandomState(2).choice(fdir.size, 40, replace = False)
+    targets = np.full(len(sources), -1, dtype=np.int64)
+    targets[:10] = recv[recv[sources[:10]]] ##stop two steps down (or at the outlet)
+    targets[10:20] = np.random.RandomState(3).choice(fdir.size, 10) ##targets off the flow paths
+    cells, dist, z, offsets = flow_path_profiles(fdir, filled, sources, 30.0, targets)
+    flat_filled = filled.ravel()
+    for i, cell in enumerate(sources):
+        path = [cell]
+        while recv[path[-1]] >= 0 and path[-1] != targets[i] and not (targets[i] >= 0 and flat_filled[path[-1]] <= flat_filled[targets[i]]):
+            path.append(recv[path[-1]])
+        assert np.array_equal(cells[offsets[i]:offsets[i + 1]], path)
+        dr = np.abs(np.diff(np.array(path) // 80))
+        dc = np.abs(np.diff(np.array(path) % 80))
+        assert np.allclose(dist[offsets[i]:offsets[i + 1]], np.append(0, np.cumsum(np.hypot(dr, dc) * 30.0)))
+        assert np.all(np.diff(z[offsets[i]:offsets[i + 1]]) <= 0)
+    print("Long profile checks passed")
+
+    for size in (250, 500, 1000):
+        dem = synthetic_dem(size, size)
+        start = time.time()
+        filled = priority_flood_fill(dem)
+        t_fill = time.time() - start
+        start = time.time()
+        fdir = d8_flow_direction(filled)
+        t_fdir = time.time() - start
+        start = time.time()
+        facc = flow_accumulation(fdir)
+        t_facc = time.time() - start
+        print("%5d x %5d: fill %.2f s, flow direction %.2f s, flow accumulation %.2f s" % (size, size, t_fill, t_fdir, t_facc))
+        start = time.time()
+        tiled_d8_routing(dem, tempfile.mkdtemp(), 256)
+        print("%5d x %5d: tiled routing (256 x 256 tiles) %.2f s" % (size, size, time.time() - start))
+        pour = np.zeros(fdir.shape, dtype=np.int64)
+        cells = np.argsort(facc.ravel())[::-1][:500]
+        pour.ravel()[cells] = np.arange(1, 501)
+        start = time.time()
+        watershed_labels(fdir, pour)
+        print("%5d x %5d: watersheds of 500 pour points %.2f s" % (size, size, time.time() - start))
+        ws = watershed_labels(fdir, pour)
+        start = time.time()
+        watershed_statistics(ws, filled, 500)
+        print("%5d x %5d: statistics of 500 watersheds %.2f s" % (size, size, time.time() - start))
+        valley_labels = np.zeros(dem.shape, dtype=np.int64)
+        valley_labels[size // 2, size // 2 - size // 50:size // 2 + size // 50] = 1
+        start = time.time()
+        box = bounded_d8_routing(dem, valley_labels)[3]
+        print("%5d x %5d: bounded routing of one valley %.2f s (%d x %d cells routed)" % (size, size, time.time() - start, box[1] - box[0], box[3] - box[2]))
+        start = time.time()
+        cells, dist, z, offsets = flow_path_profiles(fdir, filled, np.argsort(facc.ravel())[:1000])
+        print("%5d x %5d: long profiles of 1000 sources %.2f s (%d cells)" % (size, size, time.time() - start, len(cells)))
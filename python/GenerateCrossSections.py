@@ -46,6 +46,9 @@ from scipy.spatial import cKDTree as KDTree
 from scipy import ndimage
 import arcpy.cartography as CA
 import matplotlib.pyplot as plt
+from FlowCache import get_flow_products, invalidate_flow_cache
+from FlowRouting import numpy_watershed
+from LineGeometry import flip_lines_low_to_high, ragged_from_ids, stations_along_lines, sample_dem
 
 arcpy.env.overwriteOutput = True
 arcpy.env.XYTolerance= "0.01 Meters"
@@ -79,54 +82,29 @@ temp_workspace = "in_memory"
 if ArcGISPro:
     temp_workspace = "memory"
 
+##Folder to cache the Fill/FlowDirection/FlowAccumulation products between runs ("" to disable the cache)
+##and the maximum size of the cache folder in GB. The least recently used entries are removed first.
+##FlowCacheInvalidate removes the cached entries of the input DEM before the run, i.e. when the DEM was edited in
+##place and the fingerprint did not catch the change.
+FlowCacheFolder = ""
+FlowCacheMaxGB = 20
+FlowCacheInvalidate = False
+
+##Backend to derive the filled DEM, flow direction and flow accumulation: "arcpy" (Spatial Analyst tools)
+##or "numpy" (the arcpy-free priority-flood and D8 routing engine in FlowRouting.py)
+RoutingBackend = "arcpy"
+
+##Tile size (cells) of the tiled NumPy routing for large DEMs; 0 routes the whole DEM in memory
+RoutingTileSize = 0
+
 #------------------------------------------------------------------------------------------------------------
 # This function check each line in the line feature and make sure the line is from low elevation to high
 # elevation (Glacier streamline needs from low to high elevation in order to reconstruct the paleo ice thickness).
 # It is revised from the codes by Pellitero et al.(2016) in GlaRe.
 #------------------------------------------------------------------------------------------------------------
 def Check_If_Flip_Line_Direction(line, dem):
-    cellsize = arcpy.GetRasterProperties_management(dem,"CELLSIZEX")
-    cellsize_int = int(float(cellsize.getOutput(0)))
-
-    line3d = arcpy.env.scratchGDB + "\\line3d"
-    arcpy.AddField_management(line, "Flip", "Long", "", "", "", "", "", "", "")
-
-    arcpy.InterpolateShape_3d(dem, line, line3d, cellsize_int*3) 
-
-    flip_list = []
-    i = 0
-    with arcpy.da.SearchCursor(line3d,["Shape@"]) as cursor:
-        for row in cursor:
-            startZ = row[0].firstPoint.Z
-            endZ = row[0].lastPoint.Z
-
-            if startZ >= endZ:  ##Flip = True use equal in case the start and end point are the same
-                flip_list.append(1)
-            else:  ##Flip = False
-                flip_list.append(0)
-            i += 1 
-
-    del cursor
-    if i>0:
-        del row
-
-    if sum(flip_list) > 0:
-        with arcpy.da.UpdateCursor(line,["Flip"]) as cursor:
-            i = 0
-            for row in cursor:
-                row[0] = flip_list[i]
-                cursor.updateRow(row)
-                i += 1 
-        del row, cursor
-
-        arcpy.MakeFeatureLayer_management(line, "lyrLines")
-        arcpy.SelectLayerByAttribute_management("lyrLines", "NEW_SELECTION", '"Flip" > 0')
-        arcpy.FlipLine_edit("lyrLines")  ##Need to change to lyrLines
-        arcpy.SelectLayerByAttribute_management("lyrLines", "CLEAR_SELECTION")
-
-    arcpy.DeleteField_management (line, "Flip")
-    arcpy.Delete_management(line3d)
-
+    ##Sample the DEM at the two end points of all lines in one lookup and reverse the lines in memory
+    flip_lines_low_to_high(line, dem)
 
 #---------------------------------------------------------------------------------------------------------------
 # This function calculates the distance between two points
@@ -349,14 +327,13 @@ def create_cross_sections(flowlinepoints, flowline, beddem, constrainboundary, e
     arcpy.env.cellSize = extDEM
     arcpy.env.snapRaster = extDEM ##setup snap raster
 
-    fillDEM =Fill(extDEM)  ##Fill the sink first
-    fdir = FlowDirection(fillDEM,"NORMAL") ##Flow direction
-    facc = FlowAccumulation(fdir) ##Flow accmulation
+    ##Fill, flow direction and flow accumulation (or read them from the flow cache)
+    fillDEM, fdir, facc = get_flow_products(extDEM, FlowCacheFolder, FlowCacheMaxGB, beddem, mbg_buf, RoutingBackend, RoutingTileSize)
 
     ##covert the flowlines to raster
     streamlink = temp_workspace + "\\streamlink"
     arcpy.conversion.FeatureToRaster(flowline, 'SegmentID', streamlink)
-    outWs = Watershed(fdir, streamlink)
+    outWs = numpy_watershed(fdir, streamlink)
     arcpy.RasterToPolygon_conversion(outWs, temp_workspace + "\\eucAllocate", "SIMPLIFY", "VALUE")
 
     ##Clip the cross section using the watershed boundary
@@ -486,10 +463,14 @@ def CreateCrossSections(BedDEM, inputflowline, constrainboundary, eraseAreas, sp
     #Obtain the height info for the start of each flowline
     height=[]
     lineid = []
+    lineoids = []
+    part_sizes = []
     #glaciers = []
-    with arcpy.da.SearchCursor(flowlines, ['SHAPE@']) as cursor:
+    with arcpy.da.SearchCursor(flowlines, ['SHAPE@', 'OID@']) as cursor:
         i = 0
         for row in cursor:
+            lineoids.append(row[1])
+            part_sizes.append([len(part) for part in row[0]])
             Startpoint = row[0].firstPoint
             coord= str(Startpoint.X)+" "+str(Startpoint.Y)
             Cellvalue=arcpy.GetCellValue_management(BedDEM, coord)
@@ -514,50 +495,35 @@ def CreateCrossSections(BedDEM, inputflowline, constrainboundary, eraseAreas, sp
             i += 1
     del row, cursor
     
-    OriginalFID = []
-    Points = []
-    processPID = []
-    #glaIds = []
-    p = 0
-
-    geometry = arcpy.CopyFeatures_management(flowlines, arcpy.Geometry()) 
-
-    for i in order:
-        Length = geometry[i].length
-        Length = int(Length)
-        try:
-            rlist = xrange(0, Length, spacing)
-        except: ##python 3 xrange is replaced by range
-            rlist = range(0, Length, spacing)
-        
-        for j in rlist:            
-            Points.append(geometry[i].positionAlongLine(j))
-            OriginalFID.append(i)
-            #glaIds.append(glaciers[i])
-            processPID.append(p)
-        p += 1
-
-    PointsFile = temp_workspace + "\\PointsFile"
-    arcpy.CopyFeatures_management(Points, PointsFile)
-
-    ##Extract Values and xy coordinates from Elevation Raster
-    ExtractValuesToPoints(PointsFile, BedDEM, flowline3dpoints,"INTERPOLATE", "VALUE_ONLY")
-
-    ##Add original FID Field
-    arcpy.AddField_management(flowline3dpoints, 'OFID', 'Long', 6) ##OFID is not FID, but it is related to FID
-    arcpy.AddField_management(flowline3dpoints, 'ProcessID', 'Long', 6) ##OFID is not FID, but it is related to FID
-    #arcpy.AddField_management(flowline3dpoints, GlacierID, 'Long', 6) ##OFID is not FID, but it is related to FID
-    PointsCursor = arcpy.UpdateCursor(flowline3dpoints, ['OFID','ProcessID'])
-    i = 0
-    for row in PointsCursor:
-        row.OFID = OriginalFID[i]
-        row.ProcessID = processPID[i]
-        #row.GlacierID = glaIds[i]
-        PointsCursor.updateRow(row)
-        i+=1
-    del row, PointsCursor  
-    
-    arcpy.DeleteField_management(flowline3dpoints,["POINT_Z","POINT_M"])
+    ##Create the stations at every spacing along all flowlines at once from the vertex arrays (in the processing
+    ##order), instead of one positionAlongLine geometry per station. OFID is the index of the flowline (not FID,
+    ##but it is related to FID) and ProcessID is the position of the flowline in the processing order.
+    vertexArr = arcpy.da.FeatureClassToNumPyArray(flowlines, ['OID@', 'SHAPE@X', 'SHAPE@Y'], explode_to_points = True)
+    vorder, vertex_oids, voffsets = ragged_from_ids(vertexArr['OID@'])
+    ##Join the vertex runs (sorted by OID) to the flowlines in the cursor order of the heights on the OID
+    lineidx = np.searchsorted(vertex_oids, lineoids)
+    counts = np.diff(voffsets)[lineidx]
+    offsets = np.zeros(len(lineoids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    take = vorder[np.repeat(voffsets[lineidx] - offsets[:-1], counts) + np.arange(offsets[-1])]
+    xy = np.column_stack((vertexArr['SHAPE@X'][take], vertexArr['SHAPE@Y'][take]))
+    ##The parts of the multipart flowlines are not joined by a segment (the same as positionAlongLine)
+    breaks = np.zeros(len(xy), dtype=bool)
+    for i, sizes in enumerate(part_sizes):
+        if len(sizes) > 1:
+            breaks[offsets[i] + np.cumsum(sizes[:-1])] = True
+    stations, tangent, OriginalFID, processPID = stations_along_lines(xy, offsets, spacing, order, breaks)
+
+    ##Sample the elevation at the stations with the bilinear interpolation, the same as ExtractValuesToPoints with
+    ##INTERPOLATE (-9999 for NoData)
+    stationZ = sample_dem(BedDEM, stations)
+    stationArr = np.zeros(len(stations), dtype=[('X', np.float64), ('Y', np.float64), ('RASTERVALU', np.float64), ('OFID', np.int32), ('ProcessID', np.int32)])
+    stationArr['X'] = stations[:, 0]
+    stationArr['Y'] = stations[:, 1]
+    stationArr['RASTERVALU'] = np.where(np.isfinite(stationZ), stationZ, -9999)
+    stationArr['OFID'] = OriginalFID
+    stationArr['ProcessID'] = processPID
+    arcpy.da.NumPyArrayToFeatureClass(stationArr, flowline3dpoints, ('X', 'Y'), spatialref)
 
     exist_fields = [f.name for f in arcpy.ListFields(flowlines)] #List of current field names in outline layer
     line_fields = ["line_id"]
@@ -814,6 +780,9 @@ if __name__ == '__main__':
 
     arcpy.Delete_management(temp_workspace)
 
+    if FlowCacheInvalidate and FlowCacheFolder != "":
+        arcpy.AddMessage("Remove " + str(invalidate_flow_cache(FlowCacheFolder, BedDEM)) + " flow cache entries of the DEM")
+
     singlepartlines = CreateCrossSections(BedDEM, inputflowline, constrainboundary, eraseAreas, spacing, half_width, AdjustProfile, min_width, min_height, b_divide, out_cross_sections, OutputConvexPoints)
 
     if OutputFolder != "":
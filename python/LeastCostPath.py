@@ -0,0 +1,266 @@
+#-------------------------------------------------------------------------------
+# Name: LeastCostPath.py
+#
+# Purpose:
+# This module derives the streamlines of a valley as the least-cost paths along the valley
+# bottom instead of tracing the D8 stream cells, which zigzag on the flat floors of glacial
+# valleys. The cost of a cell increases with its height above the local valley floor (the
+# lowest cell within a radius), and the least-cost paths from the outlet of the valley to all
+# cells around its channel heads are derived with one heap-based Dijkstra search over the
+# 8-neighbor graph of the valid cells in the box of the outlet and the channel heads (with a
+# buffer) instead of the whole watershed window (scipy.sparse.csgraph). The paths from the channel heads (the
+# sources of the stream cells of the flow accumulation threshold) to the outlet form a tree,
+# which is vectorized with StreamNetwork.py to the stream links with the same grid_code,
+# from_node, to_node and MAX attributes as the D8 stream links, so that the tributary pruning,
+# cleaning and dissolving steps are the same.
+#
+# Run this file directly to check the paths and report the run time on synthetic valleys.
+#
+# Author: Dr. Yingkui Li
+# Created:     11/07/2024-03/05/2025
+# Department of Geography, University of Tennessee
+# Knoxville, TN 37996
+#-------------------------------------------------------------------------------
+
+from __future__ import division
+import numpy as np
+import math
+import os, sys
+import time
+from scipy import ndimage
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from FlowRouting import d8_codes, d8_drow, d8_dcol, flow_receivers, topological_order, fdir_dtype
+from StreamNetwork import vectorize_stream_links, stream_graph
+
+##Lookup table from the row/col offset ((drow + 1) * 3 + (dcol + 1)) to the D8 code
+offset_codes = np.zeros(9, dtype=fdir_dtype)
+offset_codes[(d8_drow + 1) * 3 + (d8_dcol + 1)] = d8_codes
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the cost surface of the valley bottom from the elevation: the cost of a cell is 1 plus
+# its height above the local valley floor (the lowest cell within the radius, in cells) divided by the height
+# scale, so that one height scale above the floor doubles the cost of passing the cell. NoData cells are NaN.
+#------------------------------------------------------------------------------------------------------------
+def valley_floor_cost(dem, radius = 10, height_scale = 1.0):
+    dem = np.asarray(dem, dtype=np.float64)
+    valid = ~np.isnan(dem)
+    floor = ndimage.minimum_filter(np.where(valid, dem, np.inf), size = 2 * int(radius) + 1, mode = "nearest")
+    cost = 1.0 + (dem - floor) / float(height_scale)
+    cost[~valid] = np.nan
+    return cost
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the least-cost paths from the source cell to all cells of the cost surface with one
+# Dijkstra search over the 8-neighbor graph of the valid cells. The cost of a step is the mean cost of the two
+# cells times the step length. If the targets (flat indices) are given, only the box of the source and the
+# targets with a buffer (cells) is searched, so that the graph does not cover the whole cost surface. It returns
+# the accumulated cost of each cell (inf if not reached) and the predecessor of each cell on its path to the
+# source (flat index, -1 for the source and unreached cells).
+#------------------------------------------------------------------------------------------------------------
+def least_cost_tree(cost, source, cellsize = 1.0, targets = None, buffer_cells = 20):
+    nrows, ncols = cost.shape
+    r0, r1, c0, c1 = 0, nrows, 0, ncols
+    if targets is not None:
+        cells = np.append(np.asarray(targets, dtype=np.int64), int(source))
+        r0 = max(int((cells // ncols).min()) - buffer_cells, 0)
+        r1 = min(int((cells // ncols).max()) + buffer_cells + 1, nrows)
+        c0 = max(int((cells % ncols).min()) - buffer_cells, 0)
+        c1 = min(int((cells % ncols).max()) + buffer_cells + 1, ncols)
+    box_rows = r1 - r0
+    box_cols = c1 - c0
+    flat_cost = cost[r0:r1, c0:c1].ravel()
+    valid = ~np.isnan(flat_cost)
+    ids = np.arange(box_rows * box_cols).reshape(box_rows, box_cols)
+    ##The nodes of the graph are the valid cells of the box only
+    valid_ids = np.flatnonzero(valid)
+    node = np.full(len(flat_cost), -1, dtype=np.int64)
+    node[valid_ids] = np.arange(len(valid_ids))
+
+    ##The edges to the E, SE, S and SW neighbors cover all 8-neighbor pairs once
+    src = []
+    dst = []
+    weights = []
+    for drow, dcol in ((0, 1), (1, 1), (1, 0), (1, -1)):
+        a = ids[0:box_rows - drow, max(0, -dcol):box_cols - max(0, dcol)].ravel()
+        b = a + drow * box_cols + dcol
+        ok = valid[a] & valid[b]
+        a = a[ok]
+        b = b[ok]
+        src.append(node[a])
+        dst.append(node[b])
+        weights.append(0.5 * (flat_cost[a] + flat_cost[b]) * math.hypot(drow, dcol) * cellsize)
+    graph = csr_matrix((np.concatenate(weights), (np.concatenate(src), np.concatenate(dst))), shape=(len(valid_ids), len(valid_ids)))
+
+    box_source = (int(source) // ncols - r0) * box_cols + int(source) % ncols - c0
+    node_dist, node_pred = dijkstra(graph, directed = False, indices = int(node[box_source]), return_predecessors = True)
+
+    ##Map the nodes back to the flat indices of the cost surface
+    cell_ids = (valid_ids // box_cols + r0) * ncols + valid_ids % box_cols + c0
+    dist = np.full(nrows * ncols, np.inf)
+    dist[cell_ids] = node_dist
+    pred = np.full(nrows * ncols, -1, dtype=np.int64)
+    reached = node_pred >= 0
+    pred[cell_ids[reached]] = cell_ids[node_pred[reached]]
+    return dist.reshape(nrows, ncols), pred
+
+#------------------------------------------------------------------------------------------------------------
+# This function returns the channel heads of the stream cells with flow accumulation larger than the threshold:
+# the stream cells without any upstream stream cell in the D8 flow direction (flat indices).
+#------------------------------------------------------------------------------------------------------------
+def channel_heads(fdir, facc, threshold):
+    stream = ((facc > threshold) & (fdir > 0)).ravel()
+    recv = flow_receivers(fdir)
+    down = recv[stream & (recv >= 0)]
+    ndonors = np.bincount(down[stream[down]], minlength=len(stream))
+    return np.flatnonzero(stream & (ndonors == 0))
+
+#------------------------------------------------------------------------------------------------------------
+# This function marks the cells of the paths from the channel heads to the source on the predecessor tree.
+# The heads not reached from the source are skipped.
+#------------------------------------------------------------------------------------------------------------
+def path_tree(pred, heads, source):
+    on = np.zeros(len(pred), dtype=bool)
+    on[source] = True
+    frontier = np.unique(heads[pred[heads] >= 0])
+    on[frontier] = True
+    while frontier.size > 0:
+        nxt = pred[frontier]
+        nxt = np.unique(nxt[nxt >= 0])
+        nxt = nxt[~on[nxt]]
+        on[nxt] = True
+        frontier = nxt
+    return on
+
+#------------------------------------------------------------------------------------------------------------
+# This function converts the path tree to D8 flow direction codes (from each path cell to its predecessor). The
+# source cell gets the outlet code (its D8 flow direction), so that the stream links flowing out of the valley
+# end at the edge of the outlet cell as the D8 stream links do.
+#------------------------------------------------------------------------------------------------------------
+def tree_flow_direction(pred, on, shape, source, outlet_code):
+    nrows, ncols = shape
+    codes = np.zeros(nrows * ncols, dtype=fdir_dtype)
+    cells = np.flatnonzero(on & (pred >= 0))
+    drow = pred[cells] // ncols - cells // ncols
+    dcol = pred[cells] % ncols - cells % ncols
+    codes[cells] = offset_codes[(drow + 1) * 3 + (dcol + 1)]
+    codes[source] = outlet_code if outlet_code > 0 else 1
+    return codes.reshape(nrows, ncols)
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the flow accumulation along the path tree: the maximum of the D8 flow accumulation of
+# each path cell and all path cells upstream, so that the accumulation increases downstream along the paths
+# and the MAX of each link is the D8 drainage area it reaches, as used by the tributary pruning and smoothing.
+#------------------------------------------------------------------------------------------------------------
+def tree_accumulation(pred, on, facc):
+    recv = np.where(on, pred, -1)
+    acc = np.where(on, np.asarray(facc, dtype=np.float64).ravel(), -np.inf)
+    order, wave_starts = topological_order(recv, on)
+    wave_ends = np.append(wave_starts[1:], len(order))
+    for start, end in zip(wave_starts, wave_ends):
+        cells = order[start:end]
+        rv = recv[cells]
+        has_recv = rv >= 0
+        np.maximum.at(acc, rv[has_recv], acc[cells[has_recv]])
+    acc[~on] = -1
+    return acc.reshape(facc.shape)
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the least-cost stream network graphs of a valley for each stream threshold. The arrays
+# are the filled DEM, D8 flow direction and flow accumulation of the watershed window (the flow accumulation
+# is -1 or NaN outside of the watershed), and the outlet is the cell with the highest flow accumulation. The
+# Dijkstra search runs once within the box of the outlet and the channel heads of all thresholds (with a buffer
+# in cells), and the paths of all thresholds are taken from the same predecessor tree.
+#------------------------------------------------------------------------------------------------------------
+def least_cost_stream_graphs(dem, fdir, facc, thresholds, xmin = 0.0, ymax = 0.0, cellsize = 1.0, radius = 10, height_scale = 1.0, simplify = True, buffer_cells = 20):
+    facc = np.asarray(facc)
+    with np.errstate(invalid="ignore"):
+        inside = (fdir > 0) & (facc >= 0)
+    dem = np.where(inside, dem, np.nan)
+    source = int(np.argmax(np.where(inside, facc, -1).ravel()))
+    cost = valley_floor_cost(dem, radius, height_scale)
+    inside_fdir = np.where(inside, fdir, 0)
+    all_heads = [channel_heads(inside_fdir, facc, threshold) for threshold in thresholds]
+    dist, pred = least_cost_tree(cost, source, cellsize, np.concatenate(all_heads + [np.zeros(0, dtype=np.int64)]), buffer_cells)
+
+    graphs = []
+    for heads in all_heads:
+        if len(heads) < 1:
+            on = np.zeros(len(pred), dtype=bool)
+        else:
+            on = path_tree(pred, heads, source)
+        codes = tree_flow_direction(pred, on, fdir.shape, source, fdir.ravel()[source])
+        link, links, xy, offsets = vectorize_stream_links(on.reshape(fdir.shape), codes, xmin, ymax, cellsize, simplify, tree_accumulation(pred, on, facc))
+        graphs.append(stream_graph(links, xy, offsets))
+    return graphs
+
+#------------------------------------------------------------------------------------------------------------
+# The functions below check the paths and report the run time on synthetic valleys
+#------------------------------------------------------------------------------------------------------------
+def synthetic_valley(nrows, ncols, floor_width = 30, seed = 0):
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:nrows, 0:ncols]
+    ##A U-shaped valley descending to row 0 with a flat floor and small bumps, and a side valley joining it
+    side = np.maximum(np.abs(cols - ncols / 2.0) - floor_width / 2.0, 0)
+    dem = 0.2 * rows + 0.05 * side ** 2 + rng.rand(nrows, ncols) * 0.3
+    tributary = np.abs(rows - (nrows * 0.6 + 0.8 * (cols - ncols / 2.0))) < 3
+    dem = np.where(tributary & (cols > ncols / 2.0 + floor_width / 2.0), np.minimum(dem, 0.2 * rows + 0.5 * side + 1), dem)
+    return dem
+
+def turn_rate(graph):
+    ##The fraction of the inner vertices (not simplified) where the step direction changes
+    xy = graph["xy"]
+    offsets = graph["offsets"]
+    steps = np.diff(xy, axis=0)
+    same_link = np.ones(len(steps), dtype=bool)
+    same_link[offsets[1:-1] - 1] = False
+    turned = np.any(steps[1:] != steps[:-1], axis=1)
+    inner = same_link[1:] & same_link[:-1]
+    return np.count_nonzero(turned & inner) / max(np.count_nonzero(inner), 1)
+
+if __name__ == '__main__':
+    from FlowRouting import d8_routing, watershed_labels
+
+    for seed in range(3):
+        dem = synthetic_valley(200, 120, seed = seed)
+        filled, fdir, facc = d8_routing(dem)
+        ##Only the watershed of the outlet (the cell with the highest flow accumulation)
+        pour = np.zeros(fdir.shape, dtype=np.int64)
+        pour.ravel()[np.argmax(facc)] = 1
+        facc = np.where(watershed_labels(fdir, pour) > 0, facc, -1)
+        lcp = least_cost_stream_graphs(filled, fdir, facc, [150, 50], simplify = False)
+        for threshold, graph in zip([150, 50], lcp):
+            links = graph["links"]
+            ##One outlet, the links meet at junctions, and the MAX increases downstream
+            outlet_links = links['to_node'] > len(links)
+            assert np.count_nonzero(outlet_links) == 1
+            assert np.all(np.isin(links['to_node'][~outlet_links], links['from_node']))
+            down = np.searchsorted(links['from_node'], links['to_node'][~outlet_links])
+            assert np.all(links['MAX'][down] >= links['MAX'][~outlet_links])
+            ##The paths start from the channel heads (a head can be on the path of another head), and turn much less
+            ##often than the D8 stream links
+            d8 = stream_graph(*vectorize_stream_links(facc > threshold, fdir, simplify = False, facc = facc)[1:])
+            nsources = np.count_nonzero(~np.isin(links['from_node'], links['to_node']))
+            assert nsources > 0 and nsources <= len(channel_heads(fdir, facc, threshold))
+            assert turn_rate(graph) < 0.5 * turn_rate(d8)
+        ##The search within the box of the outlet and the heads finds the same paths as the search of the window
+        heads = channel_heads(fdir, facc, 50)
+        source = int(np.argmax(facc))
+        cost = valley_floor_cost(np.where(facc >= 0, filled, np.nan))
+        dist, pred = least_cost_tree(cost, source)
+        bdist, bpred = least_cost_tree(cost, source, targets = heads)
+        on = path_tree(pred, heads, source)
+        assert np.array_equal(path_tree(bpred, heads, source), on) and np.array_equal(bpred[on], pred[on])
+        assert np.allclose(bdist.ravel()[heads], dist.ravel()[heads])
+    ##The box is only the source and the targets with the buffer
+    cost = np.ones((300, 300))
+    dist, pred = least_cost_tree(cost, 0, targets = [5 * 300 + 7], buffer_cells = 3)
+    assert np.isclose(dist[5, 7], 5 * math.sqrt(2) + 2) and np.count_nonzero(np.isfinite(dist)) == 9 * 11
+    print("Least-cost path checks passed")
+
+    for size in (250, 500, 1000):
+        dem = synthetic_valley(size, size, floor_width = size // 4)
+        filled, fdir, facc = d8_routing(dem)
+        start = time.time()
+        graphs = least_cost_stream_graphs(filled, fdir, facc, [size, size // 4])
+        print("%5d x %5d: least-cost paths of %d links %.2f s" % (size, size, len(graphs[-1]["links"]), time.time() - start))
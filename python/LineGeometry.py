@@ -0,0 +1,529 @@
+#-------------------------------------------------------------------------------
+# Name: LineGeometry.py
+#
+# Purpose:
+# This module includes the arcpy-free operations on the vertices of many lines at once. The
+# lines are stored as ragged arrays: the x, y coordinates of all vertices in one array and the
+# start offset of each line (the last offset is the total number of vertices), so that the
+# operations run as array operations over all lines instead of Python loops over each line and
+# vertex, and the results can be written back with one cursor. The ArcGIS bridge functions import
+# arcpy only when they are called.
+#
+# Run this file directly to check the operations and report the run time on synthetic lines.
+#
+# Author: Dr. Yingkui Li
+# Created:     11/07/2024-03/05/2025
+# Department of Geography, University of Tennessee
+# Knoxville, TN 37996
+#-------------------------------------------------------------------------------
+
+from __future__ import division
+import numpy as np
+import math
+import os, sys
+import time
+
+#------------------------------------------------------------------------------------------------------------
+# This function groups the vertices by line id (keeping the order of the vertices in each line) and returns the
+# order of the vertices, the unique line ids and the start offset of each line.
+#------------------------------------------------------------------------------------------------------------
+def ragged_from_ids(line_ids):
+    line_ids = np.asarray(line_ids)
+    order = np.argsort(line_ids, kind="stable")
+    unique_ids, counts = np.unique(line_ids[order], return_counts=True)
+    offsets = np.zeros(len(unique_ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    return order, unique_ids, offsets
+
+#------------------------------------------------------------------------------------------------------------
+# This function returns the line index of each vertex and the index of the vertex within its line
+#------------------------------------------------------------------------------------------------------------
+def vertex_line_index(offsets):
+    counts = np.diff(offsets)
+    line = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(offsets[-1]) - offsets[:-1][line]
+    return line, local
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the angle (degree) between two lines based on the length of the three corresponding
+# points, the same as the angle function in DeriveFlowlineFromStreamNetwork.py but for arrays: 180 if the angle
+# cannot be derived (zero length or rounding errors).
+#------------------------------------------------------------------------------------------------------------
+def angle_array(a, b, c):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosc = (a*a + b*b - c*c) / (2*a*b)
+        angles = np.arccos(cosc) / 3.14159 * 180
+    return np.where(np.isfinite(angles), angles, 180.0)
+
+#------------------------------------------------------------------------------------------------------------
+# This function removes the big turns of the lines: if the angle at an interior vertex is smaller than the max
+# angle, the vertex is moved toward the midpoint of its two neighbors in five steps until the angle is larger
+# than the max angle. All interior vertices are tested at once; the vertices with odd and even positions are
+# moved in turn so that the neighbors of the moved vertices are fixed, and the passes are repeated until no
+# vertex is moved; after the first pass, only the vertices next to the moved ones are tested again. Moving a
+# vertex changes the angles of its neighbors, so the convergence is not guaranteed:
+# max_passes is only a safety cap, and some angles may still be smaller than the max angle when it is reached.
+# The first and last vertices are not moved.
+#------------------------------------------------------------------------------------------------------------
+def remove_big_turns(xy, offsets, max_angle, max_passes = 500):
+    xy = np.array(xy, dtype=np.float64).reshape(-1, 2)
+    line, local = vertex_line_index(offsets)
+    counts = np.diff(offsets)
+    is_interior = (local > 0) & (local < counts[line] - 1)
+    active = is_interior.copy()
+    steps = (np.arange(1, 6) / 5.0)[None, :]
+
+    for npass in range(max_passes):
+        moved = False
+        for parity in (1, 0):
+            v = np.flatnonzero(active & (local % 2 == parity))
+            active[v] = False
+            if len(v) < 1:
+                continue
+            p1 = xy[v - 1]
+            p = xy[v]
+            p2 = xy[v + 1]
+            length = np.hypot(p2[:, 0] - p1[:, 0], p2[:, 1] - p1[:, 1])
+            pntangle = angle_array(np.hypot(p[:, 0] - p1[:, 0], p[:, 1] - p1[:, 1]),
+                                   np.hypot(p[:, 0] - p2[:, 0], p[:, 1] - p2[:, 1]), length)
+            turn = pntangle < max_angle
+            if not turn.any():
+                continue
+            v = v[turn]
+            p1 = p1[turn]
+            p = p[turn]
+            p2 = p2[turn]
+            length = length[turn]
+            ##The five candidate positions toward the midpoint of the two neighbors
+            mid = (p1 + p2) / 2.0
+            newx = p[:, 0:1] + (mid[:, 0:1] - p[:, 0:1]) * steps
+            newy = p[:, 1:2] + (mid[:, 1:2] - p[:, 1:2]) * steps
+            length1 = np.hypot(newx - p1[:, 0:1], newy - p1[:, 1:2])
+            length2 = np.hypot(newx - p2[:, 0:1], newy - p2[:, 1:2])
+            ok = angle_array(length1, length2, length[:, None]) > max_angle
+            found = ok.any(axis=1)
+            first = np.argmax(ok, axis=1)
+            v = v[found]
+            xy[v, 0] = newx[found, first[found]]
+            xy[v, 1] = newy[found, first[found]]
+            ##The moved vertices and their neighbors are tested again
+            active[v - 1] = True
+            active[v] = True
+            active[v + 1] = True
+            active &= is_interior
+            moved = moved or len(v) > 0
+        if not moved:
+            break
+    return xy
+
+#------------------------------------------------------------------------------------------------------------
+# This function resamples the lines at even steps along the arc length. The spacing can be different for each
+# line; each line is divided into the smallest number of equal steps that are not longer than its spacing, so
+# that the first and last vertices are kept. Returns the new vertices and offsets.
+#------------------------------------------------------------------------------------------------------------
+def resample_lines(xy, offsets, spacing):
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    nlines = len(offsets) - 1
+    line, local = vertex_line_index(offsets)
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=np.float64), (nlines,))
+
+    ##Arc length of each vertex along its line
+    seglen = np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1]))
+    seglen = np.append(seglen, 0.0)
+    seglen[offsets[1:] - 1] = 0.0 ##no segment from the last vertex of a line to the next line
+    arc = np.cumsum(seglen) - seglen
+    arc = arc - arc[offsets[:-1]][line]
+    lengths = arc[offsets[1:] - 1]
+
+    ##Number of steps of each line and the arc length of the new vertices
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nsteps = np.ceil(lengths / spacing)
+    nsteps = np.where(np.isfinite(nsteps) & (nsteps > 1), nsteps, 1).astype(np.int64)
+    new_offsets = np.zeros(nlines + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(nsteps + 1)
+    new_line, new_local = vertex_line_index(new_offsets)
+    new_arc = lengths[new_line] * new_local / nsteps[new_line]
+
+    ##Locate the segment of each new vertex with a global key (the lines are separated by their lengths + 1)
+    base = np.zeros(nlines)
+    base[1:] = np.cumsum(lengths + 1.0)[:-1]
+    seg = np.searchsorted(arc + base[line], new_arc + base[new_line], side="right") - 1
+    seg = np.clip(seg, offsets[:-1][new_line], np.maximum(offsets[1:][new_line] - 2, offsets[:-1][new_line]))
+    nxt = np.minimum(seg + 1, offsets[1:][new_line] - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (new_arc - arc[seg]) / (arc[nxt] - arc[seg])
+    t = np.clip(np.where(np.isfinite(t), t, 0.0), 0.0, 1.0)[:, None]
+    new_xy = xy[seg] + (xy[nxt] - xy[seg]) * t
+    ##Keep the end points exactly
+    new_xy[new_offsets[:-1]] = xy[offsets[:-1]]
+    new_xy[new_offsets[1:] - 1] = xy[offsets[1:] - 1]
+    return new_xy, new_offsets
+
+#------------------------------------------------------------------------------------------------------------
+# This function smooths the lines with a Gaussian kernel along the arc length, an equivalent of the PAEK
+# smoothing of the ArcGIS SmoothLine tool: the tolerance is the length of the path used to derive each new
+# vertex. The tolerance can be different for each line. Each line is resampled with the spacing of tolerance /
+# samples, so that the kernel has the same number of taps for all lines and all lines are smoothed in one
+# pass. The lines are extended by the point reflection about their end points, which keeps the end points.
+#------------------------------------------------------------------------------------------------------------
+def smooth_lines(xy, offsets, tolerance, samples = 16):
+    nlines = len(offsets) - 1
+    tolerance = np.broadcast_to(np.asarray(tolerance, dtype=np.float64), (nlines,))
+    new_xy, new_offsets = resample_lines(xy, offsets, tolerance / samples)
+    line, local = vertex_line_index(new_offsets)
+    last = (np.diff(new_offsets) - 1)[line]
+    first_xy = new_xy[new_offsets[:-1]][line]
+    last_xy = new_xy[new_offsets[1:] - 1][line]
+
+    ##The kernel covers the path of the tolerance (half on each side) with a sigma of 1/6 of the tolerance
+    radius = samples // 2
+    taps = np.arange(-radius, radius + 1)
+    weights = np.exp(-0.5 * (taps / (samples / 6.0)) ** 2)
+    weights = weights / weights.sum()
+
+    smoothed = np.zeros_like(new_xy)
+    for k, w in zip(taps, weights):
+        j = local + k
+        before = j < 0
+        after = j > last
+        j = np.where(before, -j, np.where(after, 2 * last - j, j))
+        j = np.clip(j, 0, last) ##for the lines shorter than the kernel
+        p = new_xy[new_offsets[:-1][line] + j]
+        p = np.where(before[:, None], 2 * first_xy - p, p)
+        p = np.where(after[:, None], 2 * last_xy - p, p)
+        smoothed += w * p
+    smoothed[new_offsets[:-1]] = new_xy[new_offsets[:-1]]
+    smoothed[new_offsets[1:] - 1] = new_xy[new_offsets[1:] - 1]
+    return smoothed, new_offsets
+
+#------------------------------------------------------------------------------------------------------------
+# This function creates the stations along the lines at every spacing from the start of each line (0, spacing,
+# ... below the integer length of the line, the same as positionAlongLine over range(0, int(length), spacing))
+# for all lines at once with np.interp on the cumulative segment lengths. The lines are processed in the order
+# (the line indices, all lines by default) and the process id of each station is the position of its line in
+# the order. The vertices that start a new part of a multipart line can be flagged by breaks: the parts are not
+# joined by a segment, and the length along the line is the sum of the lengths of the parts (the same as
+# positionAlongLine). Returns the stations, the unit tangent of the line at each station, and the line index and
+# process id of each station as parallel arrays.
+#------------------------------------------------------------------------------------------------------------
+def stations_along_lines(xy, offsets, spacing, order = None, breaks = None):
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    nlines = len(offsets) - 1
+    if order is None:
+        order = np.arange(nlines)
+    order = np.asarray(order, dtype=np.int64)
+    line, local = vertex_line_index(offsets)
+
+    ##Arc length of each vertex along its line
+    seglen = np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1]))
+    seglen = np.append(seglen, 0.0)
+    seglen[offsets[1:] - 1] = 0.0 ##no segment from the last vertex of a line to the next line
+    if breaks is not None:
+        seglen[np.flatnonzero(breaks) - 1] = 0.0 ##no segment between the parts of a line
+    arc = np.cumsum(seglen) - seglen
+    arc = arc - arc[offsets[:-1]][line]
+    lengths = arc[offsets[1:] - 1]
+
+    ##Distance of each station along its line, in the processing order
+    nstations = np.ceil(np.floor(lengths[order]) / spacing).astype(np.int64)
+    process = np.repeat(np.arange(len(order)), nstations)
+    station_line = order[process]
+    starts = np.cumsum(nstations) - nstations
+    dist = (np.arange(nstations.sum()) - starts[process]) * float(spacing)
+
+    ##Interpolate all stations on a global key (the lines are separated by their lengths + 1)
+    base = np.zeros(nlines)
+    base[1:] = np.cumsum(lengths + 1.0)[:-1]
+    key = arc + base[line]
+    station_key = dist + base[station_line]
+    stations = np.column_stack((np.interp(station_key, key, xy[:, 0]), np.interp(station_key, key, xy[:, 1])))
+
+    ##The tangent is the direction of the segment of each station (the stations are on lines longer than 1)
+    seg = np.searchsorted(key, station_key, side="right") - 1
+    seg = np.minimum(seg, offsets[1:][station_line] - 2)
+    d = xy[seg + 1] - xy[seg]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tangent = d / np.hypot(d[:, 0], d[:, 1])[:, None]
+    tangent = np.where(np.isfinite(tangent), tangent, 0.0)
+    return stations, tangent, station_line, process
+
+#------------------------------------------------------------------------------------------------------------
+# This function samples a grid (with the upper left corner and the cell size) at the points with the bilinear
+# interpolation of the four nearest cell centers, the same as the default of InterpolateShape in ArcGIS. The
+# value of the nearest cell is used if one of the four cells is NoData (NaN), and the points outside of the grid
+# are NaN.
+#------------------------------------------------------------------------------------------------------------
+def sample_grid(arr, xmin, ymax, cellsize, xy):
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    nrows, ncols = arr.shape
+    row = (ymax - xy[:, 1]) / cellsize
+    col = (xy[:, 0] - xmin) / cellsize
+    inside = (row >= 0) & (row <= nrows) & (col >= 0) & (col <= ncols)
+
+    ##The nearest cell
+    r = np.clip(np.floor(row), 0, nrows - 1).astype(np.int64)
+    c = np.clip(np.floor(col), 0, ncols - 1).astype(np.int64)
+    nearest = arr[r, c]
+
+    ##The four cell centers around each point
+    r0 = np.clip(np.floor(row - 0.5), 0, max(nrows - 2, 0)).astype(np.int64)
+    c0 = np.clip(np.floor(col - 0.5), 0, max(ncols - 2, 0)).astype(np.int64)
+    r1 = np.minimum(r0 + 1, nrows - 1)
+    c1 = np.minimum(c0 + 1, ncols - 1)
+    fr = np.clip(row - 0.5 - r0, 0, 1)
+    fc = np.clip(col - 0.5 - c0, 0, 1)
+    z = (arr[r0, c0] * (1 - fr) * (1 - fc) + arr[r0, c1] * (1 - fr) * fc +
+         arr[r1, c0] * fr * (1 - fc) + arr[r1, c1] * fr * fc)
+    z = np.where(np.isnan(z), nearest, z)
+    return np.where(inside, z, np.nan)
+
+#------------------------------------------------------------------------------------------------------------
+# This function samples a grid with the shape (rows, cols) at the points with sample_grid, reading the grid only
+# around the points: the points are grouped by blocks of block x block cells, and the cells of each group (within
+# the extent of its points plus one cell) are read with read_window(start row, end row, start col, end col). The
+# peak memory is bounded by the block size however far apart the points are.
+#------------------------------------------------------------------------------------------------------------
+def sample_grid_windows(read_window, shape, xmin, ymax, cellsize, xy, block = 256):
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    nrows, ncols = shape
+    z = np.full(len(xy), np.nan)
+    row = (ymax - xy[:, 1]) / cellsize
+    col = (xy[:, 0] - xmin) / cellsize
+    pts = np.flatnonzero((row >= 0) & (row <= nrows) & (col >= 0) & (col <= ncols))
+    if len(pts) < 1:
+        return z
+
+    ##Group the points by block
+    brow = np.minimum(np.floor(row[pts]), nrows - 1).astype(np.int64) // block
+    bcol = np.minimum(np.floor(col[pts]), ncols - 1).astype(np.int64) // block
+    key = brow * (ncols // block + 1) + bcol
+    order = np.argsort(key, kind="stable")
+    pts = pts[order]
+    starts = np.flatnonzero(np.r_[True, key[order][1:] != key[order][:-1]])
+    for group in np.split(pts, starts[1:]):
+        r0 = max(int(np.floor(row[group].min())) - 1, 0)
+        r1 = min(int(np.ceil(row[group].max())) + 1, nrows)
+        c0 = max(int(np.floor(col[group].min())) - 1, 0)
+        c1 = min(int(np.ceil(col[group].max())) + 1, ncols)
+        arr = np.asarray(read_window(r0, r1, c0, c1), dtype=np.float64)
+        z[group] = sample_grid(arr, xmin + c0 * cellsize, ymax - r0 * cellsize, cellsize, xy[group])
+    return z
+
+#------------------------------------------------------------------------------------------------------------
+# This function returns the lines to be flipped so that they run from low to high elevations: the elevation of
+# the start point is higher than or equal to the elevation of the end point (equal in case the start and end
+# points are the same). The lines with a NoData end point are not flipped.
+#------------------------------------------------------------------------------------------------------------
+def lines_to_flip(start_z, end_z):
+    start_z = np.asarray(start_z, dtype=np.float64)
+    end_z = np.asarray(end_z, dtype=np.float64)
+    with np.errstate(invalid="ignore"):
+        return start_z >= end_z
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function samples a DEM at the points with sample_grid. The DEM is only read around the
+# points, block by block (sample_grid_windows), aligned with the cells of the DEM. The points outside of the DEM
+# are NaN.
+#------------------------------------------------------------------------------------------------------------
+def sample_dem(dem, xy, block = 256):
+    import arcpy
+
+    ras = arcpy.Raster(dem) if isinstance(dem, str) else dem
+    cellsize = ras.meanCellWidth
+    xmin, ymax = ras.extent.XMin, ras.extent.YMax
+
+    def read_window(r0, r1, c0, c1):
+        lower_left = arcpy.Point(xmin + c0 * cellsize, ymax - r1 * cellsize)
+        return arcpy.RasterToNumPyArray(ras, lower_left, c1 - c0, r1 - r0, np.nan)
+
+    return sample_grid_windows(read_window, (ras.height, ras.width), xmin, ymax, cellsize, xy, block)
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function makes sure that each line of a line feature class runs from low to high
+# elevations. The DEM is sampled at the two end points of all lines in one lookup (read around the end points
+# only, sample_dem); the lines to be flipped are reversed (the order of the parts and of the vertices of each part)
+# in memory and written back with one UpdateCursor. Returns the number of flipped lines.
+#------------------------------------------------------------------------------------------------------------
+def flip_lines_low_to_high(line, dem):
+    import arcpy
+
+    ras = arcpy.Raster(dem) if isinstance(dem, str) else dem
+    oids = []
+    ends = []
+    with arcpy.da.SearchCursor(line, ["OID@", "SHAPE@"]) as cursor:
+        for row in cursor:
+            if row[1] is None or row[1].pointCount < 1:
+                continue
+            oids.append(row[0])
+            ends.append((row[1].firstPoint.X, row[1].firstPoint.Y, row[1].lastPoint.X, row[1].lastPoint.Y))
+    if len(oids) < 1:
+        return 0
+    ends = np.array(ends, dtype=np.float64)
+
+    ##Sample the DEM at the start and end points of all lines in one lookup
+    z = sample_dem(ras, np.vstack((ends[:, 0:2], ends[:, 2:4])))
+    start_z = z[:len(oids)]
+    end_z = z[len(oids):]
+    flip_oids = set(np.array(oids)[lines_to_flip(start_z, end_z)].tolist())
+    if len(flip_oids) < 1:
+        return 0
+
+    with arcpy.da.UpdateCursor(line, ["OID@", "SHAPE@"]) as cursor:
+        for row in cursor:
+            if row[0] in flip_oids:
+                geom = row[1]
+                parts = arcpy.Array()
+                for part in reversed([list(part) for part in geom]):
+                    parts.add(arcpy.Array([p for p in reversed(part) if p is not None]))
+                row[1] = arcpy.Polyline(parts, geom.spatialReference, geom.hasZ, geom.hasM)
+                cursor.updateRow(row)
+    return len(flip_oids)
+
+#------------------------------------------------------------------------------------------------------------
+# The functions below check the operations and report the run time on synthetic lines
+#------------------------------------------------------------------------------------------------------------
+def random_lines(nlines, nvertices, seed = 0):
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(2, nvertices, nlines)
+    offsets = np.zeros(nlines + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    ##Random walks with sharp turns
+    headings = np.cumsum(rng.normal(0, 1.2, offsets[-1]))
+    xy = np.column_stack((np.cos(headings), np.sin(headings))) * rng.uniform(5, 30, (offsets[-1], 1))
+    line, local = vertex_line_index(offsets)
+    xy = np.cumsum(xy, axis=0)
+    xy = xy - xy[offsets[:-1]][line] + np.column_stack((line * 1000.0, np.zeros(len(line))))
+    return xy, offsets
+
+def loop_remove_big_turns(xy, offsets, max_angle):
+    ##The original loop of streamline_remove_bigturn (one pass over each line), used for the timing
+    def distance2points(x1, y1, x2, y2):
+        return math.sqrt((x2-x1)*(x2-x1) + (y2-y1)*(y2-y1))
+    def angle(a, b, c):
+        try:
+            cosc = (a*a + b*b -c*c)/(2*a*b)
+            return math.acos(cosc) / 3.14159 * 180
+        except:
+            return 180
+    xy = np.array(xy)
+    for l in range(len(offsets) - 1):
+        arr = xy[offsets[l]:offsets[l+1]]
+        for row in range(1, len(arr) - 1):
+            x1, y1 = arr[row-1]
+            x, y = arr[row]
+            x2, y2 = arr[row+1]
+            length = distance2points(x1, y1, x2, y2)
+            pntangle = angle(distance2points(x1, y1, x, y), distance2points(x2, y2, x, y), length)
+            if pntangle < max_angle:
+                midx = (x1 + x2)/2
+                midy = (y1 + y2)/2
+                for i in range(5):
+                    newx = x + (midx - x) * (i+1) / 5
+                    newy = y + (midy - y) * (i+1) / 5
+                    pntangle = angle(distance2points(x1, y1, newx, newy), distance2points(x2, y2, newx, newy), length)
+                    if pntangle > max_angle:
+                        arr[row] = (newx, newy)
+                        break
+    return xy
+
+def line_angles(xy, offsets):
+    line, local = vertex_line_index(offsets)
+    counts = np.diff(offsets)
+    v = np.flatnonzero((local > 0) & (local < counts[line] - 1))
+    p1 = xy[v - 1]
+    p = xy[v]
+    p2 = xy[v + 1]
+    return angle_array(np.hypot(*(p - p1).T), np.hypot(*(p - p2).T), np.hypot(*(p2 - p1).T))
+
+if __name__ == '__main__':
+    ##The end points are not moved and all angles are larger than the max angle with the default passes of the tool
+    for nlines, nvertices in ((200, 40), (2000, 60)):
+        xy, offsets = random_lines(nlines, nvertices)
+        new_xy = remove_big_turns(xy, offsets, 120)
+        assert np.array_equal(new_xy[offsets[:-1]], xy[offsets[:-1]])
+        assert np.array_equal(new_xy[offsets[1:] - 1], xy[offsets[1:] - 1])
+        assert np.all(line_angles(new_xy, offsets) >= 120)
+    print("Big turn checks passed")
+
+    xy, offsets = random_lines(5000, 60)
+    start = time.time()
+    loop_remove_big_turns(xy, offsets, 120)
+    t_loop = time.time() - start
+    start = time.time()
+    remove_big_turns(xy, offsets, 120)
+    t_array = time.time() - start
+    print("Big turns of %d lines (%d vertices): loop %.2f s, arrays %.2f s" % (len(offsets) - 1, len(xy), t_loop, t_array))
+
+    ##Resampling keeps the end points and the shape of straight lines
+    xy, offsets = random_lines(300, 30, seed = 1)
+    tolerance = np.random.RandomState(1).uniform(50, 400, len(offsets) - 1)
+    new_xy, new_offsets = resample_lines(xy, offsets, tolerance / 16)
+    assert np.allclose(new_xy[new_offsets[:-1]], xy[offsets[:-1]])
+    assert np.allclose(new_xy[new_offsets[1:] - 1], xy[offsets[1:] - 1])
+    line_xy = np.array([[0, 0], [10, 0], [35, 0], [100, 0]], dtype=float)
+    new_xy, new_offsets = resample_lines(line_xy, np.array([0, 4]), 7)
+    assert len(new_xy) == 16 and np.allclose(np.diff(new_xy[:, 0]), 100 / 15.0) and np.allclose(new_xy[:, 1], 0)
+    ##Smoothing keeps the end points and straight lines, and reduces the zigzag of a line
+    smoothed, new_offsets = smooth_lines(xy, offsets, tolerance)
+    assert np.allclose(smoothed[new_offsets[:-1]], xy[offsets[:-1]])
+    assert np.allclose(smoothed[new_offsets[1:] - 1], xy[offsets[1:] - 1])
+    smoothed, new_offsets = smooth_lines(line_xy, np.array([0, 4]), 30)
+    assert np.allclose(smoothed[:, 1], 0) and np.all(np.diff(smoothed[:, 0]) > 0)
+    zigzag = np.column_stack((np.arange(0, 1001, 10.0), np.tile([0.0, 20.0], 51)[:101]))
+    smoothed, new_offsets = smooth_lines(zigzag, np.array([0, 101]), 200)
+    assert np.abs(smoothed[20:-20, 1] - 10).max() < 1
+    ##A line with repeated vertices and a one-segment line
+    smoothed, new_offsets = smooth_lines(np.array([[0, 0], [0, 0], [5, 5], [8, 8]], dtype=float), np.array([0, 2, 4]), 100)
+    assert np.array_equal(new_offsets, [0, 2, 4]) and np.allclose(smoothed, [[0, 0], [0, 0], [5, 5], [8, 8]])
+    print("Smoothing checks passed")
+
+    ##The end point sampling is the bilinear interpolation of the cell centers
+    grid = np.arange(20.0).reshape(4, 5)
+    z = sample_grid(grid, 100.0, 200.0, 10.0, [[105, 195], [110, 190], [115, 185], [149, 161], [99, 195], [151, 195]])
+    assert np.allclose(z[:4], [0.0, 3.0, 6.0, 19.0]) and np.all(np.isnan(z[4:]))
+    grid[0, 1] = np.nan
+    assert np.allclose(sample_grid(grid, 100.0, 200.0, 10.0, [[109, 191]]), [0.0])
+    assert np.array_equal(lines_to_flip([5, 3, 4, np.nan], [4, 3, 5, 1]), [True, True, False, False])
+    ##The points far apart are sampled from small windows with the same values as from the whole grid
+    grid = np.random.RandomState(4).rand(2000, 3000)
+    grid[500:520, 700:720] = np.nan
+    points = np.random.RandomState(5).uniform([-50, -50], [30050, 20050], (400, 2))
+    points[:4] = [[0, 0], [30000, 20000], [0, 20000], [7100, 14900]] ##the corners and next to NoData
+    reads = []
+    def read_window(r0, r1, c0, c1):
+        reads.append((r1 - r0) * (c1 - c0))
+        return grid[r0:r1, c0:c1]
+    z = sample_grid_windows(read_window, grid.shape, 0.0, 20000.0, 10.0, points, 128)
+    assert np.allclose(z, sample_grid(grid, 0.0, 20000.0, 10.0, points), equal_nan=True)
+    assert max(reads) <= 130 * 130 and sum(reads) < grid.size / 4
+    print("Flip checks passed")
+
+    ##The stations are the positions along the lines at every spacing below the integer length, in the order
+    line_xy = np.array([[0, 0], [10, 0], [10, 0], [10, 25.5], [0, 0], [3, 4], [3, 4]], dtype=float)
+    stations, tangent, line, process = stations_along_lines(line_xy, np.array([0, 4, 7]), 10, [1, 0])
+    assert np.array_equal(line, [1, 0, 0, 0, 0]) and np.array_equal(process, [0, 1, 1, 1, 1])
+    assert np.allclose(stations, [[0, 0], [0, 0], [10, 0], [10, 10], [10, 20]])
+    assert np.allclose(tangent, [[0.6, 0.8], [1, 0], [0, 1], [0, 1], [0, 1]])
+    ##The parts of a multipart line are not joined
+    line_xy = np.array([[0, 0], [10, 0], [100, 0], [100, 25]], dtype=float)
+    stations, tangent, line, process = stations_along_lines(line_xy, np.array([0, 4]), 7, breaks = [False, False, True, False])
+    assert np.allclose(stations, [[0, 0], [7, 0], [100, 4], [100, 11], [100, 18]])
+    assert np.allclose(tangent, [[1, 0], [1, 0], [0, 1], [0, 1], [0, 1]])
+    xy, offsets = random_lines(300, 30, seed = 3)
+    stations, tangent, line, process = stations_along_lines(xy, offsets, 25)
+    for i in range(len(offsets) - 1):
+        arc = np.append(0, np.cumsum(np.hypot(*np.diff(xy[offsets[i]:offsets[i + 1]], axis=0).T)))
+        dist = np.arange(0, int(arc[-1]), 25)
+        assert np.allclose(stations[line == i, 0], np.interp(dist, arc, xy[offsets[i]:offsets[i + 1], 0]))
+        assert np.allclose(stations[line == i, 1], np.interp(dist, arc, xy[offsets[i]:offsets[i + 1], 1]))
+    assert np.allclose(np.hypot(tangent[:, 0], tangent[:, 1]), 1)
+    print("Station checks passed")
+
+    xy, offsets = random_lines(5000, 60)
+    tolerance = np.random.RandomState(2).uniform(200, 1000, len(offsets) - 1)
+    start = time.time()
+    smoothed, new_offsets = smooth_lines(xy, offsets, tolerance)
+    print("Smoothing of %d lines (%d vertices): %.2f s" % (len(offsets) - 1, len(smoothed), time.time() - start))
+    start = time.time()
+    stations, tangent, line, process = stations_along_lines(xy, offsets, 10)
+    print("Stations of %d lines at 10 m spacing (%d stations): %.2f s" % (len(offsets) - 1, len(stations), time.time() - start))
@@ -26,6 +26,10 @@ from scipy.optimize import curve_fit
 from scipy import optimize
 
 import matplotlib.pyplot as plt
+from LineGeometry import flip_lines_low_to_high, sample_grid
+from FlowCache import get_flow_products, invalidate_flow_cache
+from FlowRouting import flow_path_profiles, fdir_dtype, count_dtype
+from LeastCostPath import channel_heads
 
 
 arcpy.env.overwriteOutput = True
@@ -60,6 +64,27 @@ temp_workspace = "in_memory"
 if ArcGISPro:
     temp_workspace = "memory"
 
+##Source of the profiles: "lines" samples the DEM under the input profiles with InterpolateShape, and "fdir"
+##traces the profiles down the D8 flow direction of the filled DEM from the source cells (the input points, or
+##the upper end of each input line to its lower end, or the first cell at or below the elevation of the lower end
+##if the flow path passes by it), without the vector tracing and the re-interpolation. The traced profiles follow
+##the flow path, so the adjust profile option (b_AdjustProfile) is ignored in the "fdir" mode.
+ProfileTracing = "lines"
+
+##Contributing area (km2) of the channel heads used as the sources of the "fdir" profiles within the extent of
+##the input profiles; 0 uses the input points or lines as the sources
+ProfileHeadAreaKM2 = 0
+
+##Folder to cache the Fill/FlowDirection/FlowAccumulation products between runs ("" to disable the cache)
+##and the maximum size of the cache folder in GB, the routing backend ("arcpy" or "numpy") and the tile size
+##(cells) of the tiled NumPy routing, used by the "fdir" profiles. FlowCacheInvalidate removes the cached entries
+##of the input DEM before the run, i.e. when the DEM was edited in place and the fingerprint did not catch the change.
+FlowCacheFolder = ""
+FlowCacheMaxGB = 20
+FlowCacheInvalidate = False
+RoutingBackend = "arcpy"
+RoutingTileSize = 0
+
 # Polynomial Regression
 def polyfit(x, y, degree):
     results = {}
@@ -109,47 +134,94 @@ def Dist(x1,y1,x2,y2):
 # It is revised from the codes by Pellitero et al.(2016) in GlaRe.
 #------------------------------------------------------------------------------------------------------------
 def Check_If_Flip_Line_Direction(line, dem):
-    cellsize = arcpy.GetRasterProperties_management(dem,"CELLSIZEX")
-    cellsize_int = int(float(cellsize.getOutput(0)))
-
-    line3d = arcpy.env.scratchGDB + "\\line3d"
-    arcpy.AddField_management(line, "Flip", "Long", "", "", "", "", "", "", "")
-
-    arcpy.InterpolateShape_3d(dem, line, line3d, cellsize_int*3) 
+    ##Sample the DEM at the two end points of all lines in one lookup and reverse the lines in memory
+    flip_lines_low_to_high(line, dem)
 
-    flip_list = []
-    i = 0
-    with arcpy.da.SearchCursor(line3d,["Shape@"]) as cursor:
-        for row in cursor:
-            startZ = row[0].firstPoint.Z
-            endZ = row[0].lastPoint.Z
-
-            if startZ >= endZ:  ##Flip = True use equal in case the start and end point are the same
-                flip_list.append(1)
-            else:  ##Flip = False
-                flip_list.append(0)
-            i += 1 
-
-    del cursor
-    if i>0:
-        del row
-
-    if sum(flip_list) > 0:
-        with arcpy.da.UpdateCursor(line,["Flip"]) as cursor:
-            i = 0
+#------------------------------------------------------------------------------------------------------------
+# This function traces the profiles down the D8 flow direction from the source cells and writes the profiles
+# from low to high elevations to a 2D line feature class and to profile3D in the temp workspace with the
+# elevations of the filled DEM at the cell centers. The sources are the channel heads with the flow
+# accumulation larger than the threshold (cells) within the extent of the input features if the threshold is
+# larger than 0, otherwise the input points, or the upper end of each input line with the lower end as the target.
+#------------------------------------------------------------------------------------------------------------
+def Trace_Profiles_From_Flow_Direction(fillDEM, fdir, facc, inFeatures, head_threshold, outLines):
+    fdir = arcpy.Raster(fdir) if isinstance(fdir, str) else fdir
+    lower_left = arcpy.Point(fdir.extent.XMin, fdir.extent.YMin)
+    nrows, ncols = fdir.height, fdir.width
+    cellsize = fdir.meanCellWidth
+    xmin, ymax = fdir.extent.XMin, fdir.extent.YMax
+    fdirArr = arcpy.RasterToNumPyArray(fdir, lower_left, ncols, nrows, 0).astype(fdir_dtype, copy=False)
+    zArr = arcpy.RasterToNumPyArray(fillDEM, lower_left, ncols, nrows, np.nan).astype(np.float64)
+
+    desc = arcpy.Describe(inFeatures)
+    spatialref = desc.spatialReference
+    if head_threshold > 0:
+        faccArr = arcpy.RasterToNumPyArray(facc, lower_left, ncols, nrows, -1).astype(count_dtype(nrows * ncols), copy=False)
+        sources = channel_heads(fdirArr, faccArr, head_threshold)
+        ext = desc.extent
+        x = xmin + (sources % ncols + 0.5) * cellsize
+        y = ymax - (sources // ncols + 0.5) * cellsize
+        sources = sources[(x >= ext.XMin) & (x <= ext.XMax) & (y >= ext.YMin) & (y <= ext.YMax)]
+        targets = np.full(len(sources), -1, dtype=np.int64)
+        ids = np.arange(1, len(sources) + 1)
+    else:
+        ids = []
+        ends = []
+        id_field = "OID@"
+        if "ProfileID" in [f.baseName for f in arcpy.ListFields(inFeatures)]:
+            id_field = "ProfileID"
+        with arcpy.da.SearchCursor(inFeatures, [id_field, "SHAPE@"]) as cursor:
             for row in cursor:
-                row[0] = flip_list[i]
-                cursor.updateRow(row)
-                i += 1 
-        del row, cursor
-
-        arcpy.MakeFeatureLayer_management(line, "lyrLines")
-        arcpy.SelectLayerByAttribute_management("lyrLines", "NEW_SELECTION", '"Flip" > 0')
-        arcpy.FlipLine_edit("lyrLines")  ##Need to change to lyrLines
-        arcpy.SelectLayerByAttribute_management("lyrLines", "CLEAR_SELECTION")
-
-    arcpy.DeleteField_management (line, "Flip")
-    arcpy.Delete_management(line3d)
+                ids.append(row[0])
+                if desc.shapeType == "Point":
+                    ends.append([row[1].firstPoint.X, row[1].firstPoint.Y, row[1].firstPoint.X, row[1].firstPoint.Y])
+                else:
+                    ends.append([row[1].firstPoint.X, row[1].firstPoint.Y, row[1].lastPoint.X, row[1].lastPoint.Y])
+        ids = np.array(ids, dtype=np.int64)
+        ends = np.array(ends, dtype=np.float64).reshape(-1, 4)
+        ##The upper end is the source and the lower end is the target of each line
+        swap = sample_grid(zArr, xmin, ymax, cellsize, ends[:, 0:2]) < sample_grid(zArr, xmin, ymax, cellsize, ends[:, 2:4])
+        ends[swap] = ends[swap][:, [2, 3, 0, 1]]
+        rows = np.floor((ymax - ends[:, [1, 3]]) / cellsize).astype(np.int64)
+        cols = np.floor((ends[:, [0, 2]] - xmin) / cellsize).astype(np.int64)
+        inside = np.all((rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols), axis=1)
+        cells = rows * ncols + cols
+        sources = cells[inside, 0]
+        targets = np.where(cells[inside, 1] != sources, cells[inside, 1], -1) ##-1 for the points
+        ids = ids[inside]
+    keep = fdirArr.ravel()[sources] > 0
+    sources, targets, ids = sources[keep], targets[keep], ids[keep]
+
+    cells, dist, z, offsets = flow_path_profiles(fdirArr, zArr, sources, cellsize, targets)
+    missed = (targets >= 0) & (cells[np.maximum(offsets[1:] - 1, 0)] != targets)
+    if np.any(missed):
+        arcpy.AddMessage("The flow paths of " + str(np.count_nonzero(missed)) + " profile(s) do not pass the lower end of the line, and stop at the first cell at or below its elevation: " + ", ".join([str(i) for i in ids[missed]]))
+    x = xmin + (cells % ncols + 0.5) * cellsize
+    y = ymax - (cells // ncols + 0.5) * cellsize
+
+    arcpy.CreateFeatureclass_management(temp_workspace, "profile2D", "POLYLINE", "", "DISABLED", "DISABLED", spatialref)
+    arcpy.CreateFeatureclass_management(temp_workspace, "profile3D", "POLYLINE", "", "DISABLED", "ENABLED", spatialref)
+    for fc in (temp_workspace + "\\profile2D", temp_workspace + "\\profile3D"):
+        arcpy.AddField_management(fc, "ProfileID", "LONG", 10)
+    cursor2D = arcpy.da.InsertCursor(temp_workspace + "\\profile2D", ["SHAPE@", "ProfileID"])
+    cursor3D = arcpy.da.InsertCursor(temp_workspace + "\\profile3D", ["SHAPE@", "ProfileID"])
+    nprofiles = 0
+    for i in range(len(sources)):
+        if offsets[i + 1] - offsets[i] < 2:
+            continue
+        ##From the end (low) to the source (high)
+        px = x[offsets[i]:offsets[i + 1]][::-1]
+        py = y[offsets[i]:offsets[i + 1]][::-1]
+        pz = z[offsets[i]:offsets[i + 1]][::-1]
+        array2D = arcpy.Array([arcpy.Point(px[j], py[j]) for j in range(len(px))])
+        array3D = arcpy.Array([arcpy.Point(px[j], py[j], pz[j]) for j in range(len(px))])
+        cursor2D.insertRow([arcpy.Polyline(array2D, spatialref), int(ids[i])])
+        cursor3D.insertRow([arcpy.Polyline(array3D, spatialref, True), int(ids[i])])
+        nprofiles += 1
+    del cursor2D, cursor3D
+
+    arcpy.CopyFeatures_management(temp_workspace + "\\profile2D", outLines)
+    arcpy.AddMessage("The number of traced profiles is: " + str(nprofiles))
 
 
 ##Main program
@@ -173,7 +245,16 @@ cellsize_float = float(cellsize.getOutput(0)) # use float cell size
 
 arcpy.Delete_management(temp_workspace) ### Empty the in_memory
 
-if b_AdjustProfile: 
+if ProfileTracing == "fdir":
+    arcpy.AddMessage("Trace profiles down the flow direction...")
+    if FlowCacheInvalidate and FlowCacheFolder != "":
+        arcpy.AddMessage("Remove " + str(invalidate_flow_cache(FlowCacheFolder, InputDEM)) + " flow cache entries of the DEM")
+    if b_AdjustProfile:
+        arcpy.AddMessage("The traced profiles follow the flow direction; the adjust profile option is ignored")
+    fillDEM, fdir, facc = get_flow_products(InputDEM, FlowCacheFolder, FlowCacheMaxGB, "", "", RoutingBackend, RoutingTileSize)
+    head_threshold = ProfileHeadAreaKM2 * 1e6 / (cellsize_float * cellsize_float)
+    Trace_Profiles_From_Flow_Direction(fillDEM, fdir, facc, InputProfiles, head_threshold, OutputProfileMetrics)
+elif b_AdjustProfile: 
     ##Use the highest elevation to cut off the one do not overlap the lowest point
     arcpy.InterpolateShape_3d(InputDEM, InputProfiles, temp_workspace + "\\profile3D")
     try:
@@ -285,15 +366,18 @@ for field in new_fields:
         arcpy.AddField_management(OutputProfileMetrics, field, "DOUBLE",10, 4)
 
 
-##Check the direction and flip the length from low to high elevations
-arcpy.AddMessage("Check profile direction and flip it from low to high elevations if necessary...")
-Check_If_Flip_Line_Direction(OutputProfileMetrics, InputDEM)
+##Check the direction and flip the length from low to high elevations (the traced profiles are from low to high
+##and already have the elevations of the filled DEM)
+if ProfileTracing != "fdir":
+    arcpy.AddMessage("Check profile direction and flip it from low to high elevations if necessary...")
+    Check_If_Flip_Line_Direction(OutputProfileMetrics, InputDEM)
 
 
 
 arcpy.AddMessage("Derive profile metrics...")
 
-arcpy.InterpolateShape_3d(InputDEM, OutputProfileMetrics, temp_workspace + "\\profile3D") 
+if ProfileTracing != "fdir":
+    arcpy.InterpolateShape_3d(InputDEM, OutputProfileMetrics, temp_workspace + "\\profile3D") 
 
 FID_list = []
 HLHI_list = []
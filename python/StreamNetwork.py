@@ -0,0 +1,898 @@
+#-------------------------------------------------------------------------------
+# Name: StreamNetwork.py
+#
+# Purpose:
+# This module derives the stream network from the flow direction and flow accumulation
+# arrays without arcpy. The stream cells are traced along the D8 flow direction grid in the
+# topological order, each stream link (the stream section between two junctions) gets an ID,
+# and the junctions and outlets get node IDs, so that the links have the same grid_code,
+# from_node and to_node attributes as the outputs of the StreamLink and StreamToFeature tools
+# in ArcGIS. The vertices of all links are returned as one coordinate array with the offsets
+# of each link, and are only written to a feature class if needed. The maximum flow accumulation
+# of each link is derived with one labelled reduction over the link and accumulation arrays.
+#
+# Run this file directly to check the vectorizer and report the run time on synthetic DEMs.
+#
+# Author: Dr. Yingkui Li
+# Created:     11/07/2024-03/05/2025
+# Department of Geography, University of Tennessee
+# Knoxville, TN 37996
+#-------------------------------------------------------------------------------
+
+from __future__ import division
+import numpy as np
+import os, sys
+import time
+from collections import deque
+from scipy import ndimage
+from FlowRouting import d8_codes, d8_drow, d8_dcol, d8_index, flow_receivers, topological_order, fdir_dtype, label_dtype, count_dtype
+
+##The record of each stream link
+link_dtype = [('grid_code', np.int64), ('from_node', np.int64), ('to_node', np.int64)]
+##The record with the maximum flow accumulation of each link (the MAX field of ZonalStatisticsAsTable)
+link_max_dtype = link_dtype + [('MAX', np.float64)]
+
+#------------------------------------------------------------------------------------------------------------
+# This function traces the stream cells along the D8 flow direction and assigns an ID to each stream link, the
+# same as the StreamLink tool in ArcGIS. A new link starts at each source cell (no upstream stream cell) and
+# at each junction cell (two or more upstream stream cells); other stream cells continue the link of their
+# only upstream stream cell. It returns the link raster (0 for non-stream cells), the receivers of the cells,
+# and the topological order of the stream cells. The routing of all cells (stream_routing) can be provided to
+# reuse it for several stream masks of the same flow direction.
+#------------------------------------------------------------------------------------------------------------
+def stream_link_array(stream, fdir, routing = None):
+    nrows, ncols = fdir.shape
+    stream = (np.asarray(stream) > 0) & (fdir > 0)
+    isstream = stream.ravel()
+    if routing is None:
+        recv = flow_receivers(fdir)
+    else:
+        recv = routing[0].copy()
+    ##Only keep the flow between the stream cells (in place)
+    recv[~isstream] = -1
+    down = np.flatnonzero(recv >= 0)
+    recv[down[~isstream[recv[down]]]] = -1
+
+    has_recv = recv >= 0
+    ndonors = np.bincount(recv[has_recv], minlength=nrows * ncols)
+    donor = np.full(nrows * ncols, -1, dtype=np.int64)
+    donor[recv[has_recv]] = np.flatnonzero(has_recv) ##the only donor if a cell has one donor
+    heads = isstream & (ndonors != 1)
+
+    if routing is None:
+        order, wave_starts = topological_order(recv, isstream)
+    else:
+        ##The waves of all cells restricted to the stream cells: a stream cell is always in a later wave than
+        ##its upstream stream cells
+        all_order, all_waves = routing[1], routing[2]
+        keep = isstream[all_order]
+        order = all_order[keep]
+        wave = np.repeat(np.arange(len(all_waves)), np.diff(np.append(all_waves, len(all_order))))[keep]
+        wave_starts = np.flatnonzero(np.r_[True, wave[1:] != wave[:-1]]) if len(order) > 0 else np.zeros(0, dtype=np.int64)
+    link = np.zeros(nrows * ncols, dtype=label_dtype)
+    head_ids = np.flatnonzero(heads)
+    link[head_ids] = np.arange(1, len(head_ids) + 1)
+    wave_ends = np.append(wave_starts[1:], len(order))
+    for start, end in zip(wave_starts, wave_ends):
+        cells = order[start:end]
+        cells = cells[~heads[cells]]
+        link[cells] = link[donor[cells]]
+    return link.reshape(nrows, ncols), recv, order
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the receivers and the topological order (with the start of each wave) of all cells of
+# the flow direction, which are shared by the stream masks of different thresholds
+#------------------------------------------------------------------------------------------------------------
+def stream_routing(fdir):
+    recv = flow_receivers(fdir)
+    order, wave_starts = topological_order(recv, fdir.ravel() > 0)
+    return recv, order, wave_starts
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the from_node and to_node of each stream link. The node at the upstream end of a link
+# is the node of its head cell; a link ending at a junction shares the node of the junction with the other
+# links flowing into the junction and the link starting from it. The links flowing out of the area (or into
+# NoData) end at their own outlet node.
+#------------------------------------------------------------------------------------------------------------
+def link_topology(link, recv):
+    flat_link = link.ravel()
+    nlinks = int(flat_link.max()) if flat_link.size > 0 else 0
+    links = np.zeros(nlinks, dtype=link_dtype)
+    links['grid_code'] = np.arange(1, nlinks + 1)
+    links['from_node'] = np.arange(1, nlinks + 1)
+
+    ##The last cell of a link flows to a cell of another link or out of the stream network
+    cells = np.flatnonzero(flat_link > 0)
+    rv = recv[cells]
+    last = (rv < 0) | (flat_link[np.maximum(rv, 0)] != flat_link[cells])
+    last_cells = cells[last]
+    last_recv = rv[last]
+    ids = flat_link[last_cells] - 1
+    to_node = np.zeros(nlinks, dtype=np.int64)
+    joined = last_recv >= 0
+    to_node[ids[joined]] = flat_link[last_recv[joined]]
+    outlets = ids[~joined]
+    to_node[outlets] = nlinks + 1 + np.arange(len(outlets))
+    links['to_node'] = to_node
+    return links
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the vertices of each stream link in the flow direction: the cell centers of the link
+# and the center of the junction cell it flows into, so that the links are connected at the junctions. A link
+# flowing out of the stream network ends at the edge of its last cell in the flow direction, so that every link
+# has at least two vertices. If simplify is True, the vertices where the flow direction does not change are
+# removed. It returns the x, y coordinates of all vertices and the start offset of each link (the last offset
+# is the total number).
+#------------------------------------------------------------------------------------------------------------
+def link_vertices(link, recv, order, fdir, xmin = 0.0, ymax = 0.0, cellsize = 1.0, simplify = True):
+    nrows, ncols = link.shape
+    flat_link = link.ravel()
+    nlinks = int(flat_link.max()) if flat_link.size > 0 else 0
+
+    ##Sort the stream cells by link and then by the topological order (upstream first)
+    rank = np.zeros(nrows * ncols, dtype=count_dtype(nrows * ncols))
+    rank[order] = np.arange(len(order))
+    cells = order[flat_link[order] > 0]
+    cells = cells[np.lexsort((rank[cells], flat_link[cells]))]
+    cell_link = flat_link[cells]
+
+    ##The vertices in the units of half cells: (2 * row + 1, 2 * col + 1) is the center of a cell
+    rows2 = 2 * (cells // ncols) + 1
+    cols2 = 2 * (cells % ncols) + 1
+
+    ##Add the junction cell at the end of each link flowing into another link, or the edge of the last cell
+    starts = np.searchsorted(cell_link, np.arange(1, nlinks + 2))
+    last_cells = cells[starts[1:] - 1]
+    last_recv = recv[last_cells]
+    joined = last_recv >= 0
+    k = np.maximum(d8_index[fdir.ravel()[last_cells]], 0)
+    end_rows2 = np.where(joined, 2 * (last_recv // ncols) + 1, 2 * (last_cells // ncols) + 1 + d8_drow[k])
+    end_cols2 = np.where(joined, 2 * (last_recv % ncols) + 1, 2 * (last_cells % ncols) + 1 + d8_dcol[k])
+    pos = np.concatenate((np.arange(len(cells)), starts[1:] - 0.5))
+    all_rows2 = np.concatenate((rows2, end_rows2))
+    all_cols2 = np.concatenate((cols2, end_cols2))
+    all_link = np.concatenate((cell_link, np.arange(1, nlinks + 1)))
+    sorter = np.argsort(pos, kind="stable")
+    all_rows2 = all_rows2[sorter]
+    all_cols2 = all_cols2[sorter]
+    all_link = all_link[sorter]
+
+    if simplify and len(all_link) > 2:
+        ##Keep the first and last vertex of each link and the vertices where the direction changes
+        drow = np.diff(all_rows2)
+        dcol = np.diff(all_cols2)
+        same_link = all_link[1:] == all_link[:-1]
+        keep = np.ones(len(all_link), dtype=bool)
+        inner = same_link[:-1] & same_link[1:] & (drow[:-1] == drow[1:]) & (dcol[:-1] == dcol[1:])
+        keep[1:-1] = ~inner
+        all_rows2 = all_rows2[keep]
+        all_cols2 = all_cols2[keep]
+        all_link = all_link[keep]
+
+    xy = np.empty((len(all_link), 2))
+    xy[:, 0] = xmin + all_cols2 * 0.5 * cellsize
+    xy[:, 1] = ymax - all_rows2 * 0.5 * cellsize
+    offsets = np.searchsorted(all_link, np.arange(1, nlinks + 2))
+    return xy, offsets
+
+#------------------------------------------------------------------------------------------------------------
+# This function derives the maximum flow accumulation of each link from the link and flow accumulation arrays
+# with one labelled reduction (NaN for links without valid accumulation).
+#------------------------------------------------------------------------------------------------------------
+def link_max_accumulation(link, facc, nlinks):
+    if nlinks < 1:
+        return np.zeros(0)
+    facc = np.where(link > 0, facc, -np.inf)
+    maxfacc = np.asarray(ndimage.maximum(facc, link, np.arange(1, nlinks + 1)), dtype=np.float64)
+    maxfacc[~np.isfinite(maxfacc)] = np.nan
+    return maxfacc
+
+#------------------------------------------------------------------------------------------------------------
+# This function attaches the maximum flow accumulation to the link records as the MAX field
+#------------------------------------------------------------------------------------------------------------
+def add_link_max(links, link, facc):
+    out = np.zeros(len(links), dtype=link_max_dtype)
+    for name in links.dtype.names:
+        out[name] = links[name]
+    out['MAX'] = link_max_accumulation(link, facc, len(links))
+    return out
+
+#------------------------------------------------------------------------------------------------------------
+# This function vectorizes the stream network in one pass: stream links, node topology and link vertices. The
+# stream cells are the cells with stream > 0 (e.g. flow accumulation > threshold). The coordinates are based on
+# the upper left corner (xmin, ymax) and the cell size. If the flow accumulation is provided, the links also
+# have the MAX field. The routing of all cells (stream_routing) can be provided to reuse it for several stream
+# masks.
+#------------------------------------------------------------------------------------------------------------
+def vectorize_stream_links(stream, fdir, xmin = 0.0, ymax = 0.0, cellsize = 1.0, simplify = True, facc = None, routing = None):
+    link, recv, order = stream_link_array(stream, fdir, routing)
+    links = link_topology(link, recv)
+    if facc is not None:
+        links = add_link_max(links, link, facc)
+    xy, offsets = link_vertices(link, recv, order, fdir, xmin, ymax, cellsize, simplify)
+    return link, links, xy, offsets
+
+#------------------------------------------------------------------------------------------------------------
+# This function marks the tributary links for deletion at each junction (the links with the same to_node). The
+# links are sorted by to_node and flow accumulation once, and both rules are applied to each group with segment
+# reductions:
+# (1) threshold rule: the links with flow accumulation smaller than the tributary threshold are removed from the
+#     smallest one, but at least one link is kept at each junction;
+# (2) ratio rule: the links with a ratio of the flow accumulation to the total of the junction smaller than the
+#     tributary ratio are removed.
+# It returns the IDs of the links to delete.
+#------------------------------------------------------------------------------------------------------------
+def prune_tributaries(link_ids, to_node, facc, threshold, ratio):
+    link_ids = np.asarray(link_ids)
+    to_node = np.asarray(to_node)
+    facc = np.asarray(facc, dtype=np.float64)
+    n = len(link_ids)
+    if n < 2:
+        return np.zeros(0, dtype=link_ids.dtype)
+
+    ##Sort by to_node, then by flow accumulation (the original order for the ties)
+    order = np.lexsort((np.arange(n), facc, to_node))
+    node_sorted = to_node[order]
+    facc_sorted = facc[order]
+    starts = np.flatnonzero(np.r_[True, node_sorted[1:] != node_sorted[:-1]])
+    sizes = np.diff(np.r_[starts, n])
+    group = np.repeat(np.arange(len(starts)), sizes)
+    rank = np.arange(n) - starts[group]
+    junction = sizes[group] > 1
+
+    ##Threshold rule: the smaller links below the threshold, keeping the largest one
+    remove = junction & (facc_sorted < threshold) & (rank < sizes[group] - 1)
+
+    ##Ratio rule: the ratio to the total flow accumulation of all links at the junction
+    total = np.add.reduceat(facc_sorted, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fccratio = facc_sorted / total[group]
+    remove |= junction & (fccratio < float(ratio))
+
+    return np.unique(link_ids[order[remove]])
+
+#------------------------------------------------------------------------------------------------------------
+# This function finds the dangling links after the pruning: a link is dangling if no remaining link starts from
+# its to_node and it is not the link with the highest flow accumulation (the main outlet). Removing a dangling
+# link can make the links flowing into its from_node dangling, so the links are trimmed from the leaves with a
+# queue on the node degrees, in one pass over the links. It returns the IDs of the links to delete.
+#------------------------------------------------------------------------------------------------------------
+def trim_dangling_links(link_ids, from_node, to_node, facc):
+    link_ids = np.asarray(link_ids)
+    n = len(link_ids)
+    if n < 1:
+        return np.zeros(0, dtype=link_ids.dtype)
+    facc = np.asarray(facc)
+    maxfacc = facc.max()
+    nodes, inv = np.unique(np.concatenate((from_node, to_node)), return_inverse=True)
+    from_idx = inv[:n]
+    to_idx = inv[n:]
+
+    ##The number of links starting from each node and the links ending at each node (CSR)
+    node_out = np.bincount(from_idx, minlength=len(nodes))
+    in_links = np.argsort(to_idx, kind="stable")
+    in_starts = np.searchsorted(to_idx[in_links], np.arange(len(nodes) + 1))
+
+    removable = facc < maxfacc
+    queue = deque(np.flatnonzero(removable & (node_out[to_idx] == 0)).tolist())
+    node_out = node_out.tolist()
+    in_links = in_links.tolist()
+    in_starts = in_starts.tolist()
+    removable = removable.tolist()
+    from_idx = from_idx.tolist()
+    deleted = np.zeros(n, dtype=bool)
+    while queue:
+        i = queue.popleft()
+        deleted[i] = True
+        node = from_idx[i]
+        node_out[node] -= 1
+        if node_out[node] == 0: ##the links flowing into this node become dangling
+            for j in in_links[in_starts[node]:in_starts[node + 1]]:
+                if removable[j]:
+                    queue.append(j)
+    return link_ids[deleted]
+
+#------------------------------------------------------------------------------------------------------------
+# The stream network graph is a dictionary of arrays: the link records (grid_code, from_node, to_node and MAX),
+# the vertices of the links (xy and offsets), the node IDs and the node index of the two ends of each link, and
+# the upstream and downstream adjacency of the nodes in the CSR format: the links ending at node k are
+# up_links[up_starts[k]:up_starts[k+1]] and the links starting from node k are
+# down_links[down_starts[k]:down_starts[k+1]]. The graph is built once from the stream links and passed through
+# the pruning, cleaning and dissolving steps, so that the geometry is only written at the end.
+#------------------------------------------------------------------------------------------------------------
+def csr_adjacency(node_idx, nnodes):
+    links = np.argsort(node_idx, kind="stable")
+    starts = np.searchsorted(node_idx[links], np.arange(nnodes + 1))
+    return starts, links
+
+def stream_graph(links, xy, offsets):
+    n = len(links)
+    nodes, inv = np.unique(np.concatenate((links['from_node'], links['to_node'])), return_inverse=True)
+    from_idx = inv[:n]
+    to_idx = inv[n:]
+    up_starts, up_links = csr_adjacency(to_idx, len(nodes))
+    down_starts, down_links = csr_adjacency(from_idx, len(nodes))
+    return {"links": links, "xy": xy, "offsets": np.asarray(offsets, dtype=np.int64), "nodes": nodes,
+            "from_idx": from_idx, "to_idx": to_idx, "up_starts": up_starts, "up_links": up_links,
+            "down_starts": down_starts, "down_links": down_links}
+
+#------------------------------------------------------------------------------------------------------------
+# This function builds the stream network graph of the stream cells with flow accumulation larger than each
+# threshold. The stream cells of a higher threshold are a subset of the stream cells of a lower threshold, so the
+# cells of each threshold are taken from the cells of the threshold before it (the thresholds are processed from
+# low to high), and one boolean stream mask is reused for all thresholds. The receivers and the topological order
+# of the cells are derived once for all thresholds.
+#------------------------------------------------------------------------------------------------------------
+def stream_graphs_from_arrays(fdir, facc, thresholds, xmin = 0.0, ymax = 0.0, cellsize = 1.0, simplify = True):
+    graphs = [None] * len(thresholds)
+    routing = stream_routing(fdir) if len(thresholds) > 1 else None
+    flat_facc = facc.ravel()
+    cells = np.flatnonzero(flat_facc > min(thresholds)) if len(thresholds) > 0 else np.zeros(0, dtype=np.int64)
+    stream = np.zeros(facc.shape, dtype=bool)
+    for k in np.argsort(thresholds, kind="stable"):
+        cells = cells[flat_facc[cells] > thresholds[k]]
+        stream[:] = False
+        stream.ravel()[cells] = True
+        link, links, xy, offsets = vectorize_stream_links(stream, fdir, xmin, ymax, cellsize, simplify, facc, routing)
+        graphs[k] = stream_graph(links, xy, offsets)
+    return graphs
+
+#------------------------------------------------------------------------------------------------------------
+# This function returns the graph of the links with keep = True (with their vertices)
+#------------------------------------------------------------------------------------------------------------
+def subset_stream_graph(graph, keep):
+    counts = np.diff(graph["offsets"])
+    offsets = np.zeros(np.count_nonzero(keep) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts[keep])
+    return stream_graph(graph["links"][keep], graph["xy"][np.repeat(keep, counts)], offsets)
+
+#------------------------------------------------------------------------------------------------------------
+# This function prunes the tributaries of the graph with the threshold and ratio rules (prune_tributaries) and
+# then trims the dangling links (trim_dangling_links), the same as deleting the lines from the stream feature
+# class and cleaning the extra lines. It returns the graph of the remaining links.
+#------------------------------------------------------------------------------------------------------------
+def prune_stream_graph(graph, threshold, ratio):
+    links = graph["links"]
+    remove = prune_tributaries(links['grid_code'], links['to_node'], links['MAX'], threshold, ratio)
+    graph = subset_stream_graph(graph, ~np.isin(links['grid_code'], remove))
+    links = graph["links"]
+    remove = trim_dangling_links(links['grid_code'], links['from_node'], links['to_node'], links['MAX'])
+    return subset_stream_graph(graph, ~np.isin(links['grid_code'], remove))
+
+#------------------------------------------------------------------------------------------------------------
+# This function dissolves the links of the graph into streamlines, the same as the Dissolve tool with the MAX
+# statistics of the MAX field and the SINGLE_PART and UNSPLIT_LINES options: the links are joined at the nodes
+# with only one link flowing in and one link flowing out. The streamlines keep the flow direction. It returns
+# the streamline records (Max_Max), the vertices and the offsets.
+#------------------------------------------------------------------------------------------------------------
+line_max_dtype = [('Max_Max', np.float64)]
+
+def dissolve_stream_graph(graph):
+    links = graph["links"]
+    n = len(links)
+    if n < 1:
+        return np.zeros(0, dtype=line_max_dtype), np.zeros((0, 2)), np.zeros(1, dtype=np.int64)
+    from_idx = graph["from_idx"]
+    to_idx = graph["to_idx"]
+    pseudo = (np.diff(graph["up_starts"]) == 1) & (np.diff(graph["down_starts"]) == 1)
+
+    ##The next link of each link in its streamline (-1 at the end of the streamline)
+    nxt = np.full(n, -1, dtype=np.int64)
+    joined = pseudo[to_idx]
+    nxt[joined] = graph["down_links"][graph["down_starts"][to_idx[joined]]]
+    heads = np.flatnonzero(~pseudo[from_idx])
+    nxt = nxt.tolist()
+    chain = []
+    line_starts = []
+    for head in heads.tolist():
+        line_starts.append(len(chain))
+        i = head
+        while i >= 0:
+            chain.append(i)
+            i = nxt[i]
+    chain = np.array(chain, dtype=np.int64)
+    line_starts = np.array(line_starts, dtype=np.int64)
+
+    ##Join the vertices of the links (the first vertex of a joined link is the last vertex of the link before it)
+    first = np.zeros(len(chain), dtype=bool)
+    first[line_starts] = True
+    offsets = graph["offsets"]
+    starts = offsets[chain] + np.where(first, 0, 1)
+    counts = offsets[chain + 1] - starts
+    ends = np.cumsum(counts)
+    idx = np.arange(ends[-1]) + np.repeat(starts - (ends - counts), counts)
+    xy = graph["xy"][idx]
+    line_offsets = np.zeros(len(line_starts) + 1, dtype=np.int64)
+    line_offsets[1:] = ends[np.r_[line_starts[1:], len(chain)] - 1]
+
+    lines = np.zeros(len(line_starts), dtype=line_max_dtype)
+    lines['Max_Max'] = np.maximum.reduceat(links['MAX'][chain], line_starts)
+    return lines, xy, line_offsets
+
+#------------------------------------------------------------------------------------------------------------
+# These functions save and load the records, vertices and offsets of the links (or streamlines) in a .npz file,
+# i.e. the stage outputs of a valley that are reused if only the later parameters change.
+#------------------------------------------------------------------------------------------------------------
+def save_stream_arrays(path, records, xy, offsets):
+    np.savez(path, records=records, xy=xy, offsets=offsets)
+    return path
+
+def load_stream_arrays(path):
+    with np.load(path) as data:
+        return data["records"], data["xy"], data["offsets"]
+
+#------------------------------------------------------------------------------------------------------------
+# This function finds the lines that each point lies on, with a spatial index (cKDTree) over the densified
+# vertices of the lines instead of testing every point against every line. The lines are given as a list of
+# parts (arrays of x, y vertices) and the line index of each part. The candidate segments near each point are
+# checked with the exact point to segment distance. It returns the pairs of the point index and line index.
+#------------------------------------------------------------------------------------------------------------
+def points_on_lines(points, parts, owner, tol = 0.01):
+    from scipy.spatial import cKDTree
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    seg_a = []
+    seg_b = []
+    seg_line = []
+    for part, line in zip(parts, owner):
+        part = np.asarray(part, dtype=np.float64).reshape(-1, 2)
+        if len(part) == 1: ##a single vertex is a segment of zero length
+            part = np.vstack((part, part))
+        seg_a.append(part[:-1])
+        seg_b.append(part[1:])
+        seg_line.append(np.full(len(part) - 1, line, dtype=np.int64))
+    if len(seg_a) < 1 or len(points) < 1:
+        return np.zeros((0, 2), dtype=np.int64)
+    seg_a = np.concatenate(seg_a)
+    seg_b = np.concatenate(seg_b)
+    seg_line = np.concatenate(seg_line)
+
+    ##Densify the segments so that any point on a segment is close to one of the densified vertices
+    seg_len = np.hypot(seg_b[:, 0] - seg_a[:, 0], seg_b[:, 1] - seg_a[:, 1])
+    spacing = max(float(np.median(seg_len)), tol * 10.0)
+    nsub = np.maximum(np.ceil(seg_len / spacing).astype(np.int64), 1)
+    seg_id = np.repeat(np.arange(len(seg_a)), nsub + 1)
+    first = np.repeat(np.cumsum(nsub + 1) - (nsub + 1), nsub + 1)
+    t = (np.arange(len(seg_id)) - first) / nsub[seg_id].astype(np.float64)
+    dense = seg_a[seg_id] + (seg_b[seg_id] - seg_a[seg_id]) * t[:, None]
+
+    tree = cKDTree(dense)
+    near = tree.query_ball_point(points, spacing / 2.0 + tol)
+    pt_idx = np.repeat(np.arange(len(points)), [len(n) for n in near])
+    if len(pt_idx) < 1:
+        return np.zeros((0, 2), dtype=np.int64)
+    cand = np.unique(pt_idx * len(seg_a) + seg_id[np.concatenate(near).astype(np.int64)])
+    pt_idx = cand // len(seg_a)
+    seg = cand % len(seg_a)
+
+    ##The exact distance from the points to the candidate segments
+    a = seg_a[seg]
+    d = seg_b[seg] - a
+    p = points[pt_idx] - a
+    dd = np.sum(d * d, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(dd > 0, np.clip(np.sum(p * d, axis=1) / dd, 0.0, 1.0), 0.0)
+    dist = np.hypot(p[:, 0] - t * d[:, 0], p[:, 1] - t * d[:, 1])
+    on = dist <= tol
+    pairs = np.unique(np.column_stack((pt_idx[on], seg_line[seg[on]])), axis=0)
+    return pairs.reshape(-1, 2)
+
+#------------------------------------------------------------------------------------------------------------
+# This function assigns the ValleyID and MergeID of the streamlines (from low to high) with one traversal of the
+# topology graph from the outlet lines. The start point of each line either touches (the end points) or lies
+# within another line; the lines whose start points are not on other lines are the outlets and start the
+# ValleyIDs. The other lines are assigned in the same order as the passes of the original algorithm (the lines
+# with larger flow accumulation first in each pass), which are simulated by a priority queue of (pass, rank):
+# a line takes the ValleyID of the first assigned line (in the order of assignment) its start point is on. A
+# line starting at the end of that line continues its MergeID if no other line has continued it yet; other lines
+# start new MergeIDs.
+#------------------------------------------------------------------------------------------------------------
+def assign_valley_ids(nlines, facc, pairs, touches):
+    import heapq
+
+    valley_ID = np.full(nlines, -1, dtype=np.int64)
+    mergeid = np.full(nlines, -1, dtype=np.int64)
+    if nlines < 1:
+        return valley_ID, mergeid
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    touches = np.asarray(touches, dtype=bool)
+    keep = pairs[:, 0] != pairs[:, 1] ##a line does not touch itself
+    pairs = pairs[keep]
+    touches = touches[keep]
+
+    ##The lines that each line starts on, and the lines that start on each line
+    on_lines = [[] for i in range(nlines)]
+    dependents = [[] for i in range(nlines)]
+    for (i, a), touch in zip(pairs.tolist(), touches.tolist()):
+        on_lines[i].append((a, touch))
+        dependents[a].append(i)
+
+    ids = np.argsort(np.asarray(facc))[::-1]
+    rank = np.zeros(nlines, dtype=np.int64)
+    rank[ids] = np.arange(nlines)
+    rank = rank.tolist()
+
+    position = [-1] * nlines ##the position of each assigned line in the order of assignment
+    mergeused = [] ##if the MergeID of the line at each position has been continued
+    maxmerge = -1
+    iceId = 0
+    heap = []
+    queued = [False] * nlines
+    ##The outlet lines
+    for i in range(nlines):
+        if len(on_lines[i]) == 0:
+            valley_ID[i] = iceId
+            mergeid[i] = iceId
+            maxmerge = max(maxmerge, iceId)
+            position[i] = len(mergeused)
+            mergeused.append(0)
+            iceId += 1
+    for i in range(nlines):
+        if position[i] >= 0:
+            for j in dependents[i]:
+                if position[j] < 0 and not queued[j]:
+                    heapq.heappush(heap, (0, rank[j], j))
+                    queued[j] = True
+
+    while heap:
+        npass, r, i = heapq.heappop(heap)
+        ##The first assigned line that this line starts on
+        best = None
+        for a, touch in on_lines[i]:
+            if position[a] >= 0 and (best is None or position[a] < position[best[0]]):
+                best = (a, touch)
+        a, touch = best
+        valley_ID[i] = valley_ID[a]
+        if touch and mergeused[position[a]] == 0:
+            mergeid[i] = mergeid[a]
+            mergeused[position[a]] = 1
+        else:
+            maxmerge += 1
+            mergeid[i] = maxmerge
+        position[i] = len(mergeused)
+        mergeused.append(0)
+        ##The lines starting on this line can be assigned later in this pass or in the next pass
+        for j in dependents[i]:
+            if position[j] < 0 and not queued[j]:
+                heapq.heappush(heap, (npass if rank[j] > r else npass + 1, rank[j], j))
+                queued[j] = True
+
+    ##The lines that are not connected to any outlet start new ValleyIDs
+    for i in np.flatnonzero(valley_ID < 0):
+        valley_ID[i] = iceId
+        maxmerge += 1
+        mergeid[i] = maxmerge
+        iceId += 1
+    return valley_ID, mergeid
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function writes the stream links to a polyline feature class with the grid_code, from_node
+# and to_node fields (the same as the output of StreamToFeature) and the MAX field if the links have it. The
+# links with less than two vertices are skipped. All links are inserted with one cursor.
+#------------------------------------------------------------------------------------------------------------
+def links_to_features(workspace, name, links, xy, offsets, spatial_ref):
+    import arcpy
+
+    out_fc = arcpy.CreateFeatureclass_management(workspace, name, "POLYLINE", "", "", "", spatial_ref)
+    fields = list(links.dtype.names)
+    for field in fields:
+        if links.dtype[field].kind == 'f':
+            arcpy.AddField_management(out_fc, field, "DOUBLE")
+        else:
+            arcpy.AddField_management(out_fc, field, "LONG")
+    with arcpy.da.InsertCursor(out_fc, ['SHAPE@'] + fields) as cursor:
+        for i in range(len(links)):
+            pts = xy[offsets[i]:offsets[i+1]]
+            if len(pts) < 2:
+                continue
+            line = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in pts.tolist()]), spatial_ref)
+            cursor.insertRow([line] + links[i].tolist())
+    del cursor
+    return workspace + "\\" + name
+
+#------------------------------------------------------------------------------------------------------------
+# ArcGIS bridge: This function adds the maximum flow accumulation of each link to the MAX field of a stream
+# feature class with the grid_code field (e.g. the output of StreamToFeature), based on the link and flow
+# accumulation rasters. It replaces ZonalStatisticsAsTable and JoinField without writing a table.
+#------------------------------------------------------------------------------------------------------------
+def join_link_max(stream_fc, linkRaster, facc):
+    import arcpy
+
+    linkRaster = arcpy.Raster(linkRaster) if isinstance(linkRaster, str) else linkRaster
+    lower_left = arcpy.Point(linkRaster.extent.XMin, linkRaster.extent.YMin)
+    linkArr = arcpy.RasterToNumPyArray(linkRaster, lower_left, linkRaster.width, linkRaster.height, 0).astype(label_dtype, copy=False)
+    faccArr = arcpy.RasterToNumPyArray(facc, lower_left, linkRaster.width, linkRaster.height, -1)
+    nlinks = int(linkArr.max()) if linkArr.size > 0 else 0
+    maxfacc = link_max_accumulation(linkArr, faccArr, nlinks)
+
+    arcpy.AddField_management(stream_fc, "MAX", "DOUBLE")
+    with arcpy.da.UpdateCursor(stream_fc, ["grid_code", "MAX"]) as cursor:
+        for row in cursor:
+            if row[0] >= 1 and row[0] <= nlinks:
+                row[1] = maxfacc[row[0] - 1]
+                cursor.updateRow(row)
+    del cursor
+    return stream_fc
+
+#------------------------------------------------------------------------------------------------------------
+# The functions below check the vectorizer and report the run time on synthetic DEMs
+#------------------------------------------------------------------------------------------------------------
+def check_links(fdir, facc, threshold):
+    stream = facc > threshold
+    link, links, xy, offsets = vectorize_stream_links(stream, fdir, simplify = False)
+    nlinks = len(links)
+    ##Every stream cell belongs to one link and each link is a connected chain of cells
+    assert np.all((link > 0) == (stream & (fdir > 0)))
+    assert np.array_equal(np.unique(link[link > 0]), np.arange(1, nlinks + 1))
+    cell_counts = np.bincount(link.ravel(), minlength=nlinks + 1)[1:]
+    joined = links['to_node'] <= nlinks
+    assert np.array_equal(np.diff(offsets), cell_counts + 1)
+    ##The to_node of a link is the from_node of the link downstream; two or more links meet at each junction
+    junctions, counts = np.unique(links['to_node'][joined], return_counts=True)
+    assert np.all(counts >= 2)
+    assert np.all(np.isin(junctions, links['from_node']))
+    ##Consecutive vertices are neighbor cells (or the edge of the last cell of a link flowing out)
+    steps = np.abs(np.diff(xy, axis=0)).max(axis=1)
+    same_link = np.ones(len(xy) - 1, dtype=bool)
+    same_link[offsets[1:-1] - 1] = False
+    out_steps = np.zeros(len(xy) - 1, dtype=bool)
+    out_steps[offsets[1:][~joined] - 2] = True
+    assert np.all(steps[same_link & ~out_steps] == 1) and np.all(steps[out_steps] == 0.5)
+    ##The simplified links keep the end points
+    slink, slinks, sxy, soffsets = vectorize_stream_links(stream, fdir, simplify = True)
+    assert np.array_equal(sxy[soffsets[:-1]], xy[offsets[:-1]])
+    assert np.array_equal(sxy[soffsets[1:] - 1], xy[offsets[1:] - 1])
+    ##The MAX field is the maximum flow accumulation of the cells of each link
+    mlink, mlinks, mxy, moffsets = vectorize_stream_links(stream, fdir, simplify = False, facc = facc)
+    for i in range(0, nlinks, max(1, nlinks // 20)):
+        assert mlinks['MAX'][i] == facc[link == i + 1].max()
+    return links
+
+def loop_prune_tributaries(lineArray, TributaryThreshold, TributaryRatio):
+    ##The original pruning loops of streamline_from_Stream_Network, used to check prune_tributaries
+    tonode = np.array([item[1] for item in lineArray])
+    uniquenode = np.unique(tonode)
+    lineid = []
+    for i in range(len(uniquenode)):
+        selArr = lineArray[tonode == uniquenode[i]]
+        fcclist = []
+        if len(selArr) > 1:
+            for j in range(len(selArr)):
+                fcclist.append(selArr[j][2])
+            numselected = len(fcclist)
+            while numselected > 1:
+                minfcc = min(fcclist)
+                if minfcc < TributaryThreshold:
+                    for j in range(len(selArr)):
+                        if selArr[j][2] == minfcc:
+                            lineid.append(selArr[j][0])
+                            fcclist.pop(j)
+                            selArr = np.delete(selArr, j)
+                            numselected = len(selArr)
+                            break
+                else:
+                    break
+    for i in range(len(uniquenode)):
+        selArr = lineArray[tonode == uniquenode[i]]
+        fcclist = []
+        if len(selArr) > 1:
+            for j in range(len(selArr)):
+                fcclist.append(selArr[j][2])
+            sumfcc = sum(fcclist)
+            fccratio = [x / float(sumfcc) for x in fcclist]
+            for j in range(len(fccratio)):
+                if fccratio[j] < float(TributaryRatio):
+                    lineid.append(selArr[j][0])
+    return np.unique(np.array(lineid, dtype=np.int64))
+
+def loop_trim_dangling_links(link_ids, from_node, to_node, facc):
+    ##The original iterative loop of cleanextralineswithtopology, used to check trim_dangling_links
+    keep = np.ones(len(link_ids), dtype=bool)
+    bflag = 1
+    while bflag:
+        bflag = 0
+        fromnode = from_node[keep]
+        maxfacc = max(facc[keep])
+        for i in np.flatnonzero(keep):
+            if not (to_node[i] in fromnode) and facc[i] < maxfacc:
+                keep[i] = False
+                bflag = 1
+    return link_ids[~keep]
+
+def loop_assign_valley_ids(lines, facc, tol = 0.01):
+    ##The original loops of Merge_and_Add_ValleyID_by_Topology with the point on line tests, used to check
+    ##assign_valley_ids
+    def on_line(pt, line):
+        if len(line) == 1:
+            line = np.vstack((line, line))
+        a = line[:-1]
+        d = line[1:] - a
+        p = pt - a
+        dd = np.maximum(np.sum(d * d, axis=1), 1e-12)
+        t = np.clip(np.sum(p * d, axis=1) / dd, 0.0, 1.0)
+        return np.min(np.hypot(p[:, 0] - t * d[:, 0], p[:, 1] - t * d[:, 1])) <= tol
+    def touches(pt, line):
+        return min(np.hypot(*(line[0] - pt)), np.hypot(*(line[-1] - pt))) <= tol
+    n = len(lines)
+    valley_ID = [-1] * n
+    mergeid = [-1] * n
+    mergeused = [0] * n
+    valleys = []
+    idlist = []
+    mergidlist = []
+    ids = np.argsort(np.asarray(facc))[::-1]
+    iceId = 0
+    for i in range(n):
+        if not any([on_line(lines[i][0], lines[a]) for a in range(n) if a != i]):
+            valleys.append(i)
+            idlist.append(iceId)
+            valley_ID[i] = iceId
+            mergeid[i] = iceId
+            mergidlist.append(iceId)
+            iceId += 1
+    leftover = n - len(valleys)
+    while leftover > 0:
+        last_leftover = leftover
+        for i in range(n):
+            lineid = ids[i]
+            if mergeid[lineid] == -1:
+                pt = lines[lineid][0]
+                for a in range(len(valleys)):
+                    line = lines[valleys[a]]
+                    if not on_line(pt, line) or valley_ID[lineid] != -1:
+                        continue
+                    valley_ID[lineid] = idlist[a]
+                    valleys.append(lineid)
+                    idlist.append(idlist[a])
+                    if touches(pt, line) and mergeused[a] == 0:
+                        mergeid[lineid] = mergidlist[a]
+                        mergidlist.append(mergidlist[a])
+                        mergeused[a] = 1
+                    else:
+                        mergeid[lineid] = max(mergidlist) + 1
+                        mergidlist.append(max(mergidlist) + 1)
+            leftover = n - len(valleys)
+        if leftover == last_leftover: ##the lines not connected to any outlet
+            break
+    return np.array(valley_ID), np.array(mergeid)
+
+def loop_dissolve_links(links, xy, offsets):
+    ##Join two lines at a time at the nodes where only one line ends and one line starts
+    lines = [[int(l['from_node']), int(l['to_node']), xy[offsets[i]:offsets[i+1]].tolist(), l['MAX']] for i, l in enumerate(links)]
+    merged = True
+    while merged:
+        merged = False
+        for a in lines:
+            ins = [l for l in lines if l[1] == a[1]]
+            outs = [l for l in lines if l[0] == a[1]]
+            if len(ins) == 1 and len(outs) == 1:
+                b = outs[0]
+                a[1] = b[1]
+                a[2] = a[2] + b[2][1:]
+                a[3] = max(a[3], b[3])
+                lines.remove(b)
+                merged = True
+                break
+    return sorted([(tuple(map(tuple, l[2])), l[3]) for l in lines])
+
+def check_stream_graph(fdir, facc, threshold, tributary_threshold, ratio):
+    link, links, xy, offsets = vectorize_stream_links(facc > threshold, fdir, facc = facc)
+    graph = stream_graph(links, xy, offsets)
+    ##The CSR adjacency lists each link once as upstream of its to_node and downstream of its from_node
+    assert np.array_equal(np.sort(graph["up_links"]), np.arange(len(links)))
+    for k in range(0, len(graph["nodes"]), max(1, len(graph["nodes"]) // 50)):
+        up = graph["up_links"][graph["up_starts"][k]:graph["up_starts"][k+1]]
+        assert np.all(links['to_node'][up] == graph["nodes"][k])
+        down = graph["down_links"][graph["down_starts"][k]:graph["down_starts"][k+1]]
+        assert np.all(links['from_node'][down] == graph["nodes"][k])
+    ##Pruning the graph is the same as pruning and cleaning the link records
+    pruned = prune_stream_graph(graph, tributary_threshold, ratio)
+    remove = prune_tributaries(links['grid_code'], links['to_node'], links['MAX'], tributary_threshold, ratio)
+    sel = links[~np.isin(links['grid_code'], remove)]
+    remove = trim_dangling_links(sel['grid_code'], sel['from_node'], sel['to_node'], sel['MAX'])
+    assert np.array_equal(pruned["links"], sel[~np.isin(sel['grid_code'], remove)])
+    ##The dissolved streamlines are the same as joining the links two at a time
+    lines, lxy, loffsets = dissolve_stream_graph(pruned)
+    result = sorted([(tuple(map(tuple, lxy[loffsets[i]:loffsets[i+1]].tolist())), lines['Max_Max'][i]) for i in range(len(lines))])
+    assert result == loop_dissolve_links(pruned["links"], pruned["xy"], pruned["offsets"])
+    return pruned
+
+def streamlines_low_to_high(links, xy, offsets, seed = 0):
+    ##Reverse the stream links (from low to high) and merge some links with one upstream link, so that the
+    ##start points of the other upstream links are within the merged lines
+    rng = np.random.RandomState(seed)
+    lines = [xy[offsets[i]:offsets[i+1]][::-1] for i in range(len(links))]
+    facc = links['MAX'].copy()
+    merged = np.zeros(len(links), dtype=bool)
+    for i in rng.permutation(len(links)):
+        up = np.flatnonzero((links['to_node'] == links['from_node'][i]) & ~merged)
+        if len(up) > 1 and not merged[i] and rng.rand() < 0.5:
+            j = up[0]
+            lines[i] = np.vstack((lines[i], lines[j][1:]))
+            merged[j] = True
+    keep = np.flatnonzero(~merged)
+    return [lines[i] for i in keep], facc[keep]
+
+def topology_valley_ids(lines, facc, tol = 0.01):
+    starts = np.array([line[0] for line in lines])
+    pairs = points_on_lines(starts, lines, np.arange(len(lines)), tol)
+    first = np.array([line[0] for line in lines])[pairs[:, 1]]
+    last = np.array([line[-1] for line in lines])[pairs[:, 1]]
+    pts = starts[pairs[:, 0]]
+    touches = (np.hypot(*(first - pts).T) <= tol) | (np.hypot(*(last - pts).T) <= tol)
+    return assign_valley_ids(len(lines), facc, pairs, touches)
+
+def random_links(n, seed = 0):
+    rng = np.random.RandomState(seed)
+    lineArray = np.zeros(n, dtype=[('OID', np.int64), ('to_node', np.int64), ('MAX', np.float64)])
+    lineArray['OID'] = np.arange(1, n + 1)
+    lineArray['to_node'] = rng.randint(1, n // 2 + 2, n)
+    lineArray['MAX'] = rng.randint(1, 2000, n).astype(np.float64)
+    return lineArray
+
+if __name__ == '__main__':
+    from FlowRouting import synthetic_dem, d8_routing
+    for nodata_hole in (False, True):
+        filled, fdir, facc = d8_routing(synthetic_dem(120, 150, seed = 3, nodata_hole = nodata_hole))
+        check_links(fdir, facc, 50)
+    print("Stream link checks passed")
+
+    for seed in range(5):
+        lineArray = random_links(3000, seed)
+        expected = loop_prune_tributaries(lineArray, 500, 0.05)
+        result = prune_tributaries(lineArray['OID'], lineArray['to_node'], lineArray['MAX'], 500, 0.05)
+        assert np.array_equal(result, expected)
+    print("Tributary pruning checks passed")
+
+    filled, fdir, facc = d8_routing(synthetic_dem(200, 200, seed = 5))
+    link, links, xy, offsets = vectorize_stream_links(facc > 20, fdir, facc = facc)
+    rng = np.random.RandomState(5)
+    for i in range(5):
+        sel = links[rng.rand(len(links)) > 0.2] ##random pruning creates dangling links
+        expected = loop_trim_dangling_links(sel['grid_code'], sel['from_node'], sel['to_node'], sel['MAX'])
+        result = trim_dangling_links(sel['grid_code'], sel['from_node'], sel['to_node'], sel['MAX'])
+        assert np.array_equal(np.sort(result), np.sort(expected))
+    print("Dangling link checks passed")
+
+    filled, fdir, facc = d8_routing(synthetic_dem(60, 60, seed = 6))
+    link, links, xy, offsets = vectorize_stream_links(facc > 10, fdir, facc = facc)
+    for seed in range(3):
+        lines, lfacc = streamlines_low_to_high(links, xy, offsets, seed)
+        expected = loop_assign_valley_ids(lines, lfacc)
+        result = topology_valley_ids(lines, lfacc)
+        assert np.array_equal(result[0], expected[0]) and np.array_equal(result[1], expected[1])
+    print("ValleyID and MergeID checks passed")
+
+    for seed in (7, 8):
+        filled, fdir, facc = d8_routing(synthetic_dem(150, 150, seed = seed))
+        check_stream_graph(fdir, facc, 20, 200, 0.05)
+        ##The graphs of the threshold sweep are the graphs of each threshold
+        graphs = stream_graphs_from_arrays(fdir, facc, [50, 10, 20])
+        for threshold, graph in zip([50, 10, 20], graphs):
+            link, links, xy, offsets = vectorize_stream_links(facc > threshold, fdir, facc = facc)
+            assert link.dtype == label_dtype
+            assert np.array_equal(graph["links"], links) and np.array_equal(graph["xy"], xy)
+            ##The shared routing gives the same links as the routing of the stream cells
+            assert np.array_equal(stream_link_array(facc > threshold, fdir, stream_routing(fdir))[0], link)
+    print("Stream graph checks passed")
+    filled, fdir, facc = d8_routing(synthetic_dem(1000, 1000, seed = 7))
+    link, links, xy, offsets = vectorize_stream_links(facc > 20, fdir, facc = facc)
+    start = time.time()
+    lines, lxy, loffsets = dissolve_stream_graph(prune_stream_graph(stream_graph(links, xy, offsets), 500, 0.05))
+    print("Stream graph of %d links pruned and dissolved to %d lines: %.2f s" % (len(links), len(lines), time.time() - start))
+    filled, fdir, facc = d8_routing(synthetic_dem(500, 500, seed = 6))
+    link, links, xy, offsets = vectorize_stream_links(facc > 10, fdir, facc = facc)
+    lines, lfacc = streamlines_low_to_high(links, xy, offsets)
+    start = time.time()
+    topology_valley_ids(lines, lfacc)
+    print("ValleyID and MergeID of %d lines: %.2f s" % (len(lines), time.time() - start))
+    lineArray = random_links(100000)
+    start = time.time()
+    prune_tributaries(lineArray['OID'], lineArray['to_node'], lineArray['MAX'], 500, 0.05)
+    print("Pruning of %d links: %.3f s" % (len(lineArray), time.time() - start))
+
+    for size in (500, 1000, 2000):
+        filled, fdir, facc = d8_routing(synthetic_dem(size, size))
+        start = time.time()
+        link, links, xy, offsets = vectorize_stream_links(facc > 100, fdir)
+        print("%5d x %5d: %d links, %d vertices, %.2f s" % (size, size, len(links), len(xy), time.time() - start))